@@ -0,0 +1,153 @@
+import os
+import json
+import gzip
+import uuid
+import threading
+
+try:
+    import zstandard
+except ImportError:  # zstandard が無い環境では gzip で圧縮する
+    zstandard = None
+
+LOCAL_ENV = os.environ.get("LOCAL_ENV", "false").lower() == "true"
+
+# 保存先: none / local / s3
+ARTIFACT_BACKEND = os.environ.get("ARTIFACT_BACKEND", "local" if LOCAL_ENV else "s3").lower()
+# この大きさ（UTF-8 のバイト数）以下ならペイロードにそのまま入れ、超えたら保存してキーだけを渡す
+INLINE_MAX_BYTES = int(os.environ.get("ARTIFACT_INLINE_MAX_BYTES", str(256 * 1024)))
+# 圧縮形式: gzip / zstd（zstandard が無ければ gzip）
+# zstd にする場合は、成果物を読む側の Lambda（呼び出し元の web_article_analysis_handler を含む）すべてに zstandard が必要
+COMPRESSION = os.environ.get("ARTIFACT_COMPRESSION", "gzip").lower()
+ZSTD_LEVEL = int(os.environ.get("ARTIFACT_ZSTD_LEVEL", "3"))
+GZIP_LEVEL = int(os.environ.get("ARTIFACT_GZIP_LEVEL", "6"))
+
+# 参照を表す dict のキー。{"$artifact": キー, ...} の形でペイロードに入れる
+REF_KEY = "$artifact"
+
+
+class LocalBackend:
+    """ローカル・テスト用の保存先。ディレクトリにファイルとして置く。"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, key, data, content_type):
+        path = os.path.join(self.directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+
+    def get(self, key):
+        with open(os.path.join(self.directory, key), "rb") as f:
+            return f.read()
+
+
+class S3Backend:
+    """
+    本番用の保存先。Lambda 間の受け渡し用なので、バケットのライフサイクルルールで
+    prefix 配下を数日で消す設定にしておく。
+    """
+
+    def __init__(self, bucket, prefix="artifacts/"):
+        import boto3
+        self.s3 = boto3.client('s3')
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def put(self, key, data, content_type):
+        self.s3.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data, ContentType=content_type)
+
+    def get(self, key):
+        return self.s3.get_object(Bucket=self.bucket, Key=self.prefix + key)["Body"].read()
+
+
+def create_backend(name=ARTIFACT_BACKEND):
+    if name == "local":
+        return LocalBackend(os.environ.get("ARTIFACT_DIR", "/tmp/artifacts"))
+    if name == "s3":
+        bucket = os.environ.get("ARTIFACT_BUCKET") or os.environ.get("S3_BUCKET_NAME")
+        return S3Backend(bucket) if bucket else None
+    return None
+
+
+_backend = None
+_backend_created = False
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    # 初回の呼び出し時に作り、ウォームコンテナでは使い回す
+    global _backend, _backend_created
+    with _backend_lock:
+        if not _backend_created:
+            _backend = create_backend()
+            _backend_created = True
+        return _backend
+
+
+def compress(data):
+    """戻り値: (圧縮後のバイト列, 圧縮形式)"""
+    if COMPRESSION == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data), "zstd"
+    return gzip.compress(data, compresslevel=GZIP_LEVEL), "gzip"
+
+
+def decompress(data, encoding):
+    if encoding == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd で圧縮された成果物を読むには zstandard が必要です")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if encoding == "gzip":
+        return gzip.decompress(data)
+    return data
+
+
+def is_ref(value):
+    return isinstance(value, dict) and REF_KEY in value
+
+
+def pack(value, kind, inline_max_bytes=None):
+    """
+    文字列（HTML・Markdown）か JSON にできる値（ブロックのリストなど）を、
+    小さければそのまま、大きければ圧縮して保存し参照の dict にして返す。
+    kind はキーの接頭辞（"html" / "blocks" / "markdown" など）。
+    保存先が無い・保存に失敗した場合はそのまま返す。
+    """
+    if value is None or is_ref(value):
+        return value
+    limit = INLINE_MAX_BYTES if inline_max_bytes is None else int(inline_max_bytes)
+    is_text = isinstance(value, str)
+    raw = (value if is_text else json.dumps(value, ensure_ascii=False)).encode("utf-8")
+    if len(raw) <= limit:
+        return value
+    backend = get_backend()
+    if backend is None:
+        return value
+
+    data, encoding = compress(raw)
+    key = f"{kind}/{uuid.uuid4().hex}.{'txt' if is_text else 'json'}.{'zst' if encoding == 'zstd' else 'gz'}"
+    try:
+        backend.put(key, data, "text/plain; charset=utf-8" if is_text else "application/json")
+    except Exception as e:
+        print(f"成果物の保存に失敗したため、そのまま渡します: {e}")
+        return value
+    return {
+        REF_KEY: key,
+        "format": "text" if is_text else "json",
+        "encoding": encoding,
+        "bytes": len(raw),
+        "stored_bytes": len(data),
+    }
+
+
+def unpack(value):
+    """pack の戻り値を元の値に戻す。参照でなければそのまま返す。"""
+    if not is_ref(value):
+        return value
+    backend = get_backend()
+    if backend is None:
+        raise RuntimeError(f"成果物の保存先が設定されていないため {value[REF_KEY]} を読めません")
+    raw = decompress(backend.get(value[REF_KEY]), value.get("encoding"))
+    text = raw.decode("utf-8")
+    return text if value.get("format") == "text" else json.loads(text)
@@ -0,0 +1,220 @@
+from urllib.parse import urljoin
+
+# html_to_md の walk_blocks と同じ走査をブラウザ内で行うスクリプト。
+# fetch_html の2つの前処理（data-*src* を src にコピー、見えない要素を削除）と
+# html_to_md の前処理（<br> を半角スペースに置き換え）も、DOM を書き換えずに走査の中で同じ結果になるように扱う。
+# - 見えない要素（display: none / visibility: hidden / hidden 属性）はサブツリーごと読み飛ばし、
+#   削除後にパースし直したときと同じく、前後のテキストは1つの文字列にまとめる
+# - 隣り合うテキストと <br> は1つの文字列にまとめる（BeautifulSoup でパースし直したときと同じ区切りにする）
+# - rt / rp / template 配下の文字列は、get_text() と同じく見出し等のテキストに含めない
+# URL は html_to_md と同じく Python 側で urljoin する。
+DOM_BLOCKS_SCRIPT = r"""
+const SKIP = new Set(['script', 'style', 'noscript', 'iframe', 'svg']);
+const STRING_CONTAINERS = new Set(['rt', 'rp', 'template']);
+const ENTER = 0, EXIT_CAPTURE = 1, EXIT_LI = 2, EXIT_CELL = 3;
+const CONTAINER = 1, INERT = 2;
+// Python の str.strip() と同じ空白文字
+const WS = /^[\t\n\v\f\r\x1c-\x1f \x85\xa0\u1680\u2000-\u200a\u2028\u2029\u202f\u205f\u3000]+|[\t\n\v\f\r\x1c-\x1f \x85\xa0\u1680\u2000-\u200a\u2028\u2029\u202f\u205f\u3000]+$/g;
+
+const strip = s => s.replace(WS, '');
+const classes = el => (el.getAttribute('class') || '').split(/[\t\n\f\r ]+/);
+
+function isHidden(el) {
+  if (el.hidden) return true;
+  const s = window.getComputedStyle(el);
+  return s.display === 'none' || s.visibility === 'hidden';
+}
+
+function imgSrc(img) {
+  // fetch_html と同じく、名前に src を含む data-* 属性があれば最後のものを src とみなす
+  let src = img.getAttribute('src');
+  for (const attr of img.attributes) {
+    if (attr.name.startsWith('data-') && attr.name.slice(5).replace(/-/g, '').includes('src')) {
+      src = attr.value;
+    }
+  }
+  return src;
+}
+
+function hasPcImage(parent) {
+  for (const img of parent.querySelectorAll('img')) {
+    if (!classes(img).includes('pc')) continue;
+    let el = img;
+    while (el !== parent && !SKIP.has(el.localName) && !isHidden(el)) el = el.parentNode;
+    if (el === parent) return true;
+  }
+  return false;
+}
+
+function pushChildren(stack, node, flags) {
+  if (STRING_CONTAINERS.has(node.localName)) flags |= CONTAINER;
+  let kids = node.childNodes;
+  if (node.localName === 'template' && node.content) {
+    kids = node.content.childNodes;
+    flags |= INERT;
+  }
+  const items = [];
+  let run = null;
+  for (const child of kids) {
+    // 見えない要素は fetch_html では削除されるので、前後のテキストは1つにつながる。まとまりを切らずに読み飛ばす
+    if (child.nodeType === 1 && !(flags & INERT) && isHidden(child)) continue;
+    const isBr = child.nodeType === 1 && child.localName === 'br';
+    if (child.nodeType === 3 || isBr) {
+      const value = isBr ? ' ' : child.data;
+      if (run) run.run += value;
+      else { run = {run: value, parent: node}; items.push(run); }
+      continue;
+    }
+    run = null;
+    if (child.nodeType === 1) items.push(child);
+  }
+  for (let i = items.length - 1; i >= 0; i--) stack.push([ENTER, items[i], flags]);
+}
+
+function newCapture(node, kind, start, raw) {
+  return {node, kind, start, raw: !!raw, items: [], rows: new Map(), sectionRows: [], images: []};
+}
+
+function finishCapture(cap, texts, blocks) {
+  const kind = cap.kind, node = cap.node;
+  if (kind === 'list') {
+    const ordered = node.localName === 'ol';
+    for (const text of cap.items) blocks.push({type: 'list_item', ordered, text});
+    return;
+  }
+  if (kind === 'table') {
+    blocks.push({type: 'table', rows: cap.sectionRows.length ? cap.sectionRows : cap.items});
+    return;
+  }
+  const text = texts.slice(cap.start).join('');
+  if (kind === 'heading') {
+    if (text) blocks.push({type: 'heading', level: parseInt(node.localName[1], 10), text});
+  } else if (kind === 'link') {
+    for (const img of cap.images) blocks.push(img);
+    if (text) blocks.push({type: 'link', href: node.getAttribute('href'), text});
+  } else if (kind === 'code_block') {
+    blocks.push({type: 'code_block', code: text});
+  } else if (kind === 'button' || kind === 'textarea') {
+    blocks.push({type: 'text', tag: kind, text});
+  } else {
+    blocks.push({type: kind, text});
+  }
+}
+
+function walk(root) {
+  const blocks = [], texts = [];
+  const pcCache = new Map();
+  let cap = null;
+  const stack = [[ENTER, root, 0]];
+  while (stack.length) {
+    const [action, node, data] = stack.pop();
+
+    if (action === EXIT_LI) { cap.items.push(texts.slice(data).join('')); continue; }
+    if (action === EXIT_CELL) { node.push(texts.slice(data).join('')); continue; }
+    if (action === EXIT_CAPTURE) { finishCapture(cap, texts, blocks); texts.length = cap.start; cap = null; continue; }
+
+    // テキストと <br> のまとまり
+    if (node.run !== undefined) {
+      if (cap) {
+        if (!(data & CONTAINER)) {
+          if (cap.raw) texts.push(node.run);
+          else { const text = strip(node.run); if (text) texts.push(text); }
+        }
+        continue;
+      }
+      const text = strip(node.run);
+      const parentName = node.parent.localName;
+      if (text && parentName !== 'html' && parentName !== 'body' && parentName !== 'head') {
+        blocks.push({type: 'text', tag: parentName, text});
+      }
+      continue;
+    }
+
+    const name = node.localName;
+    if (SKIP.has(name)) continue;
+
+    if (cap) {
+      if (cap.kind === 'link') {
+        const src = name === 'img' ? imgSrc(node) : null;
+        if (src) cap.images.push({type: 'image', src, alt: node.getAttribute('alt') || ''});
+      } else if (cap.kind === 'list') {
+        if (name === 'li' && node.parentNode === cap.node) stack.push([EXIT_LI, node, texts.length]);
+      } else if (cap.kind === 'table') {
+        if (name === 'tr') {
+          const row = [];
+          cap.rows.set(node, row);
+          const parent = node.parentNode;
+          if ((parent.localName === 'thead' || parent.localName === 'tbody') && parent.parentNode === cap.node) {
+            cap.sectionRows.push(row);
+          }
+          cap.items.push(row);
+        } else if ((name === 'th' || name === 'td') && cap.rows.has(node.parentNode)) {
+          stack.push([EXIT_CELL, cap.rows.get(node.parentNode), texts.length]);
+        }
+      }
+      pushChildren(stack, node, data);
+      continue;
+    }
+
+    if (name.length === 2 && name[0] === 'h' && name[1] >= '0' && name[1] <= '9') {
+      cap = newCapture(node, 'heading', texts.length);
+    } else if (name === 'ul' || name === 'ol') {
+      cap = newCapture(node, 'list', texts.length);
+    } else if (name === 'table') {
+      cap = newCapture(node, 'table', texts.length);
+    } else if (name === 'hr') {
+      blocks.push({type: 'hr'});
+      continue;
+    } else if (name === 'blockquote') {
+      cap = newCapture(node, 'blockquote', texts.length);
+    } else if (name === 'pre') {
+      cap = newCapture(node, 'code_block', texts.length, true);
+    } else if (name === 'code' && !Array.from(node.childNodes).some(
+        c => c.nodeType === 1 && c.localName !== 'br' && !SKIP.has(c.localName))) {
+      cap = newCapture(node, 'inline_code', texts.length);
+    } else if (name === 'strong' || name === 'b') {
+      cap = newCapture(node, 'bold', texts.length);
+    } else if (name === 'em' || name === 'i') {
+      cap = newCapture(node, 'italic', texts.length);
+    } else if (name === 'a' && node.getAttribute('href')) {
+      cap = newCapture(node, 'link', texts.length);
+    } else if (name === 'img' && imgSrc(node)) {
+      if (classes(node).includes('sp')) {
+        const parent = node.parentNode;
+        if (!pcCache.has(parent)) pcCache.set(parent, hasPcImage(parent));
+        if (pcCache.get(parent)) continue;
+      }
+      blocks.push({type: 'image', src: imgSrc(node), alt: node.getAttribute('alt') || ''});
+      continue;
+    } else if (name === 'input' && node.getAttribute('value')) {
+      blocks.push({type: 'text', tag: 'input', text: node.getAttribute('value')});
+      continue;
+    } else if (name === 'button' || name === 'textarea') {
+      cap = newCapture(node, name, texts.length);
+    } else if ((name === 'video' || name === 'audio') && node.getAttribute('src')) {
+      blocks.push({type: 'media', tag: name, src: node.getAttribute('src')});
+      continue;
+    }
+
+    if (cap) stack.push([EXIT_CAPTURE, node, 0]);
+    pushChildren(stack, node, data);
+  }
+  return blocks;
+}
+
+return document.body && !isHidden(document.body) ? walk(document.body) : [];
+"""
+
+
+def extract_blocks(chrome, base_url):
+    """
+    表示中のページからブロックを作る。html_to_md の html_to_blocks と同じ形の dict のリストを返す。
+    page_source の取得・転送と BeautifulSoup でのパースを省ける。
+    """
+    blocks = chrome.execute_script(DOM_BLOCKS_SCRIPT)
+    for block in blocks:
+        if block['type'] in ('image', 'media'):
+            block['src'] = urljoin(base_url, block['src'])
+        elif block['type'] == 'link':
+            block['href'] = urljoin(base_url, block['href'])
+    return blocks
@@ -0,0 +1,202 @@
+import os
+import shutil
+from tempfile import mkdtemp
+from selenium import webdriver
+
+import tracing
+
+# 1つのChromeで処理するページ数の上限。超えたら再起動してメモリリークをリセットする
+MAX_PAGES_PER_DRIVER = int(os.environ.get("DRIVER_MAX_PAGES", "30"))
+# Chrome関連プロセスの合計RSS(MB)の上限。超えたら再起動する
+MAX_DRIVER_MEMORY_MB = int(os.environ.get("DRIVER_MAX_MEMORY_MB", "1500"))
+# chrome.get の待ち時間の上限（秒）。超えたら読み込みを止めて表示できている分で続ける
+PAGE_LOAD_TIMEOUT = int(os.environ.get("PAGE_LOAD_TIMEOUT", "20"))
+
+WINDOW_WIDTH = 1280
+WINDOW_HEIGHT = 1696
+
+# リクエストごとに /tmp に作るファイルの接頭辞。ブラウザ稼働中でもこれらは削除してよい
+REQUEST_ARTIFACT_PREFIXES = ("screenshot_", "cropped_", "model_")
+
+# Chromeドライバの初期化
+def init_driver(profile_root):
+    options = webdriver.ChromeOptions()
+    service = webdriver.ChromeService("/opt/chromedriver")
+
+    options.binary_location = '/opt/chrome/chrome'
+    # DOMContentLoaded で制御を返し、以降は page_load.wait_until_ready で通信・DOM が落ち着くのを待つ
+    options.page_load_strategy = 'eager'
+    options.add_argument("--headless=new") #GUIを表示しない。コマンドラインで開く。
+    options.add_argument('--no-sandbox') # セキュリティサンドボックスを無効にする。
+    options.add_argument("--disable-gpu") # GPUではなくCPUでグラフィック処理
+    options.add_argument(f"--window-size={WINDOW_WIDTH}x{WINDOW_HEIGHT}") # 画面サイズを指定
+    options.add_argument("--hide-scrollbars") # スクロールバーを非表示にする
+    # options.add_argument("--single-process") # 使うと安定性が下がるがリソース消費は減る
+    options.add_argument("--disable-dev-shm-usage") #dev/shmはchromeが頻繁に利用する共有メモリ領域。Lambdaではサイズの変更ができず足りなくなる。このオプションを使うと代わりに/tmpを用いるようになる。
+    options.add_argument("--disable-dev-tools") #開発ツールを無効にする
+    options.add_argument("--no-zygote") #zygoteは新しいレンダラープロセス（タブや拡張機能）を高速生成する。
+    # プロファイル類は1つのディレクトリにまとめ、再起動時にまとめて削除できるようにする
+    options.add_argument(f"--user-data-dir={os.path.join(profile_root, 'user-data')}")
+    options.add_argument(f"--data-path={os.path.join(profile_root, 'data')}")
+    options.add_argument(f"--disk-cache-dir={os.path.join(profile_root, 'cache')}")
+    # options.add_argument("--remote-debugging-port=9222") #デバッグ用
+    # メインドキュメントの ETag / Last-Modified を返すために、ネットワークのイベントだけをパフォーマンスログに残す
+    options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+    options.add_experimental_option("perfLoggingPrefs", {"enableNetwork": True, "enablePage": False})
+
+    chrome = webdriver.Chrome(options=options, service=service)
+    chrome.set_page_load_timeout(PAGE_LOAD_TIMEOUT)
+    return chrome
+
+def _process_tree_rss_mb(root_pid):
+    """
+    /proc を読んで root_pid 以下のプロセスツリーの合計RSS(MB)を返す。
+    chromedriver → chrome → renderer… の全プロセスが対象。
+    """
+    children = {}
+    rss_kb = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/status") as f:
+                ppid, rss = None, 0
+                for line in f:
+                    if line.startswith("PPid:"):
+                        ppid = int(line.split()[1])
+                    elif line.startswith("VmRSS:"):
+                        rss = int(line.split()[1])
+        except (OSError, ValueError):
+            continue
+        pid = int(entry)
+        rss_kb[pid] = rss
+        children.setdefault(ppid, []).append(pid)
+
+    total_kb = 0
+    stack = [root_pid]
+    while stack:
+        pid = stack.pop()
+        total_kb += rss_kb.get(pid, 0)
+        stack.extend(children.get(pid, []))
+    return total_kb / 1024
+
+class DriverManager:
+    """
+    ウォームコンテナ間でChromeを使い回すためのライフサイクル管理。
+    acquire() で健全なドライバを返し、release() でページ数を数える。
+    ページ数・メモリが上限を超えた場合や応答しない場合は作り直す。
+    """
+
+    def __init__(self, max_pages=MAX_PAGES_PER_DRIVER, max_memory_mb=MAX_DRIVER_MEMORY_MB):
+        self.max_pages = max_pages
+        self.max_memory_mb = max_memory_mb
+        self.chrome = None
+        self.profile_root = None
+        self.pages = 0
+
+    @property
+    def alive(self):
+        return self.chrome is not None
+
+    def acquire(self):
+        if self.chrome is not None and not self._needs_recycle():
+            try:
+                self.reset()
+                return self.chrome
+            except Exception as e:
+                print(f"ブラウザ状態のリセットに失敗したため再起動します: {e}")
+        self.restart()
+        return self.chrome
+
+    def release(self):
+        self.pages += 1
+
+    def restart(self):
+        self.quit()
+        self.profile_root = mkdtemp(prefix="chrome_")
+        with tracing.span("chrome_start"):
+            self.chrome = init_driver(self.profile_root)
+        self.pages = 0
+        print("Chromeを起動しました")
+
+    def quit(self):
+        if self.chrome is not None:
+            try:
+                self.chrome.quit()
+            except Exception as e:
+                print(f"Chromeの終了に失敗しました: {e}")
+        if self.profile_root:
+            shutil.rmtree(self.profile_root, ignore_errors=True)
+        self.chrome = None
+        self.profile_root = None
+        self.pages = 0
+
+    def is_healthy(self):
+        try:
+            return self.chrome.execute_script("return 1") == 1
+        except Exception:
+            return False
+
+    def memory_mb(self):
+        try:
+            return _process_tree_rss_mb(self.chrome.service.process.pid)
+        except Exception:
+            return 0
+
+    def _needs_recycle(self):
+        if self.pages >= self.max_pages:
+            print(f"{self.pages}ページ処理したのでChromeを再起動します")
+            return True
+        if not self.is_healthy():
+            print("Chromeが応答しないため再起動します")
+            return True
+        memory = self.memory_mb()
+        if memory >= self.max_memory_mb:
+            print(f"Chromeのメモリ使用量が{memory:.0f}MBに達したため再起動します")
+            return True
+        return False
+
+    def reset(self):
+        """
+        前のURLの状態を消す。cookie・キャッシュ・ストレージを削除し、
+        新しい空タブだけを残してウィンドウサイズを元に戻す。
+        """
+        chrome = self.chrome
+        try:
+            origin = chrome.execute_script("return window.location.origin")
+            if origin and origin.startswith("http"):
+                chrome.execute_cdp_cmd("Storage.clearDataForOrigin", {"origin": origin, "storageTypes": "all"})
+        except Exception as e:
+            print(f"ストレージの削除に失敗しました: {e}")
+        chrome.execute_cdp_cmd("Network.clearBrowserCookies", {})
+        chrome.execute_cdp_cmd("Network.clearBrowserCache", {})
+
+        old_handles = chrome.window_handles
+        chrome.switch_to.new_window('tab')
+        fresh = chrome.current_window_handle
+        for handle in old_handles:
+            chrome.switch_to.window(handle)
+            chrome.close()
+        chrome.switch_to.window(fresh)
+        chrome.set_window_size(WINDOW_WIDTH, WINDOW_HEIGHT)
+
+    def cleanup_tmp(self, tmp_dir="/tmp"):
+        """
+        /tmp の古いファイルを削除する。
+        ブラウザが稼働中ならプロファイルやChromeの共有メモリファイルは残し、
+        前回リクエストのスクリーンショットだけを消す。停止中なら全て削除する。
+        """
+        for filename in os.listdir(tmp_dir):
+            file_path = os.path.join(tmp_dir, filename)
+            if self.alive and not filename.startswith(REQUEST_ARTIFACT_PREFIXES):
+                continue
+            try:
+                if os.path.isfile(file_path) or os.path.islink(file_path):
+                    os.unlink(file_path)  # ファイルまたはシンボリックリンクを削除
+                elif os.path.isdir(file_path):
+                    shutil.rmtree(file_path)  # ディレクトリを再帰的に削除
+            except Exception as e:
+                print(f"Error deleting {file_path}: {e}")
+
+# 関数外で保持することでウォームスタート時にChromeを使い回す
+driver_manager = DriverManager()
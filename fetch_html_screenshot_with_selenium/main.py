@@ -1,14 +1,20 @@
 import json
 import os
-from tempfile import mkdtemp
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from PIL import Image
+from selenium.common.exceptions import TimeoutException
 import boto3
-import shutil
 import uuid
+import io
+import time
+import base64
+import hashlib
+from PIL import Image
+
+from driver_pool import driver_manager, WINDOW_WIDTH, WINDOW_HEIGHT
+import screenshot_processing
+import page_load
+import dom_blocks
+import artifact_store
+import tracing
 
 #実行環境がローカルの場合、LOCAL_ENVを設定する
 LOCAL_ENV = os.environ.get("LOCAL_ENV", "false").lower() == "true"
@@ -18,42 +24,107 @@ if not LOCAL_ENV:
     s3 = boto3.client('s3')
     S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")
 
-# ウォームコンテナの場合、前回の実行結果が /tmp に残っている可能性があるため、全てのファイルとディレクトリを削除。
-def initialize_lambda_environment():
-    tmp_dir = "/tmp"
-    for filename in os.listdir(tmp_dir):
-        file_path = os.path.join(tmp_dir, filename)
-        try:
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)  # ファイルまたはシンボリックリンクを削除
-            elif os.path.isdir(file_path):
-                shutil.rmtree(file_path)  # ディレクトリを再帰的に削除
-        except Exception as e:
-            print(f"Error deleting {file_path}: {e}")
-
-# Chromeドライバの初期化
-def init_driver():
-    options = webdriver.ChromeOptions()
-    service = webdriver.ChromeService("/opt/chromedriver")
-
-    options.binary_location = '/opt/chrome/chrome'
-    options.add_argument("--headless=new") #GUIを表示しない。コマンドラインで開く。
-    options.add_argument('--no-sandbox') # セキュリティサンドボックスを無効にする。
-    options.add_argument("--disable-gpu") # GPUではなくCPUでグラフィック処理
-    options.add_argument("--window-size=1280x1696") # 画面サイズを指定
-    options.add_argument("--hide-scrollbars") # スクロールバーを非表示にする
-    # options.add_argument("--single-process") # 使うと安定性が下がるがリソース消費は減る
-    options.add_argument("--disable-dev-shm-usage") #dev/shmはchromeが頻繁に利用する共有メモリ領域。Lambdaではサイズの変更ができず足りなくなる。このオプションを使うと代わりに/tmpを用いるようになる。
-    options.add_argument("--disable-dev-tools") #開発ツールを無効にする
-    options.add_argument("--no-zygote") #zygoteは新しいレンダラープロセス（タブや拡張機能）を高速生成する。
-    options.add_argument(f"--user-data-dir={mkdtemp()}") #一時ディレクトリを生成し、不要なデータの残留を防ぐ
-    options.add_argument(f"--data-path={mkdtemp()}")
-    options.add_argument(f"--disk-cache-dir={mkdtemp()}")
-    # options.add_argument("--remote-debugging-port=9222") #デバッグ用
-
-    return webdriver.Chrome(options=options, service=service)
+# 複数URLモードで同時に開くタブ数
+BATCH_TAB_CONCURRENCY = int(os.environ.get("BATCH_TAB_CONCURRENCY", "4"))
+
+# スクショの取り方: window（ウィンドウをページ全体の高さに広げて1枚で撮る）/ tiled（表示領域ずつスクロールして撮り、つなげる）
+# auto はページが WINDOW_CAPTURE_MAX_HEIGHT 以下なら window、それより長ければ tiled
+CAPTURE_MODES = ('auto', 'window', 'tiled')
+CAPTURE_MODE = os.environ.get("SCREENSHOT_CAPTURE_MODE", "auto").lower()
+WINDOW_CAPTURE_MAX_HEIGHT = int(os.environ.get("SCREENSHOT_WINDOW_MAX_HEIGHT", "8000"))
+# tiled で撮る高さの上限（CSS px）。これより下は撮らないので、ページの長さに関わらずメモリ使用量が一定に収まる
+CAPTURE_MAX_HEIGHT = int(os.environ.get("SCREENSHOT_MAX_HEIGHT", "20000"))
+# スクロールしてから撮るまでの待ち時間（秒）。遅延読み込みの画像を表示させる
+SCROLL_SETTLE_SECONDS = float(os.environ.get("SCREENSHOT_SCROLL_SETTLE_SECONDS", "0.15"))
+
+# ページ内容の返し方: html（page_source をそのまま返す）/ blocks（ブラウザ内で html_to_md と同じブロックに分解して返す）
+# blocks にすると HTML の転送と html_to_md でのパースを省ける
+OUTPUT_FORMATS = ('html', 'blocks')
+OUTPUT_FORMAT = os.environ.get("PAGE_OUTPUT_FORMAT", "html").lower()
+
+def capture_options_from(event):
+    mode = str(event.get("capture_mode", CAPTURE_MODE)).lower()
+    output = str(event.get("output", OUTPUT_FORMAT)).lower()
+    return {
+        "mode": mode if mode in CAPTURE_MODES else "auto",
+        "max_height": int(event.get("capture_max_height", CAPTURE_MAX_HEIGHT)),
+        # 読み込み時に遮断するURLと、読み込み完了を待つ時間の上限
+        "block_patterns": page_load.blocked_url_patterns(event),
+        "ready_max_wait": float(event.get("ready_max_wait", page_load.READY_MAX_WAIT_SECONDS)),
+        "output": output if output in OUTPUT_FORMATS else "html",
+    }
 
 # スクリーンショットを取得する関数
+def take_screenshot(chrome, output_path, capture_options=None):
+    capture_options = capture_options or capture_options_from({})
+    mode = capture_options["mode"]
+    if mode == 'auto':
+        metrics = chrome.execute_cdp_cmd("Page.getLayoutMetrics", {})
+        mode = 'window' if metrics["contentSize"]["height"] <= WINDOW_CAPTURE_MAX_HEIGHT else 'tiled'
+    if mode == 'tiled':
+        take_tiled_screenshot(chrome, output_path, capture_options["max_height"])
+    else:
+        take_fullpage_screenshot(chrome, output_path)
+    return mode
+
+# スクロールしながら表示領域ずつ撮り、1枚の画像に順に貼り付ける関数
+def take_tiled_screenshot(chrome, output_path, max_height=CAPTURE_MAX_HEIGHT):
+    """
+    ウィンドウの大きさは変えずに、表示領域の高さずつスクロールして CDP で撮る。
+    貼り付け先の画像は最初に測ったページの高さ（上限 max_height）で確保するので、
+    無限スクロールで途中からページが伸びても、メモリ使用量は増えない。
+    固定ヘッダーなどが各区間に写り込まないよう、2区間目以降は position: fixed/sticky の要素を隠す（撮影後に戻す）。
+    """
+    size = chrome.execute_script(
+        "return [window.innerWidth, window.innerHeight, document.documentElement.scrollHeight];"
+    )
+    viewport_width, viewport_height, page_height = size
+    target_height = max(1, min(page_height, max_height))
+
+    canvas = None
+    scale = 1
+    hidden_fixed = False
+    try:
+        y = 0
+        while y < target_height:
+            scroll_y = chrome.execute_script("window.scrollTo(0, arguments[0]); return window.scrollY;", y)
+            time.sleep(SCROLL_SETTLE_SECONDS)
+            shot = chrome.execute_cdp_cmd("Page.captureScreenshot", {"format": "png"})
+            with Image.open(io.BytesIO(base64.b64decode(shot["data"]))) as segment:
+                if canvas is None:
+                    # 高解像度ディスプレイ相当の場合は CSS px と画像の px の比率をかける
+                    scale = segment.width / viewport_width
+                    canvas = Image.new("RGB", (segment.width, round(target_height * scale)), "white")
+                # ページの最後ではスクロールが止まるので、まだ撮っていない部分だけを切り出す
+                offset = round((y - scroll_y) * scale)
+                height = min(round(viewport_height * scale) - offset, canvas.height - round(y * scale))
+                canvas.paste(segment.crop((0, offset, segment.width, offset + height)), (0, round(y * scale)))
+            y += viewport_height
+            if not hidden_fixed:
+                chrome.execute_script("""
+                  document.querySelectorAll('body *').forEach(el => {
+                    const p = window.getComputedStyle(el).position;
+                    if (p === 'fixed' || p === 'sticky') {
+                      el.setAttribute('data-capture-hidden', el.style.visibility);
+                      el.style.visibility = 'hidden';
+                    }
+                  });
+                """)
+                hidden_fixed = True
+    finally:
+        # HTML取得で隠した要素が消されないよう元に戻す
+        chrome.execute_script("""
+          document.querySelectorAll('[data-capture-hidden]').forEach(el => {
+            el.style.visibility = el.getAttribute('data-capture-hidden');
+            el.removeAttribute('data-capture-hidden');
+          });
+          window.scrollTo(0, 0);
+        """)
+    canvas.save(output_path)
+    canvas.close()
+    return
+
+# スクリーンショットを取得する関数（ウィンドウをページ全体に広げて1枚で撮る）
 def take_fullpage_screenshot(chrome, output_path):
     # Chrome DevTools Protocol (CDP) を使ってページ全体のサイズを取得
     metrics = chrome.execute_cdp_cmd("Page.getLayoutMetrics", {})
@@ -94,61 +165,163 @@ def fetch_html(chrome):
     html_content = chrome.page_source
     return html_content
 
+# 読み込み済みのページからスクショとHTML（output が blocks の場合はブロックのリスト）を取得する関数
+# timings を渡すと、ステップごとの所要秒数を記録する
+def capture_page(chrome, url, output_path, exit_picture=True, capture_options=None, timings=None):
+    # 通信と DOM の変更が落ち着くまで待機（上限を超えたら body があればそのまま進む）
+    capture_options = capture_options or capture_options_from({})
+    with tracing.span("wait_ready", timings, url=url):
+        readiness = page_load.wait_until_ready(chrome, max_wait=capture_options["ready_max_wait"])
+    print(f"{url}の読み込み待ち: {readiness}")
+    page_load.record_validators(chrome, url)
+
+    # スクリーンショットの保存
+    try:
+        with tracing.span("screenshot", timings, url=url) as span:
+            mode = take_screenshot(chrome, output_path, capture_options)
+            span.add_bytes(os.path.getsize(output_path))
+            span.set(mode=mode)
+        print(f"{url}のスクリーンショット取得が完了しました（{mode}）")
+    except TimeoutError as e:
+        print(f"{url}のスクリーンショット取得がタイムアウトしました。{e}")
+        exit_picture = False
+    except Exception as e:
+        print(f"{url}のスクリーンショット取得に失敗しました。{e}")
+        exit_picture = False
+
+    # ブロックの抽出（失敗したら HTML の取得に切り替える）
+    if capture_options["output"] == 'blocks':
+        try:
+            with tracing.span("extract_blocks", timings, url=url) as span:
+                blocks = dom_blocks.extract_blocks(chrome, url)
+                span.set(blocks=len(blocks))
+            print(f"{url}のブロック抽出が完了しました（{len(blocks)}件）")
+            return exit_picture, blocks
+        except Exception as e:
+            print(f"{url}のブロック抽出に失敗したため、HTMLを取得します。{e}")
+
+    # HTML取得
+    try:
+        with tracing.span("fetch_html", timings, url=url) as span:
+            html = fetch_html(chrome)
+            span.add_bytes(len(html.encode("utf-8")))
+        print(f"{url}のhtml取得が完了しました")
+    except Exception as e:
+        print(f"{url}のhtml取得に失敗しました。{e}")
+        html = "can't_get_html"
+
+    return exit_picture, html
+
 # URLを解析する関数
-def analysis_url_with_selenium(url, output_path, exit_picture=True):
+def analysis_url_with_selenium(url, output_path, exit_picture=True, capture_options=None, timings=None):
     """
-    ドライバ起動 → URL読み込み → スクショ → HTML取得 → ドライバ終了
+    ドライバ取得 → URL読み込み → スクショ → HTML取得 → ドライバ返却
+    ドライバはウォームコンテナ間で使い回し、終了はせずに driver_manager に返す。
     """
-    chrome = None
     html = "can't_get_html"
     try:
-        chrome = init_driver()
+        with tracing.span("acquire_driver", timings, url=url):
+            chrome = driver_manager.acquire()
         
-        # chrome.implicitly_wait(10) こいつ入れると全然動かなくなる。
-        chrome.get(url)
-        
-        # ページが完全にロードされるまで明示的に待機（bodyタグが表示されるまで）
-        WebDriverWait(chrome, 10).until(EC.presence_of_element_located((By.TAG_NAME, "body")))
-        
-        # スクリーンショットの保存
-        try:
-            take_fullpage_screenshot(chrome, output_path)
-            print(f"{url}のスクリーンショット取得が完了しました")
-        except TimeoutError as e:
-            print(f"{url}のスクリーンショット取得がタイムアウトしました。{e}")
-            exit_picture = False
-        except Exception as e:
-            print(f"{url}のスクリーンショット取得に失敗しました。{e}")
-            exit_picture = False
+        capture_options = capture_options or capture_options_from({})
+        page_load.apply_blocking(chrome, capture_options["block_patterns"])
 
-        # HTML取得
+        # chrome.implicitly_wait(10) こいつ入れると全然動かなくなる。
         try:
-            html = fetch_html(chrome)
-            print(f"{url}のhtml取得が完了しました")
-        except Exception as e:
-            print(f"{url}のhtml取得に失敗しました。{e}")
-            html = "can't_get_html"
+            with tracing.span("page_load", timings, url=url):
+                chrome.get(url)
+        except TimeoutException:
+            # 読み込みが終わらないページは止めて、表示できている分で続ける
+            print(f"{url}の読み込みがタイムアウトしたため中断して続行します")
+            chrome.execute_script("window.stop();")
+        
+        exit_picture, html = capture_page(chrome, url, output_path, exit_picture, capture_options, timings)
     
     except Exception as e:
         print(f"{url}の解析に失敗しました。{e}")
         exit_picture = False
         html = "can't_get_html"
     finally:
-        chrome.quit()
+        driver_manager.release()
 
     return exit_picture, html
 
-#全体スクショをトリミング
-def crop_screenshot(screenshot_path, cropped_path):
-    # 画像をトリミング
-    image = Image.open(screenshot_path)
-    width, height = image.size
-    crop_area = (0,0,width,900)
-    cropped_image = image.crop(crop_area)
-    cropped_image.save(cropped_path)
-    return
+# 複数URLを1つのブラウザのタブで並行して読み込み、解析する関数
+def analysis_urls_in_tabs(jobs, concurrency=BATCH_TAB_CONCURRENCY, capture_options=None, timings=None):
+    """
+    jobs: [(url, output_path), ...]
+    最大 concurrency 個のタブで先読みしておき、読み込みが進んだタブから順にスクショとHTMLを取得する。
+    戻り値: [(exit_picture, html), ...]（jobs と同じ順。同じURLが複数あってもそれぞれ返す）
+    timings を渡すと、jobs の i 番目のステップの所要秒数を timings[i] に入れる
+    """
+    capture_options = capture_options or capture_options_from({})
+    outcomes = {}
+    pending = list(enumerate(jobs))
+    open_tabs = []  # [(handle, index, url, output_path), ...] 開いた順
 
-def upload_to_s3(image_path):
+    timings = timings if timings is not None else {}
+    chrome = None
+    base_handle = None
+    try:
+        with tracing.span("acquire_driver", urls=len(jobs)):
+            chrome = driver_manager.acquire()
+        base_handle = chrome.current_window_handle
+
+        while pending or open_tabs:
+            # 空きがあれば新しいタブでナビゲーションだけ開始する（読み込み完了は待たない）
+            while pending and len(open_tabs) < concurrency:
+                index, (url, output_path) = pending.pop(0)
+                handle = None
+                try:
+                    chrome.switch_to.new_window('tab')
+                    handle = chrome.current_window_handle
+                    page_load.apply_blocking(chrome, capture_options["block_patterns"])
+                    chrome.execute_script("window.location.href = arguments[0];", url)
+                    open_tabs.append((handle, index, url, output_path))
+                except Exception as e:
+                    print(f"{url}のタブを開けませんでした。{e}")
+                    outcomes[index] = (False, "can't_get_html")
+                    # 開けたタブは残さない
+                    if handle is not None:
+                        _close_tab(chrome, handle, base_handle, url)
+
+            if not open_tabs:
+                continue
+
+            # 一番古いタブから処理し、終わったら閉じる
+            handle, index, url, output_path = open_tabs.pop(0)
+            try:
+                chrome.switch_to.window(handle)
+                outcomes[index] = capture_page(chrome, url, output_path, capture_options=capture_options,
+                                               timings=timings.setdefault(index, {}))
+            except Exception as e:
+                print(f"{url}の解析に失敗しました。{e}")
+                outcomes[index] = (False, "can't_get_html")
+            finally:
+                _close_tab(chrome, handle, base_handle, url)
+                driver_manager.release()
+
+    except Exception as e:
+        print(f"タブ並行処理に失敗しました。{e}")
+    finally:
+        # 途中で失敗した場合も、開いたままのタブを閉じる
+        for handle, _, url, _ in open_tabs:
+            _close_tab(chrome, handle, base_handle, url)
+
+    # 取りこぼしたURLは失敗として返す
+    return [outcomes.get(index, (False, "can't_get_html")) for index in range(len(jobs))]
+
+def _close_tab(chrome, handle, base_handle, url):
+    try:
+        chrome.switch_to.window(handle)
+        chrome.close()
+        chrome.switch_to.window(base_handle)
+        # フルページスクショで変えたウィンドウサイズを戻す
+        chrome.set_window_size(WINDOW_WIDTH, WINDOW_HEIGHT)
+    except Exception as e:
+        print(f"{url}のタブを閉じられませんでした。{e}")
+
+def upload_to_s3(image_path, content_type='image/png'):
     #ローカル環境ではスキップする
     if LOCAL_ENV:
         print("ローカル環境なのでs3へのアップロードは行いません")
@@ -157,59 +330,150 @@ def upload_to_s3(image_path):
         try:
             base_name = os.path.basename(image_path)
             s3_key = f"live/{base_name}"
-            s3.upload_file(image_path, S3_BUCKET_NAME, s3_key, ExtraArgs={'ContentType': 'image/png'})
+            with tracing.span("s3_upload", key=s3_key) as span:
+                s3.upload_file(image_path, S3_BUCKET_NAME, s3_key, ExtraArgs={'ContentType': content_type})
+                span.add_bytes(os.path.getsize(image_path))
             #公開urlを返却
             return (f"https://{S3_BUCKET_NAME}.s3.amazonaws.com/{s3_key}", s3_key)
         except Exception as e:
             print(f"S3へのアップロードに失敗しました: {e}")
             return ("can't_get_image", None)
 
-def handler(event, context):
-    initialize_lambda_environment()
-
-    url = event.get("url")
-
-    # /tmp 以下にファイルパスを準備
-    unique_id = uuid.uuid4().hex[:5]
-    screenshot_path = f"/tmp/screenshot_{unique_id}.png"
-    cropped_path    = f"/tmp/cropped_{unique_id}.png"
-
-    # selemiumで解析
-    exit_picture, html = analysis_url_with_selenium(url, screenshot_path)
-
-    # HTML 取得が失敗した場合のみ、一度だけリトライ
-    if html == "can't_get_html":
-        print(f"{url}のhtml取得が失敗したため、リトライします")
-        exit_picture, html = analysis_url_with_selenium(url, screenshot_path)
-
+# スクショのトリミング・縮小・S3アップロードを行い、1URL分の結果を組み立てる
+def build_result(url, exit_picture, html, screenshot_path, cropped_path, model_image_options, timings=None):
+    # ブラウザ内でブロックに分解した場合は html の代わりに blocks で返す
+    blocks = None
+    if isinstance(html, list):
+        blocks, html = html, None
+    s3_key = None
+    model_s3_keys = []
+    screenshot_stats = None
+    image_url         = "can't_get_image"
+    cropped_image_url = "can't_get_image"
     if exit_picture:
-        crop_screenshot(screenshot_path, cropped_path)
-    else:
-        cropped_path = "can't_get_image"
+        try:
+            # 1回のデコードで公開用のトリミング画像とモデル用の縮小画像を作る
+            model_path_prefix = cropped_path.replace("/cropped_", "/model_").rsplit(".", 1)[0]
+            with tracing.span("process_screenshot", timings, url=url):
+                model_paths, screenshot_stats = screenshot_processing.process_screenshot(
+                    screenshot_path, cropped_path, model_path_prefix, model_image_options
+                )
+            print(f"{url}のスクショを処理しました: {screenshot_stats}")
 
-    # 画像をS3 にアップロード
-    try:
-        if exit_picture:
-            image_url, s3_key = upload_to_s3(screenshot_path)
-            cropped_image_url, cropped_s3_key = upload_to_s3(cropped_path)
+            # 画像をS3 にアップロード（全体の PNG は公開URL用、縮小画像はモデル用）
+            with tracing.span("upload_screenshots", timings, url=url):
+                image_url, s3_key = upload_to_s3(screenshot_path)
+                cropped_image_url, cropped_s3_key = upload_to_s3(cropped_path)
+                for model_path in model_paths:
+                    _, model_s3_key = upload_to_s3(model_path, screenshot_processing.mime_type_for(model_path))
+                    if model_s3_key is None:
+                        model_s3_keys = []
+                        break
+                    model_s3_keys.append(model_s3_key)
             print(f"{url}のs3アップロードが完了しました")
-        else:
+        except Exception as e:
+            print(f"{url}のスクショの処理・s3アップロードに失敗しました: {e}")
             image_url         = "can't_get_image"
             cropped_image_url = "can't_get_image"
-            s3_key = None
-    except Exception as e:
-        print(f"{url}のs3アップロードに失敗しました: {e}")
-        image_url         = "can't_get_image"
-        cropped_image_url = "can't_get_image"
 
-    result = {
+    return {
         "url": url,
         "screenshot_url": image_url,
         "cropped_screenshot_url": cropped_image_url,
         "html": html,
+        "blocks": blocks,
         "screenshot_s3_key": s3_key,
+        # Gemini にはこちらの縮小画像を渡す（タイルに分けた場合は上から順）
+        "model_screenshot_s3_keys": model_s3_keys,
+        "model_screenshot_mime_type": screenshot_stats["model_mime_type"] if screenshot_stats else None,
+        "screenshot_stats": screenshot_stats,
+        # メインドキュメントの ETag / Last-Modified（呼び出し元のURLキャッシュの再検証に使う）
+        **page_load.validators_for(url),
+        # ステップごとの所要秒数
+        "timings": timings or {},
     }
 
+# /tmp 以下にファイルパスを準備
+def _tmp_paths():
+    unique_id = uuid.uuid4().hex[:5]
+    return f"/tmp/screenshot_{unique_id}.png", f"/tmp/cropped_{unique_id}.png"
+
+def handle_single_url(url, model_image_options, capture_options):
+    screenshot_path, cropped_path = _tmp_paths()
+    timings = {}
+
+    # selemiumで解析
+    exit_picture, html = analysis_url_with_selenium(url, screenshot_path, capture_options=capture_options,
+                                                    timings=timings)
+
+    # HTML 取得が失敗した場合のみ、一度だけリトライ（ブラウザは健全性チェックの上で使い回す）
+    if html == "can't_get_html":
+        print(f"{url}のhtml取得が失敗したため、リトライします")
+        exit_picture, html = analysis_url_with_selenium(url, screenshot_path, capture_options=capture_options,
+                                                        timings=timings)
+
+    return build_result(url, exit_picture, html, screenshot_path, cropped_path, model_image_options, timings)
+
+def handle_multiple_urls(urls, concurrency, model_image_options, capture_options):
+    """
+    1つのブラウザで複数URLを処理する。戻り値は単一URLモードと同じ形の結果のリスト（入力順）。
+    同じURLが複数含まれていても、入力の1件ごとに結果を返す。
+    """
+    paths = [_tmp_paths() for _ in urls]
+    jobs = [(url, path[0]) for url, path in zip(urls, paths)]
+
+    # ページ数上限ごとに区切り、区切りごとに driver_manager の健全性チェック・再起動を挟む
+    outcomes = []
+    timings = {}
+    chunk_size = max(1, driver_manager.max_pages)
+    for i in range(0, len(jobs), chunk_size):
+        chunk_timings = {}
+        outcomes.extend(analysis_urls_in_tabs(jobs[i:i + chunk_size], concurrency, capture_options, chunk_timings))
+        timings.update({i + index: value for index, value in chunk_timings.items()})
+
+    results = []
+    for index, url in enumerate(urls):
+        exit_picture, html = outcomes[index]
+        screenshot_path, cropped_path = paths[index]
+        # HTML 取得が失敗したURLだけ、単独で一度リトライ
+        if html == "can't_get_html":
+            print(f"{url}のhtml取得が失敗したため、リトライします")
+            exit_picture, html = analysis_url_with_selenium(url, screenshot_path, capture_options=capture_options,
+                                                            timings=timings.setdefault(index, {}))
+        results.append(build_result(url, exit_picture, html, screenshot_path, cropped_path, model_image_options,
+                                    timings.get(index)))
+    return results
+
+@tracing.traced("handler", entry_point=True)
+def handler(event, context):
+    # ウォームコンテナでは稼働中のChromeを残し、前回のスクショなど古いファイルだけを削除する
+    driver_manager.cleanup_tmp()
+    page_load.reset_validators()
+
+    # urls が渡された場合は複数URLモード。結果は url ごとの辞書のリストで返す
+    urls = event.get("urls")
+    model_image_options = screenshot_processing.model_image_options(event)
+    capture_options = capture_options_from(event)
+    if urls:
+        concurrency = int(event.get("concurrency", BATCH_TAB_CONCURRENCY))
+        result = handle_multiple_urls(urls, concurrency, model_image_options, capture_options)
+    else:
+        result = handle_single_url(event.get("url"), model_image_options, capture_options)
+
+    # 大きな HTML・ブロックは圧縮して S3 に置き、参照だけを返す（同期呼び出しのレスポンス上限 6MB 対策）
+    inline_max_bytes = event.get("artifact_inline_max_bytes")
+    for page in (result if urls else [result]):
+        # 呼び出し元のキャッシュで、前回取得した内容と同じかを判定できるようにハッシュを付ける
+        content = page["html"] if page["blocks"] is None else json.dumps(page["blocks"], ensure_ascii=False)
+        if content and content != "can't_get_html":
+            data = content.encode("utf-8")
+            page["content_sha256"] = hashlib.sha256(data).hexdigest()
+            page["content_bytes"] = len(data)
+        if page["html"] != "can't_get_html":
+            page["html"] = artifact_store.pack(page["html"], "html", inline_max_bytes)
+        page["blocks"] = artifact_store.pack(page["blocks"], "blocks", inline_max_bytes)
+        page["timings"]["cold_start"] = tracing.is_cold()
+
     return {
         "statusCode": 200,
         "body": json.dumps(result, ensure_ascii=False)
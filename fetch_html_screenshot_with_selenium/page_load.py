@@ -0,0 +1,170 @@
+import os
+import json
+import time
+
+# 本文・スクショに影響しない広告・計測・トラッキングのURL（Network.setBlockedURLs のワイルドカード形式）
+AD_TRACKER_PATTERNS = (
+    "*doubleclick.net*",
+    "*googlesyndication.com*",
+    "*googleadservices.com*",
+    "*googletagservices.com*",
+    "*googletagmanager.com*",
+    "*google-analytics.com*",
+    "*adservice.google.*",
+    "*amazon-adsystem.com*",
+    "*connect.facebook.net*",
+    "*analytics.twitter.com*",
+    "*static.ads-twitter.com*",
+    "*adnxs.com*",
+    "*criteo.com*",
+    "*criteo.net*",
+    "*rubiconproject.com*",
+    "*pubmatic.com*",
+    "*taboola.com*",
+    "*outbrain.com*",
+    "*scorecardresearch.com*",
+    "*moatads.com*",
+    "*hotjar.com*",
+    "*clarity.ms*",
+    "*nr-data.net*",
+    "*yads.c.yimg.jp*",
+    "*yads.yahoo.co.jp*",
+    "*microad.jp*",
+    "*i-mobile.co.jp*",
+    "*ad-stir.com*",
+    "*adingo.jp*",
+    "*logly.co.jp*",
+    "*popin.cc*",
+    "*ptengine.jp*",
+)
+
+# リソースの種類ごとのURLパターン。setBlockedURLs は種類で指定できないため拡張子で判定する
+RESOURCE_TYPE_PATTERNS = {
+    "font": ("*.woff", "*.woff2", "*.woff?*", "*.woff2?*", "*.ttf", "*.otf", "*.eot"),
+    "media": ("*.mp4", "*.mp4?*", "*.webm", "*.m3u8", "*.m3u8?*", "*.mp3", "*.ogg", "*.mov", "*.m4s"),
+    "image": ("*.gif", "*.png", "*.jpg", "*.jpeg", "*.webp", "*.avif", "*.svg"),
+}
+
+# デフォルトで遮断するもの。画像はスクショ・画像説明に必要なので遮断しない
+BLOCK_ADS = os.environ.get("BLOCK_ADS", "true").lower() == "true"
+BLOCK_RESOURCE_TYPES = tuple(t for t in os.environ.get("BLOCK_RESOURCE_TYPES", "font,media").split(",") if t)
+# 追加で遮断するURLパターン（カンマ区切り）
+BLOCK_URL_PATTERNS = tuple(p for p in os.environ.get("BLOCK_URL_PATTERNS", "").split(",") if p)
+
+# 読み込み完了とみなすまでの、通信・DOM 変更が無い時間（秒）と待ち時間の上限（秒）
+READY_QUIET_SECONDS = float(os.environ.get("PAGE_READY_QUIET_SECONDS", "0.5"))
+READY_MAX_WAIT_SECONDS = float(os.environ.get("PAGE_READY_MAX_WAIT_SECONDS", "10"))
+READY_POLL_SECONDS = 0.1
+
+
+def blocked_url_patterns(event):
+    """
+    event の block_resources（例: {"ads": true, "types": ["font"], "patterns": ["*example.com/widget*"]}）で
+    遮断するURLパターンを決める。false を渡すと何も遮断しない。
+    """
+    options = event.get("block_resources", {})
+    if options is False:
+        return []
+    options = options or {}
+    patterns = []
+    if options.get("ads", BLOCK_ADS):
+        patterns.extend(AD_TRACKER_PATTERNS)
+    for resource_type in options.get("types", BLOCK_RESOURCE_TYPES):
+        patterns.extend(RESOURCE_TYPE_PATTERNS.get(resource_type, ()))
+    patterns.extend(options.get("patterns", BLOCK_URL_PATTERNS))
+    return patterns
+
+
+def apply_blocking(chrome, patterns):
+    """
+    現在のタブに遮断するURLを設定する。タブごとに設定が必要なので、ナビゲーションの前に呼ぶ。
+    """
+    chrome.execute_cdp_cmd("Network.enable", {})
+    chrome.execute_cdp_cmd("Network.setBlockedURLs", {"urls": list(patterns)})
+
+
+# 通信数（Resource Timing）と DOM の変更回数を返す。初回に MutationObserver を仕掛ける
+_PROBE_SCRIPT = """
+  if (location.href === 'about:blank') { return null; }
+  if (window.__captureMutations === undefined) {
+    window.__captureMutations = 0;
+    performance.setResourceTimingBufferSize(10000);
+    new MutationObserver(records => { window.__captureMutations += records.length; })
+      .observe(document, {childList: true, subtree: true, characterData: true});
+  }
+  return [document.readyState, !!document.body,
+          performance.getEntriesByType('resource').length, window.__captureMutations];
+"""
+
+
+def wait_until_ready(chrome, quiet_seconds=READY_QUIET_SECONDS, max_wait=READY_MAX_WAIT_SECONDS):
+    """
+    body があり、新しい通信と DOM の変更が quiet_seconds の間なければ読み込み完了とみなす。
+    max_wait を超えたら、その時点の状態で先に進む（body が無ければ TimeoutError）。
+    戻り値: { "reason": "quiet" / "timeout", "waited": 秒 }
+    """
+    start = time.monotonic()
+    last_state = None
+    changed_at = start
+    while True:
+        now = time.monotonic()
+        probe = chrome.execute_script(_PROBE_SCRIPT)
+        if probe is not None:
+            ready_state, has_body, resources, mutations = probe
+            state = (resources, mutations)
+            if state != last_state:
+                last_state, changed_at = state, now
+            elif has_body and ready_state != 'loading' and now - changed_at >= quiet_seconds:
+                return {"reason": "quiet", "waited": round(now - start, 2)}
+        if now - start >= max_wait:
+            if probe is None or not probe[1]:
+                raise TimeoutError(f"{max_wait}秒以内に body が表示されませんでした")
+            return {"reason": "timeout", "waited": round(now - start, 2)}
+        time.sleep(READY_POLL_SECONDS)
+
+
+# パフォーマンスログから集めたドキュメントの応答ヘッダ（応答の URL → 検証用ヘッダ）と、
+# 要求された URL ごとの検証用ヘッダ。ハンドラーの呼び出しごとに reset_validators で空にする
+_document_validators = {}
+_page_validators = {}
+EMPTY_VALIDATORS = {"etag": None, "last_modified": None}
+
+
+def reset_validators():
+    _document_validators.clear()
+    _page_validators.clear()
+
+
+def _collect_document_validators(chrome):
+    """
+    パフォーマンスログの Network.responseReceived から、ドキュメント（HTML）の応答の ETag / Last-Modified を集める。
+    ログは読むと消えるので、タブを並行して開いている場合に備えて全タブの分を溜めておく。
+    """
+    for entry in chrome.get_log("performance"):
+        message = json.loads(entry["message"])["message"]
+        if message.get("method") != "Network.responseReceived" or message["params"].get("type") != "Document":
+            continue
+        response = message["params"]["response"]
+        headers = {name.lower(): value for name, value in (response.get("headers") or {}).items()}
+        _document_validators[response["url"]] = {
+            "etag": headers.get("etag"),
+            "last_modified": headers.get("last-modified"),
+        }
+
+
+def record_validators(chrome, url):
+    """
+    現在のタブで表示しているドキュメントの ETag / Last-Modified を、要求された url に対して記録する。
+    呼び出し元のURLキャッシュが、次回に条件付きリクエストで再検証するのに使う（HEAD を送らずに済む）。
+    """
+    try:
+        _collect_document_validators(chrome)
+        # リダイレクト後の URL の応答を使う。応答の URL にはフラグメントが付かない
+        current_url = chrome.current_url.split("#", 1)[0]
+        _page_validators[url] = _document_validators.get(current_url, EMPTY_VALIDATORS)
+    except Exception as e:
+        print(f"{url}の ETag / Last-Modified を取得できませんでした: {e}")
+
+
+def validators_for(url):
+    return dict(_page_validators.get(url, EMPTY_VALIDATORS))
@@ -0,0 +1,92 @@
+import os
+import time
+from PIL import Image
+
+# 公開用のトリミング画像の高さ（ページ上部）
+CROP_HEIGHT = 900
+# モデルに渡す画像の形式: jpeg / webp
+MODEL_IMAGE_FORMAT = os.environ.get("SCREENSHOT_MODEL_FORMAT", "jpeg").lower()
+# モデルに渡す画像の幅。これより広いスクショは縦横比を保って縮小する
+MODEL_IMAGE_WIDTH = int(os.environ.get("SCREENSHOT_MODEL_WIDTH", "768"))
+MODEL_IMAGE_QUALITY = int(os.environ.get("SCREENSHOT_MODEL_QUALITY", "80"))
+# 縮小後の高さの上限。これを超える部分（長い記事の下の方）はモデルには渡さない
+MODEL_MAX_HEIGHT = int(os.environ.get("SCREENSHOT_MODEL_MAX_HEIGHT", "8000"))
+# 0 より大きいと、縮小後の画像をこの高さごとのタイルに分ける
+MODEL_TILE_HEIGHT = int(os.environ.get("SCREENSHOT_MODEL_TILE_HEIGHT", "0"))
+
+FORMATS = {
+    "jpeg": ("JPEG", ".jpg", "image/jpeg"),
+    "webp": ("WEBP", ".webp", "image/webp"),
+}
+
+
+def mime_type_for(path):
+    for _, extension, mime_type in FORMATS.values():
+        if path.endswith(extension):
+            return mime_type
+    return "image/png"
+
+
+def model_image_options(event):
+    """
+    event の model_image（例: {"format": "webp", "tile_height": 2048}）で環境変数のデフォルトを上書きする。
+    """
+    options = event.get("model_image") or {}
+    image_format = str(options.get("format", MODEL_IMAGE_FORMAT)).lower()
+    return {
+        "format": image_format if image_format in FORMATS else "jpeg",
+        "width": int(options.get("width", MODEL_IMAGE_WIDTH)),
+        "quality": int(options.get("quality", MODEL_IMAGE_QUALITY)),
+        "max_height": int(options.get("max_height", MODEL_MAX_HEIGHT)),
+        "tile_height": int(options.get("tile_height", MODEL_TILE_HEIGHT)),
+    }
+
+
+def process_screenshot(screenshot_path, cropped_path, model_path_prefix, options):
+    """
+    全体スクショ（PNG）を1回だけデコードし、
+    - 公開用のトリミング画像（上部 CROP_HEIGHT px の PNG）
+    - モデル用の縮小画像（JPEG/WebP、tile_height があればタイルに分割）
+    を作る。全体の PNG は公開URL用にそのまま残す。
+    戻り値: (モデル用画像のパスのリスト, 処理の記録)
+    """
+    image_format, extension, mime_type = FORMATS[options["format"]]
+    start = time.perf_counter()
+    with Image.open(screenshot_path) as image:
+        image.load()
+        decoded = time.perf_counter()
+        width, height = image.size
+
+        image.crop((0, 0, width, CROP_HEIGHT)).save(cropped_path)
+
+        model_image = image.convert("RGB")
+        if width > options["width"]:
+            model_height = max(1, round(height * options["width"] / width))
+            # reducing_gap で先に整数倍の縮小をしてから LANCZOS をかける（長いページでも速い）
+            model_image = model_image.resize((options["width"], model_height), Image.LANCZOS, reducing_gap=3.0)
+        if model_image.height > options["max_height"]:
+            model_image = model_image.crop((0, 0, model_image.width, options["max_height"]))
+
+        tile_height = options["tile_height"] if options["tile_height"] > 0 else model_image.height
+        paths = []
+        for top in range(0, model_image.height, tile_height):
+            tile = model_image.crop((0, top, model_image.width, min(top + tile_height, model_image.height)))
+            path = f"{model_path_prefix}_{len(paths)}{extension}"
+            tile.save(path, image_format, quality=options["quality"])
+            paths.append(path)
+    encoded = time.perf_counter()
+
+    original_bytes = os.path.getsize(screenshot_path)
+    model_bytes = sum(os.path.getsize(path) for path in paths)
+    stats = {
+        "original_size": [width, height],
+        "model_size": [model_image.width, model_image.height],
+        "model_mime_type": mime_type,
+        "tiles": len(paths),
+        "original_bytes": original_bytes,
+        "model_bytes": model_bytes,
+        "bytes_saved": original_bytes - model_bytes,
+        "decode_ms": round((decoded - start) * 1000, 1),
+        "encode_ms": round((encoded - decoded) * 1000, 1),
+    }
+    return paths, stats
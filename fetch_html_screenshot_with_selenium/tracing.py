@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import threading
+import functools
+from contextlib import contextmanager
+
+# false にするとスパンのログを出さない（計測と timings への記録は行う）
+TRACE_LOG_ENABLED = os.environ.get("TRACE_LOG_ENABLED", "true").lower() == "true"
+# ログに付ける関数名。Lambda では関数名が自動で入る
+SERVICE_NAME = os.environ.get("TRACE_SERVICE_NAME") or os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "local")
+
+_lock = threading.Lock()
+# このコンテナで最初の呼び出しか（コールドスタート）
+_invocations = 0
+_cold = True
+_counters = {}
+
+
+def begin_invocation():
+    """
+    ハンドラーの先頭で呼ぶ。このコンテナで最初の呼び出しならコールドスタートとして記録する。
+    戻り値: コールドスタートなら True
+    """
+    global _invocations, _cold
+    with _lock:
+        _invocations += 1
+        _cold = _invocations == 1
+        _counters.clear()
+        return _cold
+
+
+def is_cold():
+    return _cold
+
+
+class Span:
+    """span() の with ブロック内で、処理したバイト数や属性を追加する。"""
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.bytes = None
+
+    def add_bytes(self, n):
+        if n:
+            self.bytes = (self.bytes or 0) + n
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+@contextmanager
+def span(name, timings=None, **attrs):
+    """
+    with ブロックの所要時間を計測し、1行の JSON としてログに出す。
+    timings（dict）を渡すと、秒数を timings[name] にも記録する（URLごとの内訳の組み立て用）。
+    ブロック内で例外が起きた場合は error を付けて記録し、例外はそのまま送出する。
+    """
+    current = Span(name, dict(attrs))
+    start = time.perf_counter()
+    error = None
+    try:
+        yield current
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        if timings is not None:
+            timings[name] = round(seconds, 3)
+        count(f"{name}.calls")
+        count(f"{name}.seconds", seconds)
+        if current.bytes is not None:
+            count(f"{name}.bytes", current.bytes)
+        if TRACE_LOG_ENABLED:
+            record = {
+                "type": "span",
+                "service": SERVICE_NAME,
+                "name": name,
+                "duration_ms": round(seconds * 1000, 1),
+                "bytes": current.bytes,
+                "cold": _cold,
+                **current.attrs,
+            }
+            if error is not None:
+                record["error"] = error
+            print(json.dumps(record, ensure_ascii=False, default=str))
+
+
+def traced(name, entry_point=False):
+    """
+    関数全体を1つのスパンとして記録するデコレーター。
+    entry_point=True（Lambda のハンドラー）なら、呼び出しの始めに begin_invocation() を、
+    終わりに flush() を呼ぶ。
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if entry_point:
+                begin_invocation()
+            try:
+                with span(name):
+                    return func(*args, **kwargs)
+            finally:
+                if entry_point:
+                    flush()
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    # 呼び出し内で合計し、flush() でまとめてログに出すカウンター
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def counters():
+    with _lock:
+        return {name: round(value, 3) if isinstance(value, float) else value for name, value in _counters.items()}
+
+
+def flush():
+    """ハンドラーの最後に呼ぶ。この呼び出しのカウンターを1行の JSON としてログに出し、値を返す。"""
+    values = counters()
+    if TRACE_LOG_ENABLED:
+        print(json.dumps({"type": "counters", "service": SERVICE_NAME, "cold": _cold, "counters": values},
+                         ensure_ascii=False))
+    return values
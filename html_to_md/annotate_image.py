@@ -1,9 +1,14 @@
 import os
 import json
-import requests
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
-OPENAI_API_URL = "https://api.openai.com/v1/chat/completions"
+import image_cache
+import image_filter
+import llm_client
+import tracing
+
+# ベンチマークなどでスタブサーバに向ける場合に変える
+OPENAI_API_URL = os.getenv("OPENAI_API_URL", "https://api.openai.com/v1/chat/completions")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
 HEADERS = {
@@ -11,6 +16,18 @@ HEADERS = {
     "Authorization": f"Bearer {OPENAI_API_KEY}"
 }
 
+# 1リクエストにまとめる画像の枚数。1にすると従来通り1枚ずつ送る
+IMAGE_BATCH_SIZE = int(os.getenv("IMAGE_BATCH_SIZE", "4"))
+# 説明文の生成を同時に実行するスレッド数
+DESCRIBE_MAX_WORKERS = 50
+
+# OpenAI API 用の接続プール。スレッド数と同じ数の接続をウォームコンテナ間で使い回す
+# 429 を受けると同時実行数を絞り、Retry-After の間は新しいリクエストを止める
+openai_client = llm_client.LLMClient(pool_size=DESCRIBE_MAX_WORKERS, provider="openai")
+
+# 関数外で生成することでウォームコンテナ間でキャッシュを共有する
+description_cache = image_cache.create_cache()
+
 
 def extract_image_urls(data):
     """
@@ -26,7 +43,7 @@ def extract_image_urls(data):
 
 def describe_image_with_gpt4o(image_url ,prompt):
     """
-    OpenAI GPT-4o に requests だけでマルチモーダル入力を送り、
+    OpenAI GPT-4o に共有の接続プール経由でマルチモーダル入力を送り、
     画像の説明文を取得する。
     """
     payload = {
@@ -42,23 +59,84 @@ def describe_image_with_gpt4o(image_url ,prompt):
         ],
         "max_tokens": 300
     }
-    resp = requests.post(OPENAI_API_URL, headers=HEADERS, json=payload, timeout=30)
-    if not resp.ok:
-        raise RuntimeError(f"HTTP {resp.status_code}: {resp.text}")
+    resp = openai_client.call(OPENAI_API_URL, payload, headers=HEADERS, timeout=(llm_client.CONNECT_TIMEOUT, 30))
     data = resp.json()
     print(data)
     return data["choices"][0]["message"]["content"]
 
-def annotate_blocks_with_descriptions(blocks, descriptions):
+def describe_images_batch(image_urls, prompt):
+    """
+    複数の画像を1つのマルチモーダルメッセージにまとめて送り、画像ごとの説明文を JSON で受け取る。
+    戻り値: { url: 説明文, ... } 回答が欠けた画像は含まれない。JSON として読めなければ例外。
+    """
+    instruction = (
+        f"{prompt}\n"
+        f"以下に画像が{len(image_urls)}枚あります。それぞれの画像について個別に説明し、"
+        '次の JSON 形式だけで回答してください: '
+        '{"descriptions": [{"index": 画像番号, "description": "説明文"}, ...]}'
+    )
+    content = [{"type": "text", "text": instruction}]
+    for i, image_url in enumerate(image_urls, start=1):
+        content.append({"type": "text", "text": f"画像{i}"})
+        content.append({"type": "image_url", "image_url": {"url": image_url}})
+
+    payload = {
+        "model": "gpt-4.1-nano",
+        "messages": [{"role": "user", "content": content}],
+        "response_format": {"type": "json_object"},
+        "max_tokens": 300 * len(image_urls)
+    }
+    resp = openai_client.call(OPENAI_API_URL, payload, headers=HEADERS, timeout=(llm_client.CONNECT_TIMEOUT, 60))
+    answer = json.loads(resp.json()["choices"][0]["message"]["content"])
+
+    results = {}
+    for entry in answer.get("descriptions", []):
+        index = entry.get("index")
+        description = entry.get("description")
+        if isinstance(index, int) and 1 <= index <= len(image_urls) and isinstance(description, str) and description:
+            results[image_urls[index - 1]] = description
+    return results
+
+def describe_images(infos, prompt):
+    """
+    infos: 事前フィルタ済みの ImageInfo のリスト
+    2枚以上ならまとめて1リクエストで説明文を生成し、回答を読み取れなかった画像だけ1枚ずつ再実行する。
+    生成できた説明文はキャッシュに保存する。戻り値: { url: 説明文, ... }
+    """
+    urls = [info.url for info in infos]
+    results = {}
+    if len(urls) > 1:
+        try:
+            results = describe_images_batch(urls, prompt)
+        except Exception as e:
+            print(f"画像{len(urls)}枚の一括説明に失敗したため1枚ずつ実行します: {e}")
+        if len(results) < len(urls):
+            print(f"一括説明で回答が得られなかった{len(urls) - len(results)}枚を1枚ずつ実行します")
+
+    for info in infos:
+        if info.url in results:
+            description_cache.put(info.url, info.digest, results[info.url])
+            continue
+        try:
+            results[info.url] = describe_image_with_gpt4o(info.url, prompt)
+            description_cache.put(info.url, info.digest, results[info.url])
+        except Exception as e:
+            results[info.url] = f"Error: {e}"
+    return results
+
+def annotate_blocks_with_descriptions(blocks, descriptions, aliases=None):
     """
     blocks: [{'type': ..., 'src': ..., 'alt': ...}, ...]
     descriptions: {'https://.../img1.jpg': '画像説明文', ...}
+    aliases: {'https://.../img1_small.jpg': 'https://.../img1.jpg', ...} 同じ画像とみなしたURLの対応
     戻り値: descriptions を alt に追記した blocks（元のオブジェクトをそのまま更新）
     inplace
     """
+    aliases = aliases or {}
     for item in blocks:
         if item.get("type") == "image":
             src = item.get("src")
+            src = aliases.get(src, src)
             if src in descriptions:
                 orig_alt = item.get("alt", "")
                 desc = descriptions[src]
@@ -66,31 +144,59 @@ def annotate_blocks_with_descriptions(blocks, descriptions):
                 item["alt"] = f"{orig_alt} {desc}".strip()
     return blocks
 
-def generate_image_descriptions(json_data):
+def generate_image_descriptions(json_data, batch_size=IMAGE_BATCH_SIZE):
     """
     data: JSON リスト
     prompt: 画像に対して投げるプロンプト
     max_workers: 同時並列呼び出し数
+    batch_size: 1リクエストにまとめる画像の枚数
     戻り値: { url: 説明文, ... }
     """
     urls = extract_image_urls(json_data)
     descriptions = {}
     prompt = "この画像の内容を日本語で説明してください。"
 
-    # ThreadPoolExecutor で並列実行
-    with ThreadPoolExecutor(max_workers=50) as executor:
-        # future to url のマッピング
-        future_to_url = {
-            executor.submit(describe_image_with_gpt4o, url, prompt): url
-            for url in urls
+    # URL でキャッシュに当たったものは画像を取得せずに済ませる
+    for url in urls:
+        description = description_cache.get_by_url(url)
+        if description is not None:
+            descriptions[url] = description
+
+    # 残りは画像を1度だけ取得し、極小画像を除外・同じ画像をまとめる
+    remaining = [url for url in urls if url not in descriptions]
+    tracing.count("images.total", len(urls))
+    tracing.count("images.cache_hits_by_url", len(urls) - len(remaining))
+    with tracing.span("prefilter_images", images=len(remaining)):
+        representatives, aliases, dropped = image_filter.prefilter_images(remaining)
+
+    # 別URLの同じ画像として説明済みのものは画像ハッシュでキャッシュから引く
+    pending = []
+    for info in representatives:
+        description = description_cache.get_by_hash(info.digest, info.url)
+        if description is not None:
+            descriptions[info.url] = description
+        else:
+            pending.append(info)
+
+    # IMAGE_BATCH_SIZE 枚ずつまとめ、ThreadPoolExecutor で並列実行
+    batch_size = max(1, batch_size)
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    tracing.count("images.described", len(pending))
+    with tracing.span("describe_images", images=len(pending), batches=len(batches)), \
+            ThreadPoolExecutor(max_workers=DESCRIBE_MAX_WORKERS) as executor:
+        # future to batch のマッピング
+        future_to_batch = {
+            executor.submit(describe_images, batch, prompt): batch
+            for batch in batches
         }
-        for future in as_completed(future_to_url):
-            url = future_to_url[future]
+        for future in as_completed(future_to_batch):
             try:
-                descriptions[url] = future.result()
+                descriptions.update(future.result())
             except Exception as e:
-                descriptions[url] = f"Error: {e}"
+                for info in future_to_batch[future]:
+                    descriptions[info.url] = f"Error: {e}"
 
-    annotated_blocks = annotate_blocks_with_descriptions(json_data, descriptions)
+    # 代表画像の説明文を、まとめた画像にも付ける
+    annotated_blocks = annotate_blocks_with_descriptions(json_data, descriptions, aliases)
 
     return annotated_blocks
\ No newline at end of file
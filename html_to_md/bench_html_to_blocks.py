@@ -0,0 +1,283 @@
+"""
+html_to_blocks をパーサ・実装ごとに計測し、出力が一致するかを確認するスクリプト。
+保存しておいた HTML（*.html）のディレクトリを入力にする。<名前>.url があればその中身を base_url に使う。
+パース時間と走査時間を分けて計測し、以前の再帰版（legacy）との差も表示する。
+
+使い方:
+  python bench_html_to_blocks.py pages/                          # 各パーサ・実装の処理時間・ピークメモリと、legacy/html.parser との一致を表示
+  python bench_html_to_blocks.py pages/ --write-golden golden/   # 正解データ（ブロックのJSON）を保存
+  python bench_html_to_blocks.py pages/ --golden golden/         # 正解データと比較。不一致があれば終了コード1
+  python bench_html_to_blocks.py tests/corpus/pages --golden tests/corpus/golden  # リポジトリ内のコーパスで確認
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import tracemalloc
+from urllib.parse import urljoin
+from bs4 import BeautifulSoup, NavigableString, Comment
+
+import main
+
+IMPLEMENTATIONS = ('legacy', 'current')
+
+
+def legacy_html_to_blocks(soup, base_url):
+    """
+    比較用: 以前の再帰版の走査（コメント・不要タグの除去パス + get_text の繰り返し）。
+    """
+    # コメント除去
+    for c in soup.find_all(string=lambda t: isinstance(t, Comment)):
+        c.extract()
+    # 不要タグ除去
+    for bad in soup(['script', 'style', 'noscript', 'iframe', 'svg']):
+        bad.decompose()
+
+    blocks = []
+
+    def walk(node):
+        # --- 見出し h1-h6 ---
+        if node.name and node.name.startswith('h') and len(node.name) == 2 and node.name[1].isdigit():
+            level = int(node.name[1])
+            text = node.get_text(strip=True)
+            if text:
+                blocks.append({'type': 'heading', 'level': level, 'text': text})
+            return
+
+        # --- リスト ul/ol ---
+        if node.name in ('ul', 'ol'):
+            ordered = (node.name == 'ol')
+            for li in node.find_all('li', recursive=False):
+                blocks.append({'type': 'list_item', 'ordered': ordered, 'text': li.get_text(strip=True)})
+            return
+
+        # --- テーブル ---
+        if node.name == 'table':
+            rows = []
+            for section in node.find_all(['thead','tbody'], recursive=False):
+                for tr in section.find_all('tr', recursive=False):
+                    cells = [cell.get_text(strip=True) for cell in tr.find_all(['th','td'], recursive=False)]
+                    rows.append(cells)
+            if not rows:
+                for tr in node.find_all('tr'):  # 再帰的に全 tr を拾うフォールバック
+                    cells = [cell.get_text(strip=True) for cell in tr.find_all(['th','td'], recursive=False)]
+                    rows.append(cells)
+            blocks.append({'type': 'table', 'rows': rows})
+            return
+
+        # --- 水平線 hr ---
+        if node.name == 'hr':
+            blocks.append({'type': 'hr'})
+            return
+
+        # --- 引用 blockquote ---
+        if node.name == 'blockquote':
+            text = node.get_text(strip=True)
+            blocks.append({'type': 'blockquote', 'text': text})
+            return
+
+        # --- コードブロック pre ---
+        if node.name == 'pre':
+            code = node.get_text()
+            blocks.append({'type': 'code_block', 'code': code})
+            return
+
+        # --- インラインコード code ---
+        if node.name == 'code' and not node.find_all():
+            blocks.append({'type': 'inline_code', 'text': node.get_text(strip=True)})
+            return
+
+        # --- 強調 / 太字 ---
+        if node.name in ('strong', 'b', 'em', 'i'):
+            text = node.get_text(strip=True)
+            style = 'bold' if node.name in ('strong', 'b') else 'italic'
+            blocks.append({'type': style, 'text': text})
+            return
+
+        # --- リンク a ---
+        if node.name == 'a' and node.get('href'):
+            href = urljoin(base_url, node['href'])
+            # (1) 先に中の画像をすべてブロック化
+            for img in node.find_all('img'):
+                src = urljoin(base_url, img['src'])
+                blocks.append({'type': 'image', 'src': src, 'alt': img.get('alt','')})
+            # (2) リンクテキストをブロック化
+            text = node.get_text(strip=True)
+            if text:
+                blocks.append({'type': 'link', 'href': href, 'text': text})
+            return
+
+
+        # # --- ソース要素 source (srcset用) ---
+        # if node.name == 'source' and node.get('srcset'):
+        #     blocks.append({
+        #         'type': 'image',
+        #         'src': urljoin(base_url, node['srcset']),
+        #         'alt': ''
+        #     })
+        #     return
+
+        # --- 画像 img ---
+        if node.name == 'img' and node.get('src'):
+            src = urljoin(base_url, node['src'])
+            classes = node.get('class', [])
+            # --- sp 版は、同じ親に pc があればスキップ ---
+            if 'sp' in classes:
+                parent = node.parent
+                # 親内に class に 'pc' を含む img がいれば無視
+                if parent.find('img', class_=lambda c: c and 'pc' in c.split()):
+                    return
+            blocks.append({'type': 'image', 'src': src, 'alt': node.get('alt', '')})
+            return
+
+        # --- フォーム要素 ---
+        if node.name == 'input' and node.get('value'):
+            blocks.append({'type': 'text', 'tag': 'input', 'text': node['value']})
+            return
+        if node.name == 'button':
+            blocks.append({'type': 'text', 'tag': 'button', 'text': node.get_text(strip=True)})
+            return
+        if node.name == 'textarea':
+            blocks.append({'type': 'text', 'tag': 'textarea', 'text': node.get_text(strip=True)})
+            return
+
+        # --- メディア要素 video/audio ---
+        if node.name in ('video', 'audio') and node.get('src'):
+            src = urljoin(base_url, node['src'])
+            blocks.append({'type': 'media', 'tag': node.name, 'src': src})
+            return
+
+        # --- テキスト葉 ---
+        if isinstance(node, NavigableString):
+            text = node.strip()
+            if text and node.parent.name not in ('html', 'body', 'head'):
+                blocks.append({'type': 'text', 'tag': node.parent.name, 'text': text})
+            return
+
+        # --- 再帰 ---
+        for child in node.children:
+            walk(child)
+
+    if soup.body:
+        walk(soup.body)
+    return blocks
+
+
+def load_pages(page_dir):
+    pages = []
+    for name in sorted(os.listdir(page_dir)):
+        if not name.endswith(".html"):
+            continue
+        path = os.path.join(page_dir, name)
+        with open(path, encoding="utf-8", errors="replace") as f:
+            html = f.read()
+        base_url = "https://example.com/"
+        url_path = path[:-len(".html")] + ".url"
+        if os.path.exists(url_path):
+            with open(url_path, encoding="utf-8") as f:
+                base_url = f.read().strip()
+        pages.append((name, html, base_url))
+    return pages
+
+
+def parse(html, parser):
+    return BeautifulSoup(main.preprocess_br(html), parser)
+
+
+def walk(soup, base_url, implementation):
+    if implementation == 'legacy':
+        return legacy_html_to_blocks(soup, base_url)
+    return main.walk_blocks(soup.body, base_url) if soup.body else []
+
+
+def normalize(blocks):
+    # JSON を経由させて比較・保存できる形にそろえる
+    return json.loads(json.dumps(main.blocks_to_json(blocks), ensure_ascii=False))
+
+
+def measure(html, base_url, parser, implementation, repeat):
+    parse_times, walk_times = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        soup = parse(html, parser)
+        parsed = time.perf_counter()
+        blocks = walk(soup, base_url, implementation)
+        parse_times.append(parsed - start)
+        walk_times.append(time.perf_counter() - parsed)
+
+    tracemalloc.start()
+    kept = walk(parse(html, parser), base_url, implementation)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return min(parse_times), min(walk_times), peak, blocks
+
+
+def main_cli():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("page_dir")
+    ap.add_argument("--engines", nargs="+", default=list(main.PARSER_ENGINES))
+    ap.add_argument("--implementations", nargs="+", default=list(IMPLEMENTATIONS), choices=IMPLEMENTATIONS)
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--golden", help="正解データのディレクトリ。指定すると各パーサの出力と比較する")
+    ap.add_argument("--write-golden", help="html.parser の出力を正解データとして保存するディレクトリ")
+    args = ap.parse_args()
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))  # legacy の再帰走査用
+
+    pages = load_pages(args.page_dir)
+    if not pages:
+        print(f"{args.page_dir} に .html がありません")
+        return 1
+
+    if args.write_golden:
+        os.makedirs(args.write_golden, exist_ok=True)
+        for name, html, base_url in pages:
+            blocks = normalize(main.html_to_blocks(html, base_url, parser="html.parser"))
+            with open(os.path.join(args.write_golden, name + ".json"), "w", encoding="utf-8") as f:
+                json.dump(blocks, f, ensure_ascii=False, indent=1)
+        print(f"{len(pages)}件の正解データを {args.write_golden} に保存しました")
+        return 0
+
+    reference = {}
+    if args.golden:
+        for name, _, _ in pages:
+            with open(os.path.join(args.golden, name + ".json"), encoding="utf-8") as f:
+                reference[name] = json.load(f)
+    else:
+        for name, html, base_url in pages:
+            reference[name] = normalize(walk(parse(html, "html.parser"), base_url, 'legacy'))
+
+    total_bytes = sum(len(html.encode("utf-8")) for _, html, _ in pages)
+    print(f"{len(pages)}ページ / 合計 {total_bytes / 1024 / 1024:.1f} MB")
+    print(f"{'engine':<12} {'impl':<8} {'parse ms':>10} {'walk ms':>10} {'walk max':>10} "
+          f"{'peak MB':>9} {'json KB':>9} {'mismatch':>9}")
+
+    failed = False
+    for engine in args.engines:
+        for implementation in args.implementations:
+            parse_times, walk_times, peaks, json_sizes, mismatches = [], [], [], [], []
+            for name, html, base_url in pages:
+                parse_time, walk_time, peak, blocks = measure(html, base_url, engine, implementation, args.repeat)
+                parse_times.append(parse_time)
+                walk_times.append(walk_time)
+                peaks.append(peak)
+                blocks = normalize(blocks)
+                json_sizes.append(len(json.dumps(blocks, ensure_ascii=False).encode("utf-8")))
+                if blocks != reference[name]:
+                    mismatches.append(name)
+            print(
+                f"{engine:<12} {implementation:<8} {sum(parse_times) * 1000:>10.1f} {sum(walk_times) * 1000:>10.1f} "
+                f"{max(walk_times) * 1000:>10.1f} {max(peaks) / 1024 / 1024:>9.1f} "
+                f"{statistics.mean(json_sizes) / 1024:>9.1f} {len(mismatches):>9}"
+            )
+            for name in mismatches:
+                print(f"  不一致: {name}")
+            failed = failed or bool(mismatches)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,193 @@
+import re
+from bs4 import NavigableString, Comment, Tag
+
+# 走査しないタグ（main.SKIP_TAGS と同じ）
+SKIP_TAGS = frozenset(('script', 'style', 'noscript', 'iframe', 'svg'))
+# 本文の候補になるコンテナ
+CANDIDATE_TAGS = frozenset(('div', 'article', 'main', 'section', 'td', 'body'))
+# 本文の段落とみなす要素。テキスト量を親・祖父母のスコアに加算する
+PARAGRAPH_TAGS = frozenset(('p', 'pre', 'blockquote', 'li', 'td', 'h2', 'h3', 'h4', 'dd'))
+
+POSITIVE_PATTERN = re.compile(r'article|body|content|entry|main|post|text|blog|story|honbun|kiji', re.I)
+NEGATIVE_PATTERN = re.compile(
+    r'comment|footer|header|nav|menu|sidebar|sponsor|banner|cookie|consent|related|'
+    r'recommend|ranking|share|social|sns|breadcrumb|pager|pagination|widget|popup|modal|'
+    r'(^|[\s_-])ads?([\s_-]|$)', re.I
+)
+NEGATIVE_TAGS = frozenset(('nav', 'footer', 'header', 'aside', 'form'))
+
+# 本文候補の文字数がこれ未満なら抽出せず body 全体を使う
+MIN_CONTENT_CHARS = 200
+# 本文候補が body 全体の文字数のこの割合未満なら抽出せず body 全体を使う
+MIN_CONTENT_RATIO = 0.15
+
+
+def estimate_tokens(ascii_chars, other_chars):
+    # 英数字はおよそ4文字で1トークン、日本語などはおよそ1文字で1トークン
+    return ascii_chars // 4 + other_chars
+
+
+class _Measure:
+    __slots__ = ('chars', 'ascii', 'link_chars', 'commas')
+
+    def __init__(self):
+        self.chars = 0
+        self.ascii = 0
+        self.link_chars = 0
+        self.commas = 0
+
+
+def measure_text(root):
+    """
+    root 配下の全要素について、テキスト量・リンク内テキスト量を1回の走査で求める。
+    戻り値: { id(要素): _Measure }
+    """
+    measures = {}
+    # (node, リンク内か, 抜けるときか)
+    stack = [(root, False, False)]
+    path = []
+    while stack:
+        node, in_link, exiting = stack.pop()
+        if exiting:
+            done = path.pop()
+            if path:
+                parent = path[-1]
+                parent.chars += done.chars
+                parent.ascii += done.ascii
+                parent.link_chars += done.link_chars
+                parent.commas += done.commas
+            continue
+        if isinstance(node, NavigableString):
+            if isinstance(node, Comment) or not path:
+                continue
+            text = node.strip()
+            if text:
+                m = path[-1]
+                m.chars += len(text)
+                m.ascii += len(text.encode('ascii', 'ignore'))
+                m.commas += text.count(',') + text.count('、')
+                if in_link:
+                    m.link_chars += len(text)
+            continue
+        if node.name in SKIP_TAGS:
+            continue
+        m = _Measure()
+        measures[id(node)] = m
+        path.append(m)
+        stack.append((node, in_link, True))
+        child_in_link = in_link or node.name == 'a'
+        stack.extend((child, child_in_link, False) for child in reversed(node.contents))
+    return measures
+
+
+def _class_weight(node):
+    if node.name in NEGATIVE_TAGS:
+        return -50
+    weight = 0
+    if node.name in ('article', 'main'):
+        weight += 30
+    for value in (' '.join(node.get('class', [])), node.get('id', ''), node.get('role', '')):
+        if not value:
+            continue
+        if NEGATIVE_PATTERN.search(value):
+            weight -= 25
+        if POSITIVE_PATTERN.search(value):
+            weight += 25
+    return weight
+
+
+def find_main_content(body, measures):
+    """
+    テキスト密度とリンク密度で DOM の領域をスコアリングし、本文のコンテナを返す。
+    段落のテキスト量を親（全量）と祖父母（半分）に加算し、リンク密度の高い領域（メニュー・関連記事一覧）は減点する。
+    """
+    scores = {}
+    nodes = {}
+    for node in body.find_all(list(PARAGRAPH_TAGS)):
+        m = measures.get(id(node))
+        if m is None or m.chars < 25:
+            continue
+        score = 1 + m.commas + min(m.chars // 100, 3)
+        parent = node.parent
+        for share in (1.0, 0.5):
+            if parent is None or not isinstance(parent, Tag):
+                break
+            if parent.name in CANDIDATE_TAGS and id(parent) in measures:
+                key = id(parent)
+                if key not in scores:
+                    nodes[key] = parent
+                    scores[key] = _class_weight(parent)
+                scores[key] += score * share
+            parent = parent.parent
+
+    best, best_score = None, 0
+    for key, score in scores.items():
+        m = measures[key]
+        link_density = m.link_chars / m.chars if m.chars else 1
+        score *= (1 - link_density)
+        if score > best_score:
+            best, best_score = nodes[key], score
+    return best
+
+
+def extract_metadata(soup):
+    """
+    <head> からタイトル・説明文・公開日時などを取り出す。
+    """
+    metadata = {}
+    if soup.title and soup.title.string:
+        metadata['title'] = soup.title.string.strip()
+    names = {
+        'description': 'description',
+        'og:title': 'title',
+        'og:description': 'description',
+        'og:site_name': 'site_name',
+        'author': 'author',
+        'article:author': 'author',
+        'article:published_time': 'published_time',
+        'article:modified_time': 'modified_time',
+    }
+    for meta in soup.find_all('meta'):
+        key = names.get((meta.get('property') or meta.get('name') or '').lower())
+        content = (meta.get('content') or '').strip()
+        if key and content and key not in metadata:
+            metadata[key] = content
+    canonical = soup.find('link', rel='canonical')
+    if canonical and canonical.get('href'):
+        metadata['canonical_url'] = canonical['href']
+    return metadata
+
+
+def extract_main_content(soup):
+    """
+    本文のコンテナを選び、削減量を返す。本文らしい領域が見つからなければ body をそのまま返す。
+    戻り値: (root, stats)
+    """
+    body = soup.body
+    measures = measure_text(body)
+    total = measures[id(body)]
+    root = find_main_content(body, measures) or body
+    kept = measures[id(root)]
+    if root is not body and (kept.chars < MIN_CONTENT_CHARS or kept.chars < total.chars * MIN_CONTENT_RATIO):
+        root, kept = body, total
+
+    removed_ascii = total.ascii - kept.ascii
+    removed_other = (total.chars - total.ascii) - (kept.chars - kept.ascii)
+    stats = {
+        'root': _describe(root),
+        'original_chars': total.chars,
+        'extracted_chars': kept.chars,
+        'removed_chars': total.chars - kept.chars,
+        'removed_tokens_estimate': estimate_tokens(removed_ascii, removed_other),
+    }
+    return root, stats
+
+
+def _describe(node):
+    # ログ用に選ばれた要素を tag#id.class の形で表す
+    label = node.name
+    if node.get('id'):
+        label += '#' + node['id']
+    if node.get('class'):
+        label += '.' + '.'.join(node['class'])
+    return label
@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+LOCAL_ENV = os.environ.get("LOCAL_ENV", "false").lower() == "true"
+
+# キャッシュの有効期限（秒）。デフォルトは30日
+CACHE_TTL_SECONDS = int(os.environ.get("IMAGE_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+# ウォームコンテナ内で保持する件数
+LRU_MAX_ENTRIES = int(os.environ.get("IMAGE_CACHE_LRU_SIZE", "2000"))
+# 永続化先: none / sqlite / dynamodb / s3
+CACHE_BACKEND = os.environ.get("IMAGE_CACHE_BACKEND", "sqlite" if LOCAL_ENV else "none").lower()
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class SQLiteBackend:
+    """ローカル・テスト用の永続化先。1ファイルのSQLiteに保存する。"""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (cache_key TEXT PRIMARY KEY, value TEXT, expires_at REAL)"
+        )
+        self.conn.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value, expires_at FROM cache WHERE cache_key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def put(self, key, value, expires_at):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cache (cache_key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), expires_at),
+            )
+            self.conn.commit()
+
+
+class DynamoDBBackend:
+    """
+    本番用の永続化先。パーティションキー cache_key (S) のテーブルを使う。
+    expires_at をテーブルのTTL属性に設定しておくと期限切れの項目は自動で消える。
+    """
+
+    def __init__(self, table_name):
+        import boto3
+        self.table = boto3.resource('dynamodb').Table(table_name)
+
+    def get(self, key):
+        item = self.table.get_item(Key={"cache_key": key}).get("Item")
+        if item is None:
+            return None
+        return json.loads(item["value"]), float(item["expires_at"])
+
+    def put(self, key, value, expires_at):
+        self.table.put_item(Item={
+            "cache_key": key,
+            "value": json.dumps(value, ensure_ascii=False),
+            "expires_at": int(expires_at),
+        })
+
+
+class S3Backend:
+    """本番用の永続化先。キーごとに1オブジェクトのJSONとして保存する。"""
+
+    def __init__(self, bucket, prefix="image-descriptions/"):
+        import boto3
+        self.s3 = boto3.client('s3')
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _object_key(self, key):
+        return self.prefix + hashlib.sha256(key.encode("utf-8")).hexdigest() + ".json"
+
+    def get(self, key):
+        try:
+            obj = self.s3.get_object(Bucket=self.bucket, Key=self._object_key(key))
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        record = json.loads(obj["Body"].read())
+        return record["value"], record["expires_at"]
+
+    def put(self, key, value, expires_at):
+        body = json.dumps({"value": value, "expires_at": expires_at}, ensure_ascii=False)
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key=self._object_key(key),
+            Body=body.encode("utf-8"),
+            ContentType="application/json",
+        )
+
+
+class ImageDescriptionCache:
+    """
+    画像説明文のキャッシュ。
+    画像バイト列の SHA-256 を主キー、URL を高速な副キーとして保持する。
+    メモリ上の LRU を先に引き、無ければ永続化先（backend）を引く。
+    """
+
+    def __init__(self, backend=None, ttl=CACHE_TTL_SECONDS, max_entries=LRU_MAX_ENTRIES):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"url_hits": 0, "hash_hits": 0, "misses": 0, "stores": 0, "backend_errors": 0}
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def _get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.lru.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self.lru.move_to_end(key)
+                    return value
+                del self.lru[key]
+        if self.backend is None:
+            return None
+        try:
+            entry = self.backend.get(key)
+        except Exception as e:
+            print(f"画像キャッシュの読み込みに失敗しました: {e}")
+            self._count("backend_errors")
+            return None
+        if entry is None or entry[1] <= now:
+            return None
+        self._remember(key, entry[0], entry[1])
+        return entry[0]
+
+    def _remember(self, key, value, expires_at):
+        with self.lock:
+            self.lru[key] = (value, expires_at)
+            self.lru.move_to_end(key)
+            while len(self.lru) > self.max_entries:
+                self.lru.popitem(last=False)
+
+    def _put(self, key, value):
+        expires_at = time.time() + self.ttl
+        self._remember(key, value, expires_at)
+        if self.backend is None:
+            return
+        try:
+            self.backend.put(key, value, expires_at)
+        except Exception as e:
+            print(f"画像キャッシュの書き込みに失敗しました: {e}")
+            self._count("backend_errors")
+
+    def get_by_url(self, url):
+        record = self._get("url:" + url)
+        if record is None:
+            return None
+        self._count("url_hits")
+        return record["description"]
+
+    def get_by_hash(self, digest, url=None):
+        # 画像を取得できずハッシュが無い場合はミスとして扱う
+        record = self._get("img:" + digest) if digest else None
+        if record is None:
+            self._count("misses")
+            return None
+        self._count("hash_hits")
+        # 同じ画像の別URLだったので、次回はURLだけで引けるようにしておく
+        if url:
+            self._put("url:" + url, {"hash": digest, "description": record["description"]})
+        return record["description"]
+
+    def put(self, url, digest, description):
+        self._count("stores")
+        if digest:
+            self._put("img:" + digest, {"description": description})
+        self._put("url:" + url, {"hash": digest, "description": description})
+
+
+def create_backend(name=CACHE_BACKEND):
+    if name == "sqlite":
+        return SQLiteBackend(os.environ.get("IMAGE_CACHE_SQLITE_PATH", "/tmp/image_descriptions.sqlite3"))
+    if name == "dynamodb":
+        return DynamoDBBackend(os.environ["IMAGE_CACHE_TABLE_NAME"])
+    if name == "s3":
+        return S3Backend(os.environ["IMAGE_CACHE_BUCKET_NAME"])
+    return None
+
+
+def create_cache():
+    try:
+        backend = create_backend()
+    except Exception as e:
+        print(f"画像キャッシュの永続化先を初期化できないため、メモリのみで動かします: {e}")
+        backend = None
+    return ImageDescriptionCache(backend)
@@ -0,0 +1,149 @@
+import io
+import os
+import base64
+import hashlib
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+# ハッシュ計算・判定のために取得する画像の最大サイズ
+MAX_IMAGE_BYTES = 10 * 1024 * 1024
+# これより小さいファイルはトラッキングピクセルやスペーサーとみなして捨てる
+MIN_IMAGE_BYTES = int(os.environ.get("IMAGE_MIN_BYTES", "512"))
+# 幅・高さのどちらかがこれ未満の画像はアイコン類とみなして捨てる
+MIN_IMAGE_DIMENSION = int(os.environ.get("IMAGE_MIN_DIMENSION", "48"))
+# 知覚ハッシュのハミング距離がこれ以下なら同じ画像とみなす
+PHASH_MAX_DISTANCE = int(os.environ.get("IMAGE_PHASH_MAX_DISTANCE", "4"))
+
+
+class ImageInfo:
+    __slots__ = ("url", "size", "digest", "width", "height", "phash")
+
+    def __init__(self, url, size, digest, width=None, height=None, phash=None):
+        self.url = url
+        self.size = size
+        self.digest = digest
+        self.width = width
+        self.height = height
+        self.phash = phash
+
+
+def fetch_image_bytes(image_url):
+    """
+    画像のバイト列を取得する。取得できない・大きすぎる場合は None。
+    data: URL はその場でデコードする。
+    """
+    try:
+        if image_url.startswith("data:"):
+            header, _, payload = image_url.partition(",")
+            if header.endswith(";base64"):
+                return base64.b64decode(payload)
+            return payload.encode("utf-8")
+        with requests.get(image_url, timeout=10, stream=True) as resp:
+            if not resp.ok:
+                return None
+            length = resp.headers.get("Content-Length")
+            if length and length.isdigit() and int(length) > MAX_IMAGE_BYTES:
+                return None
+            data = bytearray()
+            for chunk in resp.iter_content(chunk_size=65536):
+                data.extend(chunk)
+                if len(data) > MAX_IMAGE_BYTES:
+                    return None
+            return bytes(data)
+    except Exception as e:
+        print(f"画像の取得に失敗しました: {e} for {image_url[:200]}")
+        return None
+
+
+def dhash(image, hash_size=8):
+    """
+    差分ハッシュ（dHash）。縮小したグレースケール画像の隣接画素の大小を 64bit にまとめる。
+    サイズ違い・再圧縮・クエリ違いの同一画像はほぼ同じ値になる。
+    """
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def inspect_image(url):
+    """
+    画像を1度だけ取得し、サイズ・内容ハッシュ・知覚ハッシュを求める。取得できなければ None。
+    """
+    data = fetch_image_bytes(url)
+    if not data:
+        return None
+    info = ImageInfo(url, len(data), hashlib.sha256(data).hexdigest())
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            info.width, info.height = image.size
+            image.draft("L", (64, 64))  # JPEG は縮小デコードで済ませる
+            info.phash = dhash(image)
+    except Exception:
+        # SVG など Pillow で読めない形式はサイズ判定・グループ化の対象外として残す
+        pass
+    return info
+
+
+def is_junk(info):
+    if info.size < MIN_IMAGE_BYTES:
+        return True
+    if info.width is not None and min(info.width, info.height) < MIN_IMAGE_DIMENSION:
+        return True
+    return False
+
+
+def prefilter_images(urls, max_workers=20):
+    """
+    説明文を生成する前に画像を絞り込む。
+    戻り値: (representatives, aliases, dropped)
+      representatives: 説明文を生成する ImageInfo のリスト（取得できなかったURLは digest=None）
+      aliases: { url: 代表url } 知覚ハッシュが近い画像を代表にまとめる
+      dropped: 小さすぎる等で説明文を付けないURLの集合
+    """
+    if not urls:
+        return [], {}, set()
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(urls))) as executor:
+        infos = list(executor.map(inspect_image, urls))
+
+    representatives = []
+    aliases = {}
+    dropped = set()
+    for url, info in zip(urls, infos):
+        if info is None:
+            # 取得できなくても、URL指定ならモデル側で読める場合があるのでそのまま残す
+            representatives.append(ImageInfo(url, 0, None))
+            continue
+        if is_junk(info):
+            dropped.add(url)
+            continue
+        group = None
+        for rep in representatives:
+            if rep.digest is None:
+                continue
+            if rep.digest == info.digest or (
+                info.phash is not None and rep.phash is not None
+                and bin(rep.phash ^ info.phash).count("1") <= PHASH_MAX_DISTANCE
+            ):
+                group = rep
+                break
+        if group is None:
+            representatives.append(info)
+        elif info.width is not None and group.width is not None \
+                and info.width * info.height > group.width * group.height:
+            # 解像度の高い方を代表にして説明文の精度を上げる
+            representatives[representatives.index(group)] = info
+            for alias, target in aliases.items():
+                if target == group.url:
+                    aliases[alias] = info.url
+            aliases[group.url] = info.url
+        else:
+            aliases[url] = group.url
+
+    print(f"画像の事前フィルタ: {len(urls)}件 → 説明対象{len(representatives)}件 (重複{len(aliases)}件, 除外{len(dropped)}件)")
+    return representatives, aliases, dropped
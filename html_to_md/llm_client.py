@@ -0,0 +1,290 @@
+import os
+import time
+import random
+import threading
+import requests
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+
+# 接続確立までと、レスポンス待ちのタイムアウト（秒）
+CONNECT_TIMEOUT = float(os.environ.get("LLM_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.environ.get("LLM_READ_TIMEOUT", "60"))
+# true にすると httpx（http2 extra）が入っていれば HTTP/2 で1本の接続に多重化する
+USE_HTTP2 = os.environ.get("LLM_HTTP2", "false").lower() == "true"
+# リトライ回数と、指数バックオフの基準・上限（秒）
+MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "4"))
+BACKOFF_BASE = float(os.environ.get("LLM_BACKOFF_BASE", "1"))
+BACKOFF_MAX = float(os.environ.get("LLM_BACKOFF_MAX", "30"))
+# 429 以外でリトライするステータス（サーバ側の一時的なエラー）
+RETRYABLE_STATUS = frozenset((408, 500, 502, 503, 504))
+
+
+class LLMHTTPError(RuntimeError):
+    def __init__(self, status_code, text):
+        super().__init__(f"HTTP {status_code}: {text[:500]}")
+        self.status_code = status_code
+
+
+class AdaptiveLimiter:
+    """
+    プロバイダごとの流量制御。
+    - トークンバケット: 1秒あたりのリクエスト数を rate_per_sec 以下に抑える（0 なら制限なし）
+    - AIMD: 同時実行数の上限を、成功ごとに少しずつ増やし、429 を受けたら半分に減らす
+    - Retry-After: 429 で指定された時間は、このプロバイダへの新しいリクエストを全スレッドで止める
+    待たされた時間は throttled_seconds に積算する。
+    """
+
+    def __init__(self, name, rate_per_sec, max_concurrency, min_concurrency=1):
+        self.name = name
+        self.rate = rate_per_sec
+        self.burst = max(1.0, rate_per_sec)
+        self.tokens = self.burst
+        self.refilled_at = time.monotonic()
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.decreased_at = 0.0
+        self.cond = threading.Condition()
+        self.counters = {"requests": 0, "throttled": 0, "server_errors": 0, "retries": 0, "throttled_seconds": 0.0}
+
+    def _wait_time(self, now):
+        # 0 なら今すぐ実行できる。None は実行中のリクエストが終わるまで待つ
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.in_flight >= int(self.limit):
+            return None
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+            self.refilled_at = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+        return 0
+
+    def acquire(self):
+        start = time.monotonic()
+        with self.cond:
+            while True:
+                wait = self._wait_time(time.monotonic())
+                if wait == 0:
+                    break
+                self.cond.wait(wait)
+            if self.rate:
+                self.tokens -= 1
+            self.in_flight += 1
+            self.counters["requests"] += 1
+            now = time.monotonic()
+            self.counters["throttled_seconds"] += now - start
+            return now
+
+    def release(self, started_at, success=True, throttled=False, retry_after=None):
+        now = time.monotonic()
+        with self.cond:
+            self.in_flight -= 1
+            if throttled:
+                self.counters["throttled"] += 1
+                # 前回減らした後に送ったリクエストの 429 だけで減らす（同じ時期に送った分でまとめて何度も半減させない）
+                if started_at >= self.decreased_at:
+                    self.limit = max(self.min_concurrency, self.limit / 2)
+                    self.decreased_at = now
+                if retry_after:
+                    self.paused_until = max(self.paused_until, now + retry_after)
+            elif success:
+                # 上限まで埋まった状態で全て成功すると、およそ1ずつ増える
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            self.cond.notify_all()
+
+    def record_retry(self, delay, server_error=False):
+        with self.cond:
+            self.counters["retries"] += 1
+            self.counters["throttled_seconds"] += delay
+            if server_error:
+                self.counters["server_errors"] += 1
+
+    def stats(self):
+        with self.cond:
+            stats = dict(self.counters)
+            stats["concurrency_limit"] = int(self.limit)
+        return stats
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(provider, default_concurrency):
+    """
+    プロバイダごとに1つの流量制御をコンテナ内で共有する。
+    LLM_<PROVIDER>_RATE_PER_SEC / LLM_<PROVIDER>_MAX_CONCURRENCY で設定できる。
+    """
+    with _limiters_lock:
+        if provider not in _limiters:
+            prefix = f"LLM_{provider.upper()}_"
+            _limiters[provider] = AdaptiveLimiter(
+                provider,
+                rate_per_sec=float(os.environ.get(prefix + "RATE_PER_SEC", "0")),
+                max_concurrency=int(os.environ.get(prefix + "MAX_CONCURRENCY", str(default_concurrency))),
+            )
+        return _limiters[provider]
+
+
+def parse_retry_after(headers):
+    """
+    Retry-After（秒数または HTTP 日付）と retry-after-ms から待つべき秒数を求める。指定が無ければ None。
+    """
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error):
+    """
+    時間を置けば成功しうる失敗か。レート制限（429）・サーバ側の一時的なエラー・タイムアウト・接続エラーが該当する。
+    それ以外の 4xx やレスポンスの解釈の失敗は、同じリクエストを送り直しても変わらない。
+    """
+    if isinstance(error, LLMHTTPError):
+        return error.status_code == 429 or error.status_code in RETRYABLE_STATUS
+    if isinstance(error, (requests.Timeout, requests.ConnectionError)):
+        return True
+    try:
+        import httpx
+    except ImportError:
+        return False
+    return isinstance(error, httpx.TransportError)
+
+
+def stats_delta(before, after):
+    # 呼び出し1回分の増分。concurrency_limit は現在値をそのまま使う
+    delta = {k: after[k] - before[k] for k in after if k != "concurrency_limit"}
+    delta["throttled_seconds"] = round(delta["throttled_seconds"], 3)
+    delta["concurrency_limit"] = after["concurrency_limit"]
+    return delta
+
+
+def backoff_delay(attempt):
+    # full jitter: 0 〜 base * 2^attempt の一様乱数で、リトライが同じ時刻に集中しないようにする
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+class LLMClient:
+    """
+    LLM API 用の HTTP クライアント。
+    ホストごとの接続プールを保持し、ウォームコンテナでは前回の呼び出しの TCP/TLS 接続を使い回す。
+    pool_size は呼び出し側の並列数（スレッド数）に合わせる。足りないと接続の張り直しが起きる。
+    """
+
+    def __init__(self, pool_size, provider="default", connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 http2=USE_HTTP2):
+        self.pool_size = pool_size
+        self.limiter = get_limiter(provider, pool_size)
+        self.timeout = (connect_timeout, read_timeout)
+        self.http2 = http2
+        self.lock = threading.Lock()
+        self.session = None
+
+    def _create_session(self):
+        if self.http2:
+            try:
+                import httpx
+                import h2  # noqa: F401  httpx の HTTP/2 対応に必要
+                return httpx.Client(
+                    http2=True,
+                    timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
+                    limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+                )
+            except ImportError:
+                print("httpx[http2] が無いため HTTP/1.1 の接続プールを使います")
+                self.http2 = False
+        session = requests.Session()
+        # pool_block=True で、上限を超えた分は新しい接続を張らずに空きを待つ
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, pool_block=True)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def _get_session(self):
+        if self.session is None:
+            with self.lock:
+                if self.session is None:
+                    self.session = self._create_session()
+        return self.session
+
+    def post(self, url, payload, headers=None, timeout=None):
+        """
+        JSON を POST してレスポンスを返す。ステータスの確認は呼び出し側で行う。
+        timeout を省略すると (接続, 読み込み) のデフォルトを使う。
+        """
+        timeout = timeout or self.timeout
+        session = self._get_session()
+        if self.http2:
+            import httpx
+            return session.post(url, json=payload, headers=headers,
+                                timeout=httpx.Timeout(timeout[1], connect=timeout[0]))
+        return session.post(url, json=payload, headers=headers, timeout=timeout)
+
+    def call(self, url, payload, headers=None, timeout=None, max_retries=MAX_RETRIES):
+        """
+        流量制御とリトライ付きで POST し、成功したレスポンスを返す。
+        429 は Retry-After（無ければバックオフ）だけ待ってリトライし、同時実行数を減らす。
+        5xx・タイムアウト・接続エラーはバックオフしてリトライする。それ以外の 4xx はリトライせず LLMHTTPError。
+        """
+        for attempt in range(max_retries + 1):
+            last_attempt = attempt == max_retries
+            started_at = self.limiter.acquire()
+            try:
+                response = self.post(url, payload, headers=headers, timeout=timeout)
+            except Exception as e:
+                self.limiter.release(started_at, success=False)
+                if last_attempt:
+                    raise
+                delay = backoff_delay(attempt)
+                print(f"{self.limiter.name} への接続に失敗したため{delay:.1f}秒後にリトライします: {e}")
+                self.limiter.record_retry(delay, server_error=True)
+                time.sleep(delay)
+                continue
+
+            status = response.status_code
+            if status < 400:
+                self.limiter.release(started_at)
+                return response
+            if status == 429:
+                retry_after = parse_retry_after(response.headers)
+                self.limiter.release(started_at, success=False, throttled=True, retry_after=retry_after)
+                if last_attempt:
+                    raise LLMHTTPError(status, response.text)
+                delay = max(retry_after or 0, backoff_delay(attempt))
+                print(f"{self.limiter.name} のレート制限に達したため{delay:.1f}秒後にリトライします")
+                self.limiter.record_retry(delay)
+                time.sleep(delay)
+                continue
+            self.limiter.release(started_at, success=False)
+            if status not in RETRYABLE_STATUS or last_attempt:
+                raise LLMHTTPError(status, response.text)
+            delay = backoff_delay(attempt)
+            print(f"{self.limiter.name} が HTTP {status} を返したため{delay:.1f}秒後にリトライします")
+            self.limiter.record_retry(delay, server_error=True)
+            time.sleep(delay)
+
+    def stats(self):
+        return self.limiter.stats()
+
+    def close(self):
+        with self.lock:
+            if self.session is not None:
+                self.session.close()
+                self.session = None
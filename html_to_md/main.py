@@ -1,161 +1,376 @@
+import os
 import json
 import re
 from urllib.parse import urljoin
-from bs4 import BeautifulSoup, NavigableString, Comment
+from bs4 import BeautifulSoup, NavigableString, Comment, CData
 
 import annotate_image
+import content_extract
+import llm_client
+import artifact_store
+import tracing
+
+# BeautifulSoup のパーサ。lxml は C 実装で大きな HTML でも速いが、
+# 閉じタグの省略など不正な HTML の木の組み方が html.parser と異なりブロックが変わるため、既定は html.parser
+PARSER_ENGINES = ('html.parser', 'lxml')
+DEFAULT_PARSER = os.environ.get("HTML_PARSER", "html.parser")
 
 def preprocess_br(html: str) -> str:
     # <br> <br/> <BR> などをすべて半角スペースに置き換え
     return re.sub(r'(?i)<br\s*/?>', ' ', html)
 
-def html_to_blocks(html, base_url):
+class Block:
+    """
+    ブロック1件分のレコード。dict より省メモリな __slots__ のクラスで、
+    b['type'] や b.get('alt') のように dict と同じ書き方でも参照・更新できる。
+    """
+    __slots__ = ('type', 'level', 'ordered', 'tag', 'href', 'src', 'alt', 'text', 'code', 'rows')
+
+    # type ごとに持つ項目（JSON にしたときのキーの順番も兼ねる）
+    FIELDS = {
+        'heading':     ('level', 'text'),
+        'list_item':   ('ordered', 'text'),
+        'table':       ('rows',),
+        'hr':          (),
+        'blockquote':  ('text',),
+        'code_block':  ('code',),
+        'inline_code': ('text',),
+        'bold':        ('text',),
+        'italic':      ('text',),
+        'link':        ('href', 'text'),
+        'image':       ('src', 'alt'),
+        'text':        ('tag', 'text'),
+        'media':       ('tag', 'src'),
+    }
+
+    def __init__(self, type, level=None, ordered=None, tag=None, href=None, src=None,
+                 alt=None, text=None, code=None, rows=None):
+        self.type = type
+        self.level = level
+        self.ordered = ordered
+        self.tag = tag
+        self.href = href
+        self.src = src
+        self.alt = alt
+        self.text = text
+        self.code = code
+        self.rows = rows
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def keys(self):
+        return ('type',) + self.FIELDS[self.type]
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.keys()}
+
+    def __getitem__(self, key):
+        if key not in self.keys():
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.keys() else default
+
+    def __eq__(self, other):
+        if isinstance(other, Block):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __repr__(self):
+        return f"Block({self.to_dict()!r})"
+
+
+def blocks_to_json(blocks):
+    """
+    ブロックのリストを JSON で返せる dict のリストにする（dict のブロックはそのまま）。
+    """
+    return [b.to_dict() if isinstance(b, Block) else b for b in blocks]
+
+
+def json_default(obj):
+    # json.dumps(..., default=json_default) で Block をそのままシリアライズする
+    if isinstance(obj, Block):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+# 走査時にサブツリーごと無視するタグ
+SKIP_TAGS = frozenset(('script', 'style', 'noscript', 'iframe', 'svg'))
+# get_text() が既定で拾う文字列の型（rt/rp など専用の型は除外される）
+MAIN_STRING_TYPES = (NavigableString, CData)
+
+# スタックに積む処理の種類
+_ENTER, _EXIT_CAPTURE, _EXIT_LI, _EXIT_CELL = range(4)
+
+
+def _string_types(tag):
+    # BeautifulSoup の get_text() と同じく、タグごとに対象となる文字列の型を決める
+    types = getattr(tag, 'interesting_string_types', None)
+    if types is None:
+        return MAIN_STRING_TYPES
+    if isinstance(types, type):
+        return (types,)
+    return tuple(types)
+
+
+def _is_heading(name):
+    return name.startswith('h') and len(name) == 2 and name[1].isdigit()
+
+
+class _Capture:
+    """
+    見出し・リスト・表・リンクなど、配下のテキストをまとめて1ブロックにする要素の走査状態。
+    配下の文字列は共有の texts に積み、開始位置からの結合でテキストを作る。
+    """
+    __slots__ = ('node', 'kind', 'start', 'raw', 'string_types', 'items', 'rows', 'section_rows', 'images')
+
+    def __init__(self, node, kind, start, raw=False):
+        self.node = node
+        self.kind = kind
+        self.start = start
+        self.raw = raw
+        self.string_types = _string_types(node)
+        self.items = []          # list: li のテキスト
+        self.rows = {}           # table: id(tr) → セルのテキストのリスト
+        self.section_rows = []   # table: thead/tbody 直下の tr の行
+        self.images = []         # link: 配下の img
+
+
+def _has_pc_image(parent):
+    """
+    親要素の中に class に 'pc' を含む img があるか。無視するタグの中の img は数えない。
+    """
+    for img in parent.find_all('img', class_=lambda c: c and 'pc' in c.split()):
+        ancestor = img.parent
+        while ancestor is not parent and ancestor.name not in SKIP_TAGS:
+            ancestor = ancestor.parent
+        if ancestor is parent:
+            return True
+    return False
+
+
+def html_to_blocks(html, base_url, parser=None):
     """
     HTML をブロック単位に分解し、Markdown 変換のための中間データ構造を作成する。
     対応要素: h1-h6, ul/ol, table, hr, blockquote, pre, code, strong/b/em/i, a, img,
     input/button/textarea, video/audio, text
+    parser: PARSER_ENGINES のいずれか。省略時は DEFAULT_PARSER
+    戻り値: Block のリスト
     """
+    soup = parse_html(html, parser)
+
+    # 本体走査
+    if soup.body:
+        return walk_blocks(soup.body, base_url)
+    return []
+
+
+def parse_html(html, parser=None):
+    parser = parser or DEFAULT_PARSER
+    if parser not in PARSER_ENGINES:
+        raise ValueError(f"unknown parser: {parser}")
+
     # 改行処理（br を適切に扱う前処理）
     html_without_br = preprocess_br(html)
-    soup = BeautifulSoup(html_without_br, 'html.parser')
+    return BeautifulSoup(html_without_br, parser)
 
-    # コメント除去
-    for c in soup.find_all(string=lambda t: isinstance(t, Comment)):
-        c.extract()
-    # 不要タグ除去
-    for bad in soup(['script', 'style', 'noscript', 'iframe', 'svg']):
-        bad.decompose()
 
+def html_to_main_content_blocks(html, base_url, parser=None, include_metadata=True):
+    """
+    ナビゲーション・フッター・関連記事一覧などを除き、本文の領域だけをブロック化する。
+    include_metadata: True なら <head> のタイトル・説明文などを先頭にテキストブロックとして付ける
+    戻り値: (blocks, stats) stats は削減した文字数・トークン数の見積もり
+    """
+    soup = parse_html(html, parser)
+    if not soup.body:
+        return [], None
+    root, stats = content_extract.extract_main_content(soup)
     blocks = []
+    if include_metadata:
+        metadata = content_extract.extract_metadata(soup)
+        blocks.extend(Block('text', tag='meta', text=f"{key}: {value}") for key, value in metadata.items())
+    blocks.extend(walk_blocks(root, base_url))
+    return blocks, stats
 
-    def walk(node):
-        # --- 見出し h1-h6 ---
-        if node.name and node.name.startswith('h') and len(node.name) == 2 and node.name[1].isdigit():
-            level = int(node.name[1])
-            text = node.get_text(strip=True)
-            if text:
-                blocks.append({'type': 'heading', 'level': level, 'text': text})
-            return
 
-        # --- リスト ul/ol ---
-        if node.name in ('ul', 'ol'):
-            ordered = (node.name == 'ol')
-            for li in node.find_all('li', recursive=False):
-                blocks.append({'type': 'list_item', 'ordered': ordered, 'text': li.get_text(strip=True)})
-            return
+def walk_blocks(root, base_url):
+    """
+    root 配下を再帰を使わずに1度だけ走査してブロックを作る。
+    コメントと SKIP_TAGS のサブツリーは走査中に読み飛ばす（事前の除去パスは不要）。
+    見出し・リスト等のテキストは走査中に集めた文字列から1回だけ組み立てる。
+    """
+    blocks = []
+    texts = []           # キャプチャ中に集めた文字列
+    cap = None           # 現在のキャプチャ（入れ子にはしない。一番外側だけがブロックを作る）
+    pc_cache = {}        # id(親要素) → 親の中に pc 画像があるか
+
+    stack = [(_ENTER, root, None)]
+    while stack:
+        action, node, data = stack.pop()
+
+        # ---------- 要素を抜けるときの処理 ----------
+        if action == _EXIT_LI:
+            cap.items.append(''.join(texts[data:]))
+            continue
+        if action == _EXIT_CELL:
+            # node はセルが属する行のリスト
+            node.append(''.join(texts[data:]))
+            continue
+        if action == _EXIT_CAPTURE:
+            _finish_capture(cap, texts, blocks, base_url)
+            del texts[cap.start:]
+            cap = None
+            continue
+
+        # ---------- 文字列 ----------
+        if isinstance(node, NavigableString):
+            if isinstance(node, Comment):
+                continue
+            if cap is not None:
+                if type(node) in cap.string_types:
+                    if cap.raw:
+                        texts.append(str(node))
+                    else:
+                        text = node.strip()
+                        if text:
+                            texts.append(text)
+                continue
+            # --- テキスト葉 ---
+            text = node.strip()
+            if text and node.parent.name not in ('html', 'body', 'head'):
+                blocks.append(Block('text', tag=node.parent.name, text=text))
+            continue
+
+        name = node.name
+        if name in SKIP_TAGS:
+            continue
+
+        # ---------- キャプチャ中: 文字列を集めるだけ ----------
+        if cap is not None:
+            kind = cap.kind
+            if kind == 'link':
+                if name == 'img' and node.get('src'):
+                    cap.images.append(node)
+            elif kind == 'list':
+                if name == 'li' and node.parent is cap.node:
+                    stack.append((_EXIT_LI, node, len(texts)))
+            elif kind == 'table':
+                if name == 'tr':
+                    row = []
+                    cap.rows[id(node)] = row
+                    parent = node.parent
+                    if parent.name in ('thead', 'tbody') and parent.parent is cap.node:
+                        cap.section_rows.append(row)
+                    cap.items.append(row)
+                elif name in ('th', 'td') and id(node.parent) in cap.rows:
+                    stack.append((_EXIT_CELL, cap.rows[id(node.parent)], len(texts)))
+            stack.extend((_ENTER, child, None) for child in reversed(node.contents))
+            continue
 
+        # --- 見出し h1-h6 ---
+        if _is_heading(name):
+            cap = _Capture(node, 'heading', len(texts))
+        # --- リスト ul/ol ---
+        elif name in ('ul', 'ol'):
+            cap = _Capture(node, 'list', len(texts))
         # --- テーブル ---
-        if node.name == 'table':
-            rows = []
-            for section in node.find_all(['thead','tbody'], recursive=False):
-                for tr in section.find_all('tr', recursive=False):
-                    cells = [cell.get_text(strip=True) for cell in tr.find_all(['th','td'], recursive=False)]
-                    rows.append(cells)
-            if not rows:
-                for tr in node.find_all('tr'):  # 再帰的に全 tr を拾うフォールバック
-                    cells = [cell.get_text(strip=True) for cell in tr.find_all(['th','td'], recursive=False)]
-                    rows.append(cells)
-            blocks.append({'type': 'table', 'rows': rows})
-            return
-
+        elif name == 'table':
+            cap = _Capture(node, 'table', len(texts))
         # --- 水平線 hr ---
-        if node.name == 'hr':
-            blocks.append({'type': 'hr'})
-            return
-
+        elif name == 'hr':
+            blocks.append(Block('hr'))
+            continue
         # --- 引用 blockquote ---
-        if node.name == 'blockquote':
-            text = node.get_text(strip=True)
-            blocks.append({'type': 'blockquote', 'text': text})
-            return
-
+        elif name == 'blockquote':
+            cap = _Capture(node, 'blockquote', len(texts))
         # --- コードブロック pre ---
-        if node.name == 'pre':
-            code = node.get_text()
-            blocks.append({'type': 'code_block', 'code': code})
-            return
-
+        elif name == 'pre':
+            cap = _Capture(node, 'code_block', len(texts), raw=True)
         # --- インラインコード code ---
-        if node.name == 'code' and not node.find_all():
-            blocks.append({'type': 'inline_code', 'text': node.get_text(strip=True)})
-            return
-
+        elif name == 'code' and not any(
+            child.name and child.name not in SKIP_TAGS for child in node.contents
+        ):
+            cap = _Capture(node, 'inline_code', len(texts))
         # --- 強調 / 太字 ---
-        if node.name in ('strong', 'b', 'em', 'i'):
-            text = node.get_text(strip=True)
-            style = 'bold' if node.name in ('strong', 'b') else 'italic'
-            blocks.append({'type': style, 'text': text})
-            return
-
+        elif name in ('strong', 'b'):
+            cap = _Capture(node, 'bold', len(texts))
+        elif name in ('em', 'i'):
+            cap = _Capture(node, 'italic', len(texts))
         # --- リンク a ---
-        if node.name == 'a' and node.get('href'):
-            href = urljoin(base_url, node['href'])
-            # (1) 先に中の画像をすべてブロック化
-            for img in node.find_all('img'):
-                src = urljoin(base_url, img['src'])
-                blocks.append({'type': 'image', 'src': src, 'alt': img.get('alt','')})
-            # (2) リンクテキストをブロック化
-            text = node.get_text(strip=True)
-            if text:
-                blocks.append({'type': 'link', 'href': href, 'text': text})
-            return
-
-
-        # # --- ソース要素 source (srcset用) ---
-        # if node.name == 'source' and node.get('srcset'):
-        #     blocks.append({
-        #         'type': 'image',
-        #         'src': urljoin(base_url, node['srcset']),
-        #         'alt': ''
-        #     })
-        #     return
-
+        elif name == 'a' and node.get('href'):
+            cap = _Capture(node, 'link', len(texts))
         # --- 画像 img ---
-        if node.name == 'img' and node.get('src'):
-            src = urljoin(base_url, node['src'])
-            classes = node.get('class', [])
+        elif name == 'img' and node.get('src'):
             # --- sp 版は、同じ親に pc があればスキップ ---
-            if 'sp' in classes:
+            if 'sp' in node.get('class', []):
                 parent = node.parent
-                # 親内に class に 'pc' を含む img がいれば無視
-                if parent.find('img', class_=lambda c: c and 'pc' in c.split()):
-                    return
-            blocks.append({'type': 'image', 'src': src, 'alt': node.get('alt', '')})
-            return
-
+                key = id(parent)
+                if key not in pc_cache:
+                    pc_cache[key] = _has_pc_image(parent)
+                if pc_cache[key]:
+                    continue
+            blocks.append(Block('image', src=urljoin(base_url, node['src']), alt=node.get('alt', '')))
+            continue
         # --- フォーム要素 ---
-        if node.name == 'input' and node.get('value'):
-            blocks.append({'type': 'text', 'tag': 'input', 'text': node['value']})
-            return
-        if node.name == 'button':
-            blocks.append({'type': 'text', 'tag': 'button', 'text': node.get_text(strip=True)})
-            return
-        if node.name == 'textarea':
-            blocks.append({'type': 'text', 'tag': 'textarea', 'text': node.get_text(strip=True)})
-            return
-
+        elif name == 'input' and node.get('value'):
+            blocks.append(Block('text', tag='input', text=node['value']))
+            continue
+        elif name in ('button', 'textarea'):
+            cap = _Capture(node, name, len(texts))
         # --- メディア要素 video/audio ---
-        if node.name in ('video', 'audio') and node.get('src'):
-            src = urljoin(base_url, node['src'])
-            blocks.append({'type': 'media', 'tag': node.name, 'src': src})
-            return
+        elif name in ('video', 'audio') and node.get('src'):
+            blocks.append(Block('media', tag=name, src=urljoin(base_url, node['src'])))
+            continue
 
-        # --- テキスト葉 ---
-        if isinstance(node, NavigableString):
-            text = node.strip()
-            if text and node.parent.name not in ('html', 'body', 'head'):
-                blocks.append({'type': 'text', 'tag': node.parent.name, 'text': text})
-            return
+        # --- 子要素へ ---
+        if cap is not None:
+            stack.append((_EXIT_CAPTURE, node, None))
+        stack.extend((_ENTER, child, None) for child in reversed(node.contents))
 
-        # --- 再帰 ---
-        for child in node.children:
-            walk(child)
+    return blocks
 
-    # 本体走査
-    if soup.body:
-        walk(soup.body)
 
-    return blocks
+def _finish_capture(cap, texts, blocks, base_url):
+    kind = cap.kind
+    node = cap.node
+    if kind == 'list':
+        ordered = (node.name == 'ol')
+        for text in cap.items:
+            blocks.append(Block('list_item', ordered=ordered, text=text))
+        return
+    if kind == 'table':
+        # thead/tbody 直下の行が無ければ、配下の全 tr を拾うフォールバック
+        rows = cap.section_rows or cap.items
+        blocks.append(Block('table', rows=rows))
+        return
+
+    text = ''.join(texts[cap.start:])
+    if kind == 'heading':
+        if text:
+            blocks.append(Block('heading', level=int(node.name[1]), text=text))
+    elif kind == 'link':
+        # (1) 先に中の画像をすべてブロック化
+        for img in cap.images:
+            blocks.append(Block('image', src=urljoin(base_url, img['src']), alt=img.get('alt', '')))
+        # (2) リンクテキストをブロック化
+        if text:
+            blocks.append(Block('link', href=urljoin(base_url, node['href']), text=text))
+    elif kind == 'code_block':
+        blocks.append(Block('code_block', code=text))
+    elif kind in ('button', 'textarea'):
+        blocks.append(Block('text', tag=kind, text=text))
+    else:
+        # blockquote / inline_code / bold / italic
+        blocks.append(Block(kind, text=text))
 
 
 def blocks_to_markdown(blocks):
@@ -205,17 +420,47 @@ def blocks_to_markdown(blocks):
         md.pop()
     return '\n'.join(md)
 
+@tracing.traced("handler", entry_point=True)
 def handler(event, context):
     if "body" in event:
         event = json.loads(event["body"])
     
-    html = event.get('html', '')
     base_url = event.get('url', '')
     print(f"{base_url}の処理を開始します")
+    inline_max_bytes = event.get('artifact_inline_max_bytes')
+    # ステップごとの所要秒数（レスポンスで返し、呼び出し元でURLごとの内訳に入れる）
+    timings = {"cold_start": tracing.is_cold()}
 
-    # HTMLをブロック化
+    # 大きな HTML・ブロックは S3 に置かれた参照で渡される
     try:
-        blocks_json = html_to_blocks(html, base_url)
+        with tracing.span("load_input", timings, url=base_url) as span:
+            html = artifact_store.unpack(event.get('html', ''))
+            event_blocks = artifact_store.unpack(event.get('blocks'))
+            span.add_bytes(len(html.encode("utf-8")) if html else 0)
+    except Exception as e:
+        print(f"artifact load error: {e}")
+        return _error_response("Failed to load artifact")
+
+    # HTMLをブロック化（extract_main_content が指定された場合は本文だけ）
+    content_stats = None
+    try:
+        if event_blocks is not None:
+            # Selenium Lambda がブラウザ内で分解済みのブロック（HTML のパースは不要）
+            blocks_json = [Block.from_dict(b) for b in event_blocks]
+            if event.get('extract_main_content'):
+                print(f"{base_url}はブロックで渡されたため、本文抽出は行いません")
+        elif event.get('extract_main_content'):
+            with tracing.span("html_to_main_content_blocks", timings, url=base_url) as span:
+                blocks_json, content_stats = html_to_main_content_blocks(
+                    html, base_url, parser=event.get('parser'),
+                    include_metadata=event.get('include_metadata', True),
+                )
+                span.add_bytes(len(html.encode("utf-8")))
+            print(f"{base_url}の本文を抽出しました: {content_stats}")
+        else:
+            with tracing.span("html_to_blocks", timings, url=base_url) as span:
+                blocks_json = html_to_blocks(html, base_url, parser=event.get('parser'))
+                span.add_bytes(len(html.encode("utf-8")))
         print(f"{base_url}のHTMLをブロック化しました")
     except Exception as e:
         print(f"html_to_blocks error: {e}")
@@ -223,25 +468,48 @@ def handler(event, context):
 
 
     # 画像の説明を生成
+    cache_before = annotate_image.description_cache.stats()
+    llm_before = annotate_image.openai_client.stats()
     try:
-        annotated_blocks = annotate_image.generate_image_descriptions(blocks_json)
+        with tracing.span("generate_image_descriptions", timings, url=base_url):
+            annotated_blocks = annotate_image.generate_image_descriptions(
+                blocks_json,
+                batch_size=int(event.get('image_batch_size', annotate_image.IMAGE_BATCH_SIZE)),
+            )
     except Exception as e:
         print(f"annotate_image error: {e}")
         # フォールバックで元のブロックをそのまま使う
         annotated_blocks = blocks_json
+    cache_after = annotate_image.description_cache.stats()
+    image_cache_stats = {k: cache_after[k] - cache_before[k] for k in cache_after}
+    print(f"{base_url}の画像キャッシュ: {image_cache_stats}")
+    llm_stats = llm_client.stats_delta(llm_before, annotate_image.openai_client.stats())
+    print(f"{base_url}の OpenAI の呼び出し状況: {llm_stats}")
 
     # markdown 変換
     try:
-        markdown = blocks_to_markdown(annotated_blocks)
+        with tracing.span("blocks_to_markdown", timings, url=base_url) as span:
+            markdown = blocks_to_markdown(annotated_blocks)
+            span.add_bytes(len(markdown.encode("utf-8")))
         print(f"{base_url}のMarkdown 変換が完了しました")
     except Exception as e:
         print(f"blocks_to_markdown error: {e}")
         markdown = "#RAW HTML FALLBACK\n" + html
 
+    # 大きければ S3 に置いて参照を返す
+    with tracing.span("store_output", timings, url=base_url):
+        blocks_out = artifact_store.pack(blocks_to_json(annotated_blocks), 'blocks', inline_max_bytes)
+        markdown_out = artifact_store.pack(markdown, 'markdown', inline_max_bytes)
+
     body = {
-        'blocks_json': annotated_blocks,
-        'markdown': markdown
+        'blocks_json': blocks_out,
+        'markdown': markdown_out,
+        'image_cache_stats': image_cache_stats,
+        'llm_stats': llm_stats,
+        'timings': timings,
     }
+    if content_stats is not None:
+        body['content_extraction'] = content_stats
 
     return {
         'statusCode': 200,
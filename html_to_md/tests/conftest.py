@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Lambda のモジュールはフラットに import しているので、関数のディレクトリをパスに追加する
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,98 @@
+import json
+
+import pytest
+
+import annotate_image
+import image_cache
+import image_filter
+
+URLS = ["https://example.com/a.png", "https://example.com/b.png", "https://example.com/c.png"]
+
+
+class FakeResponse:
+    def __init__(self, content):
+        self.content = content
+
+    def json(self):
+        return {"choices": [{"message": {"content": self.content}}]}
+
+
+@pytest.fixture
+def openai(monkeypatch):
+    # OpenAI API を呼ばず、用意した本文を順に返す。送った payload は記録する
+    payloads = []
+    replies = []
+
+    def call(url, payload, headers=None, timeout=None):
+        payloads.append(payload)
+        return FakeResponse(replies.pop(0))
+
+    monkeypatch.setattr(annotate_image.openai_client, "call", call)
+    monkeypatch.setattr(annotate_image, "description_cache", image_cache.ImageDescriptionCache())
+    return payloads, replies
+
+
+def batch_reply(*entries):
+    return json.dumps({"descriptions": [{"index": i, "description": d} for i, d in entries]}, ensure_ascii=False)
+
+
+def infos(urls):
+    return [image_filter.ImageInfo(url, 2048, "digest-" + url[-5]) for url in urls]
+
+
+def test_batch_parses_structured_answer(openai):
+    payloads, replies = openai
+    replies.append(batch_reply((2, "犬の写真"), (1, "猫の写真"), (3, "鳥の写真")))
+    assert annotate_image.describe_images_batch(URLS, "説明して") == {
+        URLS[0]: "猫の写真", URLS[1]: "犬の写真", URLS[2]: "鳥の写真",
+    }
+    # 画像はすべて1つのメッセージにまとめて送る
+    [payload] = payloads
+    content = payload["messages"][0]["content"]
+    assert [part["image_url"]["url"] for part in content if part["type"] == "image_url"] == URLS
+    assert payload["response_format"] == {"type": "json_object"}
+
+
+@pytest.mark.parametrize("reply", [
+    batch_reply((1, "猫の写真")),                                    # 回答が欠けている
+    batch_reply((1, "猫の写真"), (0, "範囲外"), (4, "範囲外")),          # 範囲外の番号
+    batch_reply((1, "猫の写真"), (2, ""), ("3", "番号が文字列")),        # 空の説明・不正な番号
+    json.dumps({"descriptions": [{"index": 1, "description": "猫の写真"}, {"index": 2}]}),
+])
+def test_batch_skips_unusable_items(openai, reply):
+    openai[1].append(reply)
+    assert annotate_image.describe_images_batch(URLS, "説明して") == {URLS[0]: "猫の写真"}
+
+
+@pytest.mark.parametrize("reply", ["画像1は猫です", '{"descriptions": [', ""])
+def test_batch_raises_on_malformed_json(openai, reply):
+    openai[1].append(reply)
+    with pytest.raises(json.JSONDecodeError):
+        annotate_image.describe_images_batch(URLS, "説明して")
+
+
+def test_describe_images_falls_back_for_missing_items(openai):
+    payloads, replies = openai
+    replies.extend([batch_reply((1, "猫の写真")), "犬の写真", "鳥の写真"])
+    results = annotate_image.describe_images(infos(URLS), "説明して")
+    assert results == {URLS[0]: "猫の写真", URLS[1]: "犬の写真", URLS[2]: "鳥の写真"}
+    # 一括で1回、回答が欠けた2枚を1枚ずつ
+    assert len(payloads) == 3
+    assert [p["messages"][0]["content"][1]["image_url"]["url"] for p in payloads[1:]] == URLS[1:]
+    # 生成できた説明文はすべてキャッシュに入る
+    assert annotate_image.description_cache.get_by_hash("digest-" + URLS[2][-5]) == "鳥の写真"
+
+
+def test_describe_images_falls_back_when_batch_is_unreadable(openai):
+    payloads, replies = openai
+    replies.extend(["すみません、JSON では答えられません", "猫の写真", "犬の写真"])
+    results = annotate_image.describe_images(infos(URLS[:2]), "説明して")
+    assert results == {URLS[0]: "猫の写真", URLS[1]: "犬の写真"}
+    assert len(payloads) == 3
+
+
+def test_describe_images_single_image_is_not_batched(openai):
+    payloads, replies = openai
+    replies.append("猫の写真")
+    assert annotate_image.describe_images(infos(URLS[:1]), "説明して") == {URLS[0]: "猫の写真"}
+    assert "response_format" not in payloads[0]
@@ -0,0 +1,135 @@
+import pytest
+from bs4 import BeautifulSoup
+
+import content_extract
+
+PARAGRAPHS = [
+    "新しい電池は、従来品より容量が大きく、充電にかかる時間も半分ほどになった。" * 2,
+    "開発チームによると、材料の配合を見直し、製造工程も一から組み直したという。" * 2,
+    "販売は来年の春からで、まずは国内の量販店、その後に海外でも展開する予定だ。" * 2,
+]
+NAV_LINKS = ["ホーム", "ニュース", "テクノロジー", "お問い合わせ"]
+RELATED = [f"関連記事: 新製品の発表会で語られた今後の計画 その{i}" for i in range(1, 6)]
+FOOTER = "Copyright 2024 Example News. All rights reserved."
+
+PAGE = f"""
+<html>
+<head>
+  <title>新しい電池を発表 | Example News</title>
+  <meta name="description" content="容量が大きく充電の速い電池">
+  <meta property="og:title" content="新しい電池を発表">
+  <meta property="og:site_name" content="Example News">
+  <meta name="author" content="山田 太郎">
+  <meta property="article:published_time" content="2024-04-01T09:00:00+09:00">
+  <link rel="canonical" href="https://news.example.com/articles/123">
+</head>
+<body>
+  <header><nav>{"".join(f'<a href="/{i}">{t}</a>' for i, t in enumerate(NAV_LINKS))}</nav></header>
+  <div class="content-wrapper">
+    <article id="story" class="post">
+      <h1>新しい電池を発表</h1>
+      {"".join(f"<p>{p}</p>" for p in PARAGRAPHS)}
+    </article>
+    <div class="content-list">
+      <ul>{"".join(f'<li><a href="/r{i}">{t}</a></li>' for i, t in enumerate(RELATED))}</ul>
+    </div>
+  </div>
+  <footer><p>{FOOTER}</p></footer>
+  <script>var tracking = "ここは数えない";</script>
+</body>
+</html>
+"""
+
+
+def soup_of(html):
+    return BeautifulSoup(html, "html.parser")
+
+
+def test_measure_text_counts_links_and_skips_scripts():
+    soup = soup_of(PAGE)
+    measures = content_extract.measure_text(soup.body)
+    body = measures[id(soup.body)]
+    texts = ["新しい電池を発表"] + PARAGRAPHS + NAV_LINKS + RELATED + [FOOTER]
+    assert body.chars == sum(len(t) for t in texts)
+    assert body.link_chars == sum(len(t) for t in NAV_LINKS + RELATED)
+    assert body.ascii == len(FOOTER) + sum(len(t.encode("ascii", "ignore")) for t in RELATED)
+    assert id(soup.script) not in measures
+
+
+def test_chooses_article_over_nav_footer_and_link_list():
+    soup = soup_of(PAGE)
+    root, stats = content_extract.extract_main_content(soup)
+    assert root is soup.find("article")
+    assert stats["root"] == "article#story.post"
+
+    article_chars = len("新しい電池を発表") + sum(len(p) for p in PARAGRAPHS)
+    removed = NAV_LINKS + RELATED + [FOOTER]
+    removed_ascii = sum(len(t.encode("ascii", "ignore")) for t in removed)
+    removed_chars = sum(len(t) for t in removed)
+    assert stats["extracted_chars"] == article_chars
+    assert stats["original_chars"] == article_chars + removed_chars
+    assert stats["removed_chars"] == removed_chars
+    assert stats["removed_tokens_estimate"] == removed_ascii // 4 + (removed_chars - removed_ascii)
+
+
+def test_link_heavy_region_is_rejected():
+    # 名前は本文らしくても、ほとんどがリンクの領域は選ばない
+    soup = soup_of(PAGE)
+    measures = content_extract.measure_text(soup.body)
+    link_list = soup.find("div", class_="content-list")
+    m = measures[id(link_list)]
+    assert m.link_chars == m.chars
+    assert content_extract.find_main_content(soup.body, measures) is not link_list
+
+    only_links = soup_of(
+        '<html><body><div class="content"><ul>'
+        + "".join(f'<li><a href="/r{i}">{t}</a></li>' for i, t in enumerate(RELATED))
+        + "</ul></div></body></html>"
+    )
+    measures = content_extract.measure_text(only_links.body)
+    assert content_extract.find_main_content(only_links.body, measures) is None
+    root, stats = content_extract.extract_main_content(only_links)
+    assert root is only_links.body
+    assert (stats["root"], stats["removed_chars"], stats["removed_tokens_estimate"]) == ("body", 0, 0)
+
+
+def test_short_article_falls_back_to_body():
+    # 本文候補が MIN_CONTENT_CHARS に満たなければ body 全体を使う
+    soup = soup_of(
+        '<html><body><nav><a href="/">ホーム</a></nav>'
+        '<article><p>短い本文ですが、段落としては十分な長さがあります。</p></article></body></html>'
+    )
+    root, stats = content_extract.extract_main_content(soup)
+    assert root is soup.body
+    assert stats["removed_chars"] == 0
+
+
+@pytest.mark.parametrize("attrs, expected", [
+    ({"name": "nav"}, -50),
+    ({"name": "article"}, 30),
+    ({"name": "div", "class": "post-body"}, 25),
+    ({"name": "div", "id": "sidebar"}, -25),
+    ({"name": "div", "class": "main-content", "id": "comments"}, 0),
+    ({"name": "div", "class": "ad"}, -25),
+    ({"name": "div", "class": "download"}, 0),
+])
+def test_class_weight(attrs, expected):
+    attrs = dict(attrs)
+    name = attrs.pop("name")
+    node = soup_of("<div></div>").new_tag(name, attrs=attrs)
+    if "class" in attrs:
+        node["class"] = attrs["class"].split()
+    assert content_extract._class_weight(node) == expected
+
+
+def test_extract_metadata():
+    assert content_extract.extract_metadata(soup_of(PAGE)) == {
+        # <title> を og:title より優先する
+        "title": "新しい電池を発表 | Example News",
+        "description": "容量が大きく充電の速い電池",
+        "site_name": "Example News",
+        "author": "山田 太郎",
+        "published_time": "2024-04-01T09:00:00+09:00",
+        "canonical_url": "https://news.example.com/articles/123",
+    }
+    assert content_extract.extract_metadata(soup_of("<html><body></body></html>")) == {}
@@ -0,0 +1,59 @@
+"""
+html_to_blocks の出力を tests/corpus の正解データ（html.parser の出力）と比較する。
+正解データは bench_html_to_blocks.py の --write-golden で作り直せる:
+  python bench_html_to_blocks.py tests/corpus/pages --write-golden tests/corpus/golden
+"""
+import os
+import json
+
+import pytest
+
+import main
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+PAGES = sorted(name for name in os.listdir(os.path.join(CORPUS_DIR, "pages")) if name.endswith(".html"))
+
+
+def load_page(name):
+    path = os.path.join(CORPUS_DIR, "pages", name)
+    with open(path, encoding="utf-8") as f:
+        html = f.read()
+    base_url = "https://example.com/"
+    if os.path.exists(path[:-len(".html")] + ".url"):
+        with open(path[:-len(".html")] + ".url", encoding="utf-8") as f:
+            base_url = f.read().strip()
+    with open(os.path.join(CORPUS_DIR, "golden", name + ".json"), encoding="utf-8") as f:
+        golden = json.load(f)
+    return html, base_url, golden
+
+
+def to_json(blocks):
+    return json.loads(json.dumps(main.blocks_to_json(blocks), ensure_ascii=False))
+
+
+@pytest.mark.parametrize("name", PAGES)
+@pytest.mark.parametrize("parser", main.PARSER_ENGINES)
+def test_matches_golden(name, parser):
+    # 整形式の HTML ではどのパーサでもブロックが一致する
+    html, base_url, golden = load_page(name)
+    assert to_json(main.html_to_blocks(html, base_url, parser=parser)) == golden
+
+
+def test_default_parser_is_html_parser():
+    # 閉じタグの省略などの不正な HTML では lxml とブロックが変わるので、既定は html.parser のまま
+    assert main.DEFAULT_PARSER == "html.parser"
+
+
+@pytest.mark.parametrize("html, expected", [
+    # 閉じタグの無い li: html.parser では入れ子になり 1 件にまとまる
+    ("<ul><li>one<li>two</ul>", [{"type": "list_item", "ordered": False, "text": "onetwo"}]),
+    # 見出しの中の p: html.parser では見出しの中に残る
+    ("<h1>Head<p>para</h1>", [{"type": "heading", "level": 1, "text": "Headpara"}]),
+])
+def test_malformed_html_with_default_parser(html, expected):
+    assert to_json(main.html_to_blocks(f"<html><body>{html}</body></html>", "https://example.com/")) == expected
+
+
+def test_unknown_parser():
+    with pytest.raises(ValueError):
+        main.html_to_blocks("<p>x</p>", "https://example.com/", parser="selectolax")
@@ -0,0 +1,71 @@
+import time
+
+import image_cache
+
+URL = "https://example.com/logo.png"
+DIGEST = image_cache.content_hash(b"logo")
+
+
+def test_url_then_hash_lookup():
+    cache = image_cache.ImageDescriptionCache()
+    assert cache.get_by_url(URL) is None
+    assert cache.get_by_hash(DIGEST, URL) is None
+    cache.put(URL, DIGEST, "ロゴ")
+    assert cache.get_by_url(URL) == "ロゴ"
+    # 同じ画像を別の URL で参照した場合はハッシュで当たり、次からはその URL でも引ける
+    other = "https://cdn.example.com/logo.png"
+    assert cache.get_by_url(other) is None
+    assert cache.get_by_hash(DIGEST, other) == "ロゴ"
+    assert cache.get_by_url(other) == "ロゴ"
+    stats = cache.stats()
+    assert (stats["url_hits"], stats["hash_hits"], stats["misses"], stats["stores"]) == (2, 1, 1, 1)
+
+
+def test_missing_hash_is_a_miss():
+    cache = image_cache.ImageDescriptionCache()
+    cache.put(URL, None, "説明")
+    assert cache.get_by_hash(None, URL) is None
+    assert cache.stats()["misses"] == 1
+
+
+def test_ttl():
+    cache = image_cache.ImageDescriptionCache(ttl=0.05)
+    cache.put(URL, DIGEST, "ロゴ")
+    time.sleep(0.06)
+    assert cache.get_by_url(URL) is None
+    assert cache.get_by_hash(DIGEST) is None
+
+
+def test_lru_evicts_oldest():
+    cache = image_cache.ImageDescriptionCache(max_entries=2)
+    cache.put("https://example.com/a.png", None, "a")
+    cache.put("https://example.com/b.png", None, "b")
+    cache.get_by_url("https://example.com/a.png")
+    cache.put("https://example.com/c.png", None, "c")
+    assert cache.get_by_url("https://example.com/b.png") is None
+    assert cache.get_by_url("https://example.com/a.png") == "a"
+
+
+def test_sqlite_backend_persists_across_instances(tmp_path):
+    path = str(tmp_path / "images.sqlite3")
+    image_cache.ImageDescriptionCache(image_cache.SQLiteBackend(path)).put(URL, DIGEST, "ロゴ")
+    # 新しいコンテナ（空の LRU）でも永続化先から引ける
+    cache = image_cache.ImageDescriptionCache(image_cache.SQLiteBackend(path))
+    assert cache.get_by_hash(DIGEST) == "ロゴ"
+    assert cache.get_by_url(URL) == "ロゴ"
+
+
+def test_backend_errors_are_counted():
+    class BrokenBackend:
+        def get(self, key):
+            raise OSError("unavailable")
+
+        def put(self, key, value, expires_at):
+            raise OSError("unavailable")
+
+    cache = image_cache.ImageDescriptionCache(BrokenBackend())
+    cache.put(URL, DIGEST, "ロゴ")
+    # 書き込みに失敗してもメモリには残る
+    assert cache.get_by_url(URL) == "ロゴ"
+    assert cache.get_by_url("https://example.com/other.png") is None
+    assert cache.stats()["backend_errors"] == 3
@@ -0,0 +1,116 @@
+import io
+import base64
+
+import pytest
+from PIL import Image, ImageDraw
+
+import image_filter
+import annotate_image
+
+
+def data_url(image, image_format="PNG"):
+    buffer = io.BytesIO()
+    image.save(buffer, image_format)
+    return f"data:image/{image_format.lower()};base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+def photo(width, height, variant=0):
+    # 左右のグラデーションに図形を重ねた画像。variant ごとに図形の配置が変わる
+    image = Image.new("RGB", (width, height))
+    draw = ImageDraw.Draw(image)
+    for x in range(width):
+        shade = int(255 * x / width)
+        draw.line([(x, 0), (x, height)], fill=(shade, 80 + variant * 40, 255 - shade))
+    if variant == 0:
+        draw.ellipse((width * 0.1, height * 0.2, width * 0.5, height * 0.8), fill=(250, 250, 250))
+        draw.rectangle((width * 0.6, height * 0.1, width * 0.9, height * 0.4), fill=(10, 10, 10))
+    else:
+        draw.rectangle((0, height * 0.5, width, height), fill=(0, 0, 0))
+        draw.ellipse((width * 0.55, height * 0.05, width * 0.95, height * 0.45), fill=(255, 255, 0))
+    return image
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+@pytest.fixture
+def images():
+    original = photo(240, 180)
+    return {
+        "pixel": data_url(Image.new("RGB", (1, 1), (255, 255, 255))),
+        "large": data_url(original),
+        "small": data_url(original.resize((120, 90), Image.LANCZOS)),
+        "distinct": data_url(photo(240, 180, variant=1)),
+        "banner": data_url(photo(400, 30)),
+    }
+
+
+def test_inspect_image(images):
+    info = image_filter.inspect_image(images["large"])
+    assert (info.width, info.height) == (240, 180)
+    assert info.size > image_filter.MIN_IMAGE_BYTES
+    assert len(info.digest) == 64 and info.phash is not None
+
+
+def test_junk_thresholds(images):
+    pixel = image_filter.inspect_image(images["pixel"])
+    assert pixel.size < image_filter.MIN_IMAGE_BYTES
+    assert image_filter.is_junk(pixel)
+    # バイト数は十分でも、高さが MIN_IMAGE_DIMENSION 未満ならアイコン類として捨てる
+    banner = image_filter.inspect_image(images["banner"])
+    assert banner.size >= image_filter.MIN_IMAGE_BYTES and banner.height < image_filter.MIN_IMAGE_DIMENSION
+    assert image_filter.is_junk(banner)
+    assert not image_filter.is_junk(image_filter.inspect_image(images["large"]))
+    # Pillow で読めない（SVG など）画像はバイト数だけで判定する
+    assert not image_filter.is_junk(image_filter.ImageInfo("a.svg", 2048, "x"))
+
+
+def test_dhash_distance(images):
+    large = image_filter.inspect_image(images["large"])
+    small = image_filter.inspect_image(images["small"])
+    distinct = image_filter.inspect_image(images["distinct"])
+    assert large.digest != small.digest
+    assert hamming(large.phash, small.phash) <= image_filter.PHASH_MAX_DISTANCE
+    assert hamming(large.phash, distinct.phash) > image_filter.PHASH_MAX_DISTANCE
+
+
+def test_prefilter_groups_resized_copies(images):
+    urls = [images["small"], images["pixel"], images["large"], images["distinct"], images["banner"]]
+    representatives, aliases, dropped = image_filter.prefilter_images(urls)
+    # 解像度の高い方を代表にし、縮小版はその別名にする
+    assert [info.url for info in representatives] == [images["large"], images["distinct"]]
+    assert aliases == {images["small"]: images["large"]}
+    assert dropped == {images["pixel"], images["banner"]}
+
+
+def test_prefilter_groups_identical_bytes():
+    payload = base64.b64encode(b"<svg>" + b" " * 1024 + b"</svg>").decode("ascii")
+    first = "data:image/svg+xml;base64," + payload
+    second = "data:image/svg+xml;charset=utf-8;base64," + payload
+    representatives, aliases, dropped = image_filter.prefilter_images([first, second])
+    # 同じ内容なら、Pillow で読めなくても内容ハッシュでまとめる
+    assert [info.url for info in representatives] == [first]
+    assert aliases == {second: first}
+    assert dropped == set()
+
+
+def test_unreachable_images_are_kept(monkeypatch):
+    monkeypatch.setattr(image_filter, "fetch_image_bytes", lambda url: None)
+    representatives, aliases, dropped = image_filter.prefilter_images(["https://example.com/a.png"])
+    assert [(info.url, info.digest) for info in representatives] == [("https://example.com/a.png", None)]
+    assert (aliases, dropped) == ({}, set())
+
+
+def test_annotate_fans_out_to_aliases():
+    blocks = [
+        {"type": "image", "src": "https://example.com/large.png", "alt": "製品"},
+        {"type": "text", "text": "本文"},
+        {"type": "image", "src": "https://example.com/small.png"},
+        {"type": "image", "src": "https://example.com/pixel.gif", "alt": "spacer"},
+    ]
+    annotated = annotate_image.annotate_blocks_with_descriptions(
+        blocks, {"https://example.com/large.png": "白い製品の写真"},
+        {"https://example.com/small.png": "https://example.com/large.png"},
+    )
+    assert [block.get("alt") for block in annotated] == ["製品 白い製品の写真", None, "白い製品の写真", "spacer"]
@@ -0,0 +1,148 @@
+import os
+import re
+import time
+import json
+import hashlib
+import threading
+import unicodedata
+import requests
+
+import kv_store
+
+# 保存先: memory / sqlite / dynamodb / none
+ANALYSIS_CACHE_BACKEND = os.environ.get(
+    "ANALYSIS_CACHE_BACKEND", "sqlite" if kv_store.LOCAL_ENV else "memory"
+).lower()
+ANALYSIS_CACHE_TTL_SECONDS = int(os.environ.get("ANALYSIS_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+
+_SPACE_PATTERN = re.compile(r'\s+')
+
+
+def normalize_query(query):
+    # 全角・半角の違いと空白の違いだけのクエリは同じものとして扱う
+    return _SPACE_PATTERN.sub(' ', unicodedata.normalize('NFKC', query)).strip()
+
+
+def analysis_key(query, article, images, model):
+    """
+    (正規化したクエリ, 記事部分, スクショ, モデル名) のハッシュ。
+    images: [(MIMEタイプ, base64), ...]
+    """
+    digest = hashlib.sha256()
+    for part in (model, normalize_query(query), article):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    for mime_type, b64 in images:
+        digest.update(mime_type.encode("utf-8"))
+        digest.update(hashlib.sha256(b64.encode("ascii")).digest())
+    return "analysis:" + digest.hexdigest()
+
+
+class AnalysisCache:
+    """
+    Gemini の解析結果のキャッシュ。同じクエリ・記事・スクショ・モデルなら Gemini を呼ばずに前回の結果を返す。
+    失敗した呼び出しの結果は保存しない。
+    """
+
+    def __init__(self, backend, ttl=ANALYSIS_CACHE_TTL_SECONDS):
+        self.backend = backend
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.counters = {"lookups": 0, "hits": 0, "misses": 0, "stores": 0, "backend_errors": 0}
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def get(self, key):
+        if self.backend is None:
+            return None
+        self._count("lookups")
+        try:
+            entry = self.backend.get(key)
+        except Exception as e:
+            print(f"解析キャッシュの読み込みに失敗しました: {e}")
+            self._count("backend_errors")
+            entry = None
+        if entry is None or kv_store.is_expired(entry):
+            self._count("misses")
+            return None
+        self._count("hits")
+        return entry[0]["gemini_text"]
+
+    def put(self, key, gemini_text):
+        if self.backend is None or gemini_text is None:
+            return
+        try:
+            self.backend.put(key, {"gemini_text": gemini_text, "stored_at": time.time()}, time.time() + self.ttl)
+            self._count("stores")
+        except Exception as e:
+            print(f"解析キャッシュの書き込みに失敗しました: {e}")
+            self._count("backend_errors")
+
+
+class GeminiContextCache:
+    """
+    Gemini の cachedContents に、ジョブ内の全URLで共通する先頭部分（分析の指示）を1回だけ登録する。
+    以降のリクエストは cachedContent の名前を渡し、共通部分の入力トークンを送らずに済ませる。
+    共通部分がモデルの最小トークン数に満たない場合などは登録に失敗するので、呼び出し側は通常の送り方に戻す。
+    """
+
+    def __init__(self, client, api_key, base_url="https://generativelanguage.googleapis.com/v1beta"):
+        self.client = client
+        self.api_key = api_key
+        self.base_url = base_url
+
+    def create(self, model, text, ttl_seconds):
+        payload = {
+            "model": f"models/{model}",
+            "contents": [{"role": "user", "parts": [{"text": text}]}],
+            "ttl": f"{int(ttl_seconds)}s",
+        }
+        response = self.client.call(f"{self.base_url}/cachedContents?key={self.api_key}", payload,
+                                    headers={"Content-Type": "application/json"})
+        return response.json()["name"]
+
+    def delete(self, name):
+        # LLMClient は POST しか持たないので、削除だけは requests で送る
+        requests.delete(f"{self.base_url}/{name}?key={self.api_key}", timeout=10)
+
+
+class StubContextCache:
+    """
+    オフラインのテスト・ベンチマーク用。API を呼ばずに名前だけを払い出し、登録・削除の回数を数える。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.contents = {}
+        self.counters = {"created": 0, "deleted": 0}
+
+    def create(self, model, text, ttl_seconds):
+        name = "cachedContents/stub-" + hashlib.sha256(json.dumps([model, text]).encode("utf-8")).hexdigest()[:16]
+        with self.lock:
+            self.contents[name] = text
+            self.counters["created"] += 1
+        return name
+
+    def delete(self, name):
+        with self.lock:
+            self.contents.pop(name, None)
+            self.counters["deleted"] += 1
+
+
+def create_cache():
+    try:
+        backend = kv_store.create_backend(
+            ANALYSIS_CACHE_BACKEND,
+            sqlite_path=os.environ.get("ANALYSIS_CACHE_SQLITE_PATH", "/tmp/analysis_cache.sqlite3"),
+            table_name=os.environ.get("ANALYSIS_CACHE_TABLE_NAME"),
+        )
+    except Exception as e:
+        print(f"解析キャッシュの保存先を初期化できないため、メモリのみで動かします: {e}")
+        backend = kv_store.MemoryBackend()
+    return AnalysisCache(backend)
@@ -0,0 +1,131 @@
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# 各ステップの関数は lambda_function に定義されている（呼び出し時に参照する）
+import lambda_function as pipeline
+import tracing
+
+# ステージごとの同時実行数のデフォルト
+# fetch: Selenium Lambda の呼び出し / convert: html_to_md Lambda の呼び出しと S3 からの画像取得
+# llm: Gemini API の呼び出し（DynamoDB へのログは log_writer がまとめて書き込むのでステージを持たない）
+DEFAULT_STAGE_LIMITS = {
+    "fetch":   int(os.environ.get("ASYNC_FETCH_CONCURRENCY", "20")),
+    "convert": int(os.environ.get("ASYNC_CONVERT_CONCURRENCY", "20")),
+    "llm":     int(os.environ.get("ASYNC_LLM_CONCURRENCY", "10")),
+}
+
+
+def stage_limits_from(event):
+    """
+    event の stage_concurrency（例: {"llm": 5}）でデフォルトの同時実行数を上書きする。
+    """
+    limits = dict(DEFAULT_STAGE_LIMITS)
+    for stage, value in (event.get("stage_concurrency") or {}).items():
+        if stage in limits:
+            limits[stage] = max(1, int(value))
+    return limits
+
+
+class StageRunner:
+    """
+    boto3 / requests のブロッキング呼び出しを、ステージごとのセマフォで同時実行数を絞りながら
+    共有のスレッドプールで実行する。スレッド数は各ステージの上限の合計までに抑えられる。
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.semaphores = {stage: asyncio.Semaphore(limit) for stage, limit in limits.items()}
+        self.executor = ThreadPoolExecutor(max_workers=sum(limits.values()))
+
+    async def run(self, stage, func, *args):
+        async with self.semaphores[stage]:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, func, *args)
+
+    async def timed(self, timings, name, stage, func, *args, url=None):
+        # run と同じだが、セマフォの待ちを含めた所要秒数をスパンとして記録し、timings[name] にも入れる
+        with tracing.span(name, timings, url=url, stage=stage):
+            return await self.run(stage, func, *args)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+async def process_url_async(runner, url, query, userid, options, html_resp=None):
+    """
+    process_single_url と同じ処理を、ステージごとの並列数の制御付きで行う。
+    Markdown 変換とスクリーンショットの取得は互いに依存しないので同時に進める。
+    """
+    # ステップごとの所要秒数（結果とログに残す）
+    timings = {}
+    # 1) Lambdaを呼び出してHTML＋スクショ取得（まとめて取得済みの場合はそれを使う）
+    if html_resp is None:
+        html_resp = await runner.timed(timings, "fetch", "fetch", pipeline.fetch_page, url, options, url=url)
+    pipeline.add_fetch_timings(timings, html_resp)
+
+    if not pipeline.page_fetched(html_resp):
+        return dict(pipeline.html_failed_result(url, html_resp), timings=timings)
+    print(f"HTML and screenshot fetched for {url}")
+
+    # 2) Markdown変換（URLキャッシュにあれば変換しない）と 3) S3からの画像取得 を並行して行う
+    (markdown, content_extraction), screenshot_images = await asyncio.gather(
+        runner.timed(timings, "convert", "convert", pipeline.markdown_for_page, url, html_resp, options, timings,
+                     url=url),
+        runner.timed(timings, "images", "convert", pipeline.fetch_screenshot_images, html_resp, url, url=url),
+    )
+
+    # 4) Gemini APIを呼び出してテキスト生成
+    analysis = await runner.timed(
+        timings, "analyze", "llm", pipeline.analyze_article, url, query, markdown, screenshot_images, options,
+        url=url,
+    )
+
+    # 5) DynamoDBへのログ（バッファに入れるだけなので待たない）と 6) 結果のマージは process_single_url と共通
+    return pipeline.finish_url(url, userid, html_resp, markdown, content_extraction, analysis, timings)
+
+
+async def _process_or_error(runner, url, query, userid, options, html_resp=None, on_result=None):
+    try:
+        result = await process_url_async(runner, url, query, userid, options, html_resp)
+    except Exception as e:
+        result = pipeline.error_result(url, e)
+    if on_result is None:
+        return result
+    # 完了したものから渡し、結果は保持しない
+    on_result(result)
+    return None
+
+
+async def _process_batch(runner, batch, query, userid, options, on_result=None):
+    # 1つのSelenium Lambdaでまとめて取得し、取得できたものからURLごとの後続処理に進む
+    try:
+        pages = await runner.run("fetch", pipeline.fetch_pages_batch, batch, options)
+    except Exception as e:
+        print(f"まとめて取得に失敗したため、URLごとに取得します: {e}")
+        pages = {}
+    return await asyncio.gather(*(
+        _process_or_error(runner, url, query, userid, options, pages.get(url), on_result) for url in batch
+    ))
+
+
+async def run_urls(urls, query, userid, options, limits=None, batch_size=1, on_result=None):
+    """
+    全URLをコルーチンとして同時に投入する。URLが数百件あってもスレッド数はステージの上限の合計まで。
+    戻り値は urls と同じ順の結果のリスト。
+    on_result を渡すと、完了したURLから順に結果を渡して保持しない（戻り値は空のリスト）。
+    """
+    runner = StageRunner(limits or DEFAULT_STAGE_LIMITS)
+    try:
+        if batch_size > 1:
+            batches = [urls[i:i + batch_size] for i in range(0, len(urls), batch_size)]
+            grouped = await asyncio.gather(*(
+                _process_batch(runner, batch, query, userid, options, on_result) for batch in batches
+            ))
+            return [result for results in grouped for result in results if result is not None]
+        results = await asyncio.gather(*(
+            _process_or_error(runner, url, query, userid, options, on_result=on_result) for url in urls
+        ))
+        return [result for result in results if result is not None]
+    finally:
+        runner.close()
@@ -0,0 +1,137 @@
+"""
+LLM API の呼び出しを、毎回新しい接続を張る requests.post と、接続プールを使う LLMClient で比較するスクリプト。
+ローカルにスタブサーバを立て、応答までの遅延（--delay）と接続確立の遅延（--handshake-delay、TLS ハンドシェイク相当）を再現する。
+--certfile/--keyfile を渡すと実際に TLS で計測する。
+
+使い方:
+  python bench_llm_client.py                                  # 200回・並列10で比較
+  python bench_llm_client.py --calls 500 --concurrency 20 --handshake-delay 0.05
+  python bench_llm_client.py --certfile cert.pem --keyfile key.pem
+"""
+import ssl
+import sys
+import socket
+import json
+import time
+import argparse
+import threading
+import statistics
+import urllib3
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import llm_client
+
+RESPONSE = json.dumps({"candidates": [{"content": {"parts": [{"text": "ok"}]}}]}).encode("utf-8")
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, delay, handshake_delay):
+        super().__init__(address, StubHandler)
+        self.delay = delay
+        self.handshake_delay = handshake_delay
+        self.connections = 0
+        self.lock = threading.Lock()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive を有効にする
+
+    def setup(self):
+        super().setup()
+        # ヘッダと本文の2回の書き込みが遅延ACKで待たされないようにする
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.lock:
+            self.server.connections += 1
+        # 新しい接続ごとに、DNS・TCP・TLS の確立にかかる時間を再現する
+        time.sleep(self.server.handshake_delay)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.server.delay)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(args):
+    server = StubServer(("127.0.0.1", 0), args.delay, args.handshake_delay)
+    scheme = "http"
+    if args.certfile:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(args.certfile, args.keyfile)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = "https"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"{scheme}://127.0.0.1:{server.server_address[1]}/v1/generate"
+
+
+def run(call, calls, concurrency):
+    def timed(_):
+        start = time.perf_counter()
+        response = call()
+        response.raise_for_status()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(timed, range(calls)))
+    return latencies, time.perf_counter() - start
+
+
+def report(name, latencies, elapsed, connections):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{name:<14} {statistics.mean(latencies) * 1000:>9.1f} {statistics.median(latencies) * 1000:>9.1f} "
+          f"{p95 * 1000:>9.1f} {len(latencies) / elapsed:>9.1f} {connections:>7}")
+    return statistics.mean(latencies)
+
+
+def main_cli():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--calls", type=int, default=200)
+    ap.add_argument("--concurrency", type=int, default=10)
+    ap.add_argument("--delay", type=float, default=0.02, help="スタブの応答遅延（秒）")
+    ap.add_argument("--handshake-delay", type=float, default=0.03, help="新しい接続ごとの遅延（秒）")
+    ap.add_argument("--certfile")
+    ap.add_argument("--keyfile")
+    args = ap.parse_args()
+    if args.certfile:
+        urllib3.disable_warnings()
+
+    server, url = start_server(args)
+    payload = {"contents": [{"parts": [{"text": "x" * 2000}]}]}
+    verify = not args.certfile  # 自己署名証明書を想定
+
+    print(f"{args.calls}回 / 並列{args.concurrency} / 応答遅延 {args.delay * 1000:.0f}ms / "
+          f"接続確立 {args.handshake_delay * 1000:.0f}ms")
+    print(f"{'client':<14} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'calls/s':>9} {'conns':>7}")
+
+    server.connections = 0
+    latencies, elapsed = run(
+        lambda: requests.post(url, json=payload, timeout=(5, 60), verify=verify), args.calls, args.concurrency
+    )
+    bare = report("requests.post", latencies, elapsed, server.connections)
+
+    client = llm_client.LLMClient(pool_size=args.concurrency)
+    client._get_session().verify = verify
+    server.connections = 0
+    latencies, elapsed = run(lambda: client.post(url, payload), args.calls, args.concurrency)
+    pooled = report("LLMClient", latencies, elapsed, server.connections)
+    client.close()
+
+    print(f"1回あたりの短縮: {(bare - pooled) * 1000:.1f} ms")
+    server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
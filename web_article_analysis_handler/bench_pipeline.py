@@ -0,0 +1,595 @@
+"""
+lambda_handler から Selenium / html_to_md Lambda・Gemini・OpenAI までのパイプライン全体を、
+外部サービス無しで計測するスクリプト。デプロイ前に処理性能の劣化を見つけるために使う。
+
+- 入力は保存しておいた HTML（*.html）のディレクトリ。<名前>.url があればその中身を base_url に、
+  <名前>.png / .jpg / .webp があればスクショに使う（無ければ共通のダミー画像）。
+- Gemini・OpenAI はローカルのスタブサーバで代用する。応答の遅延（--gemini-latency / --openai-latency）と
+  429 を返す割合（--rate-429）を指定できる。記事内の画像もスタブサーバから返す。
+- Lambda の呼び出しは同じプロセス内の関数呼び出し（Selenium は保存した HTML を返すだけ、html_to_md は main.handler）、
+  S3 はメモリ、DynamoDB は log_writer の LocalTable、成果物は artifact_store の local で代用する。
+
+lambda_handler・html_to_md.handler・generate_image_descriptions のそれぞれについて、
+1秒あたりの処理件数、ステップごとの p50 / p95 / p99、ピークメモリ（tracemalloc）を表示する。
+
+boto3 は不要。インストールされていなければ、import だけ通るダミーの boto3 を入れて動かす
+（S3・Lambda・DynamoDB はすべて上のローカルの代わりを使うので、boto3 のクライアントは呼ばれない）。
+必要なのは requests・Pillow と html_to_md の依存（beautifulsoup4 など）だけ。
+
+使い方:
+  python bench_pipeline.py                                          # リポジトリ内のコーパス（tests/corpus/pages）で計測
+  python bench_pipeline.py --baseline tests/corpus/baseline.json    # 同梱の基準値と比較
+  python bench_pipeline.py --json tests/corpus/baseline.json        # 基準値を作り直す（計測するマシンが変わったとき）
+  python bench_pipeline.py pages/                                   # 100URL・threads モードで計測
+  python bench_pipeline.py pages/ --urls 300 --mode async --rate-429 0.05
+  python bench_pipeline.py pages/ --json result.json                 # 結果を保存
+  python bench_pipeline.py pages/ --baseline result.json            # 保存した結果より一定以上遅ければ終了コード1
+"""
+import io
+import os
+import re
+import sys
+import json
+import math
+import time
+import random
+import hashlib
+import argparse
+import tempfile
+import threading
+import importlib
+import importlib.util
+import contextlib
+import statistics
+import tracemalloc
+import types
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+HTML_TO_MD_DIR = os.path.join(os.path.dirname(HERE), "html_to_md")
+# リポジトリ内のコーパス。baseline.json はこれを既定の引数で計測した結果
+CORPUS_DIR = os.path.join(HERE, "tests", "corpus")
+
+SCREENSHOT_TYPES = {".png": "image/png", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".webp": "image/webp"}
+IMG_TAG_PATTERN = re.compile(r"<img\b[^>]*>", re.IGNORECASE)
+# src と data-*src*（遅延読み込み）の値を書き換える
+IMG_SRC_PATTERN = re.compile(r"""(\s(?:data-[\w-]*src[\w-]*|src)\s*=\s*)(["'])(.*?)\2""", re.IGNORECASE)
+BUCKET = "bench"
+# compare でこれ以下の増加は揺らぎとして扱う
+MIN_STAGE_DELTA_MS = 20
+MIN_PEAK_DELTA_MB = 1
+
+
+# ---------- LLM のスタブサーバ ----------
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, args):
+        super().__init__(address, StubHandler)
+        self.latency = {"gemini": args.gemini_latency, "openai": args.openai_latency}
+        self.rate_429 = args.rate_429
+        self.retry_after = args.retry_after
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.images = {}
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def image(self, path):
+        # パスごとに内容の違う画像を返す（同じパスなら同じ内容）
+        with self.lock:
+            data = self.images.get(path)
+        if data is None:
+            data = make_image(path, 320, 240, "PNG")
+            with self.lock:
+                self.images[path] = data
+        return data
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive を有効にする
+
+    def do_GET(self):
+        if not self.path.startswith("/images/"):
+            return self._send(404, b"{}")
+        self.server.count("image")
+        self._send(200, self.server.image(self.path), "image/png")
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if "/chat/completions" in self.path:
+            provider, response = "openai", openai_response(body)
+        elif "/cachedContents" in self.path:
+            provider, response = "gemini", {"name": f"cachedContents/bench-{random.getrandbits(32):08x}"}
+        else:
+            provider, response = "gemini", gemini_response(body)
+        self.server.count(f"{provider}.requests")
+        # 一定の割合で 429 を返し、Retry-After で待たせる
+        if random.random() < self.server.rate_429:
+            self.server.count(f"{provider}.429")
+            return self._send(429, b'{"error": "rate limited"}',
+                              headers={"retry-after-ms": str(int(self.server.retry_after * 1000))})
+        latency = self.server.latency[provider]
+        time.sleep(random.uniform(latency * 0.5, latency * 1.5))
+        self._send(200, json.dumps(response, ensure_ascii=False).encode("utf-8"))
+
+    def _send(self, status, data, content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def openai_response(body):
+    content = body["messages"][0]["content"]
+    images = sum(1 for part in content if part.get("type") == "image_url")
+    if body.get("response_format", {}).get("type") == "json_object":
+        text = json.dumps({"descriptions": [
+            {"index": i, "description": f"ベンチマーク用の画像{i}の説明文です。"} for i in range(1, images + 1)
+        ]}, ensure_ascii=False)
+    else:
+        text = "ベンチマーク用の画像の説明文です。"
+    return {"choices": [{"message": {"content": text}}]}
+
+
+def gemini_response(body):
+    text = json.dumps({"summary": "ベンチマーク用の解析結果です。", "score": 3}, ensure_ascii=False)
+    return {"candidates": [{"content": {"parts": [{"text": text}]}}]}
+
+
+def make_image(seed, width, height, image_format):
+    # seed ごとに異なるノイズ画像（重複画像としてまとめられないようにする）
+    from PIL import Image
+    rng = random.Random(seed)
+    image = Image.frombytes("RGB", (width, height), rng.randbytes(width * height * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, image_format)
+    return buffer.getvalue()
+
+
+def start_server(args):
+    server = StubServer(("127.0.0.1", 0), args)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# ---------- S3・Lambda の代わり ----------
+
+class LocalS3:
+    """s3 クライアントの代わり。オブジェクトをメモリに置く。"""
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = Body if isinstance(Body, bytes) else Body.encode("utf-8")
+
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+
+class LocalLambda:
+    """lambda クライアントの代わり。FunctionName ごとの関数を同じプロセス内で呼び、JSON で受け渡す。"""
+
+    def __init__(self, functions):
+        self.functions = functions
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        result = self.functions[FunctionName](json.loads(Payload), None)
+        return {"Payload": io.BytesIO(json.dumps(result, ensure_ascii=False).encode("utf-8"))}
+
+
+class SeleniumStandIn:
+    """
+    Selenium Lambda の代わり。ブラウザは使わず、URLに対応する保存済みの HTML とスクショを
+    Selenium Lambda と同じ形の応答で返す。--selenium-latency でページの読み込み時間を再現する。
+    """
+
+    def __init__(self, pages, s3, latency):
+        self.pages = pages    # URL → Page
+        self.s3 = s3
+        self.latency = latency
+
+    def handler(self, event, context):
+        urls = event.get("urls")
+        results = [self.capture(url, event) for url in (urls or [event.get("url")])]
+        return {"statusCode": 200, "body": json.dumps(results if urls else results[0], ensure_ascii=False)}
+
+    def capture(self, url, event):
+        import artifact_store
+        start = time.perf_counter()
+        if self.latency:
+            time.sleep(random.uniform(self.latency * 0.5, self.latency * 1.5))
+        page = self.pages[url]
+        html = page.html_for(url)
+        data = html.encode("utf-8")
+        return {
+            "url": url,
+            "screenshot_url": f"https://{BUCKET}.s3.amazonaws.com/{page.screenshot_key}",
+            "cropped_screenshot_url": f"https://{BUCKET}.s3.amazonaws.com/{page.screenshot_key}",
+            "html": artifact_store.pack(html, "html", event.get("artifact_inline_max_bytes")),
+            "blocks": None,
+            "screenshot_s3_key": page.screenshot_key,
+            "model_screenshot_s3_keys": [page.screenshot_key],
+            "model_screenshot_mime_type": page.screenshot_mime_type,
+            "content_sha256": hashlib.sha256(data).hexdigest(),
+            "content_bytes": len(data),
+            "timings": {"page_load": round(time.perf_counter() - start, 3), "cold_start": False},
+        }
+
+
+class _Boto3Unavailable:
+    """boto3 が無い環境で、モジュールの読み込み時に作られるクライアントの代わり。使われたらエラーにする。"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        raise RuntimeError(f"boto3 がインストールされていないため {self.name}.{attr} は使えません")
+
+
+def install_boto3_stand_in():
+    """
+    lambda_function はモジュールの読み込み時に boto3 のクライアントを作るので、boto3 が無ければ
+    ダミーのモジュールを入れて import を通す。クライアントはベンチでローカルの代わりに差し替える。
+    """
+    if importlib.util.find_spec("boto3") is not None:
+        return False
+    boto3 = types.ModuleType("boto3")
+    boto3.client = lambda name, *args, **kwargs: _Boto3Unavailable(f"client('{name}')")
+    boto3.resource = lambda name, *args, **kwargs: _Boto3Unavailable(f"resource('{name}')")
+    sys.modules["boto3"] = boto3
+    return True
+
+
+# ---------- 入力 ----------
+
+class Page:
+    def __init__(self, name, html, base_url, screenshot_key, screenshot_mime_type, image_base, shared_images):
+        self.name = name
+        self.html = html
+        self.base_url = base_url
+        self.screenshot_key = screenshot_key
+        self.screenshot_mime_type = screenshot_mime_type
+        self.image_base = image_base
+        self.shared_images = shared_images
+
+    def html_for(self, url):
+        """
+        記事内の画像の URL をスタブサーバに向けた HTML。
+        shared_images でなければ URL ごとに別の画像にする（画像キャッシュに当たらない状態を計測する）。
+        """
+        scope = self.name if self.shared_images else hashlib.sha1(url.encode("utf-8")).hexdigest()[:12]
+
+        def rewrite_src(match):
+            digest = hashlib.sha1(match.group(3).encode("utf-8")).hexdigest()[:12]
+            return f"{match.group(1)}{match.group(2)}{self.image_base}/images/{scope}/{digest}.png{match.group(2)}"
+
+        return IMG_TAG_PATTERN.sub(lambda tag: IMG_SRC_PATTERN.sub(rewrite_src, tag.group(0)), self.html)
+
+
+def load_pages(page_dir, s3, image_base, shared_images):
+    pages = []
+    default_screenshot = None
+    for name in sorted(os.listdir(page_dir)):
+        if not name.endswith(".html"):
+            continue
+        stem = os.path.join(page_dir, name[:-len(".html")])
+        with open(stem + ".html", encoding="utf-8", errors="replace") as f:
+            html = f.read()
+        base_url = f"https://example.com/{name}"
+        if os.path.exists(stem + ".url"):
+            with open(stem + ".url", encoding="utf-8") as f:
+                base_url = f.read().strip()
+
+        key, mime_type = None, None
+        for ext, candidate in SCREENSHOT_TYPES.items():
+            if os.path.exists(stem + ext):
+                key, mime_type = f"live/{name}{ext}", candidate
+                with open(stem + ext, "rb") as f:
+                    s3.put_object(Bucket=BUCKET, Key=key, Body=f.read())
+                break
+        if key is None:
+            # スクショが無いページは、縮小後のスクショと同程度の大きさのダミー画像を使う
+            if default_screenshot is None:
+                default_screenshot = "live/default.jpg"
+                s3.put_object(Bucket=BUCKET, Key=default_screenshot, Body=make_image("screenshot", 768, 1024, "JPEG"))
+            key, mime_type = default_screenshot, "image/jpeg"
+        pages.append(Page(name, html, base_url, key, mime_type, image_base, shared_images))
+    return pages
+
+
+# ---------- 集計 ----------
+
+def percentile(values, q):
+    # 最近傍順位法
+    values = sorted(values)
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+def flatten_timings(timings, prefix=""):
+    # {"fetch": 0.1, "html_to_md": {"html_to_blocks": 0.02}} → {"fetch": 0.1, "html_to_md.html_to_blocks": 0.02}
+    flat = {}
+    for name, value in (timings or {}).items():
+        if isinstance(value, dict):
+            flat.update(flatten_timings(value, f"{prefix}{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + name] = value
+    return flat
+
+
+def summarize(count, elapsed, samples, peak_bytes):
+    """samples: [{ステップ名: 秒数}, ...]"""
+    stages = {}
+    for sample in samples:
+        for name, seconds in sample.items():
+            stages.setdefault(name, []).append(seconds)
+    return {
+        "count": count,
+        "elapsed_seconds": round(elapsed, 3),
+        "per_second": round(count / elapsed, 2) if elapsed else None,
+        "peak_mb": round(peak_bytes / 1024 / 1024, 1) if peak_bytes is not None else None,
+        "stages": {
+            name: {
+                "p50_ms": round(percentile(values, 0.50) * 1000, 1),
+                "p95_ms": round(percentile(values, 0.95) * 1000, 1),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 1),
+                "mean_ms": round(statistics.mean(values) * 1000, 1),
+            }
+            for name, values in stages.items()
+        },
+    }
+
+
+def measure(run, with_memory):
+    """
+    run() を2回実行する。1回目で処理時間を、2回目で tracemalloc のピークメモリを計測する
+    （tracemalloc を有効にすると遅くなるので分ける）。
+    戻り値: (1回目の run の戻り値, 経過秒数, ピークのバイト数)
+    """
+    start = time.perf_counter()
+    result = run()
+    elapsed = time.perf_counter() - start
+    peak = None
+    if with_memory:
+        tracemalloc.start()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+@contextlib.contextmanager
+def quiet(enabled):
+    # パイプラインのログを捨てる（端末への出力が計測結果に影響しないようにする）
+    if not enabled:
+        yield
+        return
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def print_report(name, unit, report):
+    peak = f"{report['peak_mb']:.1f} MB" if report["peak_mb"] is not None else "-"
+    print(f"\n[{name}] {report['count']}{unit} / {report['elapsed_seconds']:.2f}秒 / "
+          f"{report['per_second']} {unit}/秒 / ピークメモリ {peak}")
+    print(f"  {'step':<40} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for stage, values in report["stages"].items():
+        print(f"  {stage:<40} {values['p50_ms']:>9.1f} {values['p95_ms']:>9.1f} {values['p99_ms']:>9.1f}")
+
+
+def compare(baseline, current, max_regression):
+    """
+    前回の結果と比べ、1秒あたりの件数・p95・ピークメモリが max_regression（割合）を超えて悪化した項目を返す。
+    短いステップは揺らぎが大きいので、p95 が 5ms 未満のものは比べない。
+    小さいコーパスでは数 ms・数百 KB の揺らぎでも割合が大きくなるので、
+    p95 は MIN_STAGE_DELTA_MS、ピークメモリは MIN_PEAK_DELTA_MB を超えて増えた場合だけ劣化とする。
+    """
+    regressions = []
+    for target, report in current.items():
+        before = baseline.get(target)
+        if not before:
+            continue
+        if before.get("per_second") and report["per_second"] < before["per_second"] * (1 - max_regression):
+            regressions.append(f"{target}: {before['per_second']} → {report['per_second']} 件/秒")
+        if (before.get("peak_mb") and report["peak_mb"]
+                and report["peak_mb"] > before["peak_mb"] * (1 + max_regression)
+                and report["peak_mb"] - before["peak_mb"] > MIN_PEAK_DELTA_MB):
+            regressions.append(f"{target}: ピークメモリ {before['peak_mb']} → {report['peak_mb']} MB")
+        for stage, values in report["stages"].items():
+            old = before.get("stages", {}).get(stage)
+            if (old and old["p95_ms"] >= 5 and values["p95_ms"] > old["p95_ms"] * (1 + max_regression)
+                    and values["p95_ms"] - old["p95_ms"] > MIN_STAGE_DELTA_MS):
+                regressions.append(f"{target}.{stage}: p95 {old['p95_ms']} → {values['p95_ms']} ms")
+    return regressions
+
+
+# ---------- 計測対象 ----------
+
+def bench_lambda_handler(pipeline, pages, args):
+    # URL ごとに別の URL にして、同じページを何度も処理する
+    urls = [f"{pages[i % len(pages)].base_url}#bench-{i}" for i in range(args.urls)]
+    event = {
+        "urls": urls,
+        "query": "この記事の要点と想定読者を JSON で答えてください。",
+        "mode": args.mode,
+        "selenium_batch_size": args.batch_size,
+        "url_cache": args.with_cache,
+        "analysis_cache": args.with_cache,
+    }
+
+    def run():
+        with quiet(not args.verbose):
+            response = pipeline.lambda_handler(event, None)
+        return json.loads(response["body"])
+
+    results, elapsed, peak = measure(run, not args.skip_memory)
+    failed = sum(1 for result in results if result.get("error"))
+    samples = [flatten_timings(result.get("timings")) for result in results]
+    report = summarize(len(results), elapsed, samples, peak)
+    report["failed"] = failed
+    return report
+
+
+def bench_html_to_md(html_to_md, pages, args):
+    events = [
+        {"url": page.base_url, "html": page.html_for(f"{page.base_url}#md-{i}")}
+        for i in range(args.repeat) for page in pages
+    ]
+
+    def run():
+        bodies = []
+        with quiet(not args.verbose):
+            for event in events:
+                bodies.append(json.loads(html_to_md.handler(event, None)["body"]))
+        return bodies
+
+    bodies, elapsed, peak = measure(run, not args.skip_memory)
+    samples = [flatten_timings(body.get("timings")) for body in bodies]
+    return summarize(len(bodies), elapsed, samples, peak)
+
+
+def bench_image_descriptions(html_to_md, annotate_image, pages, args):
+    inputs = [
+        html_to_md.html_to_blocks(page.html_for(f"{page.base_url}#img-{i}"), page.base_url)
+        for i in range(args.repeat) for page in pages
+    ]
+    inputs = [blocks for blocks in inputs if annotate_image.extract_image_urls(blocks)]
+
+    def run():
+        samples = []
+        with quiet(not args.verbose):
+            for blocks in inputs:
+                start = time.perf_counter()
+                annotate_image.generate_image_descriptions(blocks)
+                samples.append({"generate_image_descriptions": time.perf_counter() - start})
+        return samples
+
+    samples, elapsed, peak = measure(run, not args.skip_memory)
+    report = summarize(len(samples), elapsed, samples, peak)
+    report["images"] = sum(len(annotate_image.extract_image_urls(blocks)) for blocks in inputs)
+    return report
+
+
+def configure_environment(base_url, args):
+    # パイプラインのモジュールを import する前に、保存先・接続先をすべてローカルに向ける
+    settings = {
+        "GEMINI_API_KEY": "bench",
+        "OPENAI_API_KEY": "bench",
+        "GEMINI_API_BASE": f"{base_url}/v1beta",
+        "OPENAI_API_URL": f"{base_url}/v1/chat/completions",
+        "GEMINI_CONTEXT_CACHE_BACKEND": "stub",
+        "AWS_DEFAULT_REGION": "ap-northeast-1",
+        "S3_BUCKET_NAME": BUCKET,
+        "ARTIFACT_BACKEND": "local",
+        "ARTIFACT_DIR": tempfile.mkdtemp(prefix="bench_artifacts_"),
+        "LOG_BACKEND": "local",
+        "URL_CACHE_BACKEND": "memory",
+        "ANALYSIS_CACHE_BACKEND": "memory",
+        "IMAGE_CACHE_BACKEND": "none",
+        "JOB_STORE_BACKEND": "memory",
+        "TRACE_LOG_ENABLED": "false",
+        # 429 の後のバックオフは Retry-After（スタブの retry-after-ms）に従う
+        "LLM_BACKOFF_BASE": "0.05",
+    }
+    if not args.shared_images:
+        # 2回目の実行（メモリの計測）でも画像の説明文をキャッシュから返さない
+        settings["IMAGE_CACHE_LRU_SIZE"] = "0"
+    for key, value in settings.items():
+        os.environ.setdefault(key, value)
+
+
+def main_cli():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("page_dir", nargs="?", default=os.path.join(CORPUS_DIR, "pages"),
+                    help="保存した HTML のディレクトリ（省略時はリポジトリ内のコーパス）")
+    ap.add_argument("--urls", type=int, default=100, help="lambda_handler に渡すURL数")
+    ap.add_argument("--mode", choices=("threads", "async"), default="threads")
+    ap.add_argument("--batch-size", type=int, default=1, help="selenium_batch_size")
+    ap.add_argument("--repeat", type=int, default=1, help="html_to_md・画像説明で各ページを処理する回数")
+    ap.add_argument("--targets", nargs="+", default=["lambda_handler", "html_to_md", "image_descriptions"],
+                    choices=["lambda_handler", "html_to_md", "image_descriptions"])
+    ap.add_argument("--gemini-latency", type=float, default=0.5, help="Gemini スタブの平均応答時間（秒）")
+    ap.add_argument("--openai-latency", type=float, default=0.3, help="OpenAI スタブの平均応答時間（秒）")
+    ap.add_argument("--selenium-latency", type=float, default=0.0, help="Selenium の代わりの平均応答時間（秒）")
+    ap.add_argument("--rate-429", type=float, default=0.0, help="スタブが 429 を返す割合")
+    ap.add_argument("--retry-after", type=float, default=0.2, help="429 で待たせる秒数")
+    ap.add_argument("--shared-images", action="store_true", help="同じページの画像は全URLで同じにする（画像キャッシュに当たる）")
+    ap.add_argument("--with-cache", action="store_true", help="URLキャッシュ・解析キャッシュを有効にする")
+    ap.add_argument("--skip-memory", action="store_true", help="ピークメモリを計測しない（計測のための2回目の実行を省く）")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--json", help="結果を保存する JSON ファイル")
+    ap.add_argument("--baseline", help="比較する前回の結果（--json で保存したもの）")
+    ap.add_argument("--max-regression", type=float, default=0.1, help="これを超えて悪化したら終了コード1（割合）")
+    ap.add_argument("--verbose", action="store_true", help="パイプラインのログを表示する")
+    args = ap.parse_args()
+    random.seed(args.seed)
+
+    server, base_url = start_server(args)
+    configure_environment(base_url, args)
+    if install_boto3_stand_in():
+        print("boto3 が無いため、ダミーの boto3 で実行します")
+    sys.path.insert(0, HERE)
+    sys.path.append(HTML_TO_MD_DIR)
+    pipeline = importlib.import_module("lambda_function")
+    html_to_md = importlib.import_module("main")
+    annotate_image = importlib.import_module("annotate_image")
+
+    s3 = LocalS3()
+    pages = load_pages(args.page_dir, s3, base_url, args.shared_images)
+    if not pages:
+        print(f"{args.page_dir} に .html がありません")
+        return 1
+    selenium = SeleniumStandIn({}, s3, args.selenium_latency)
+    for i in range(args.urls):
+        selenium.pages[f"{pages[i % len(pages)].base_url}#bench-{i}"] = pages[i % len(pages)]
+    pipeline.s3_client = s3
+    pipeline.lambda_client = LocalLambda({
+        "fetch_html_screenshot_with_selenium": selenium.handler,
+        "html_to_md": html_to_md.handler,
+    })
+
+    print(f"{len(pages)}ページ / Gemini {args.gemini_latency * 1000:.0f}ms / OpenAI {args.openai_latency * 1000:.0f}ms / "
+          f"429 の割合 {args.rate_429:.0%} / mode={args.mode}")
+
+    reports = {}
+    if "lambda_handler" in args.targets:
+        reports["lambda_handler"] = bench_lambda_handler(pipeline, pages, args)
+        print_report("lambda_handler", "URL", reports["lambda_handler"])
+        print(f"  失敗: {reports['lambda_handler']['failed']}件 / Gemini: {pipeline.gemini_client.stats()}")
+    if "html_to_md" in args.targets:
+        reports["html_to_md.handler"] = bench_html_to_md(html_to_md, pages, args)
+        print_report("html_to_md.handler", "ページ", reports["html_to_md.handler"])
+    if "image_descriptions" in args.targets:
+        reports["generate_image_descriptions"] = bench_image_descriptions(html_to_md, annotate_image, pages, args)
+        print_report("generate_image_descriptions", "ページ", reports["generate_image_descriptions"])
+        print(f"  画像: {reports['generate_image_descriptions']['images']}枚 / "
+              f"OpenAI: {annotate_image.openai_client.stats()}")
+    print(f"\nスタブへのリクエスト: {server.counters}")
+    server.shutdown()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=1)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(json.load(f), reports, args.max_regression)
+        for line in regressions:
+            print(f"  劣化: {line}")
+        if regressions:
+            return 1
+        print(f"前回の結果から {args.max_regression:.0%} を超える劣化はありません")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,409 @@
+import os
+import json
+import time
+import uuid
+import random
+import threading
+
+import kv_store
+import artifact_store
+import tracing
+# process_single_url などは lambda_function に定義されている（呼び出し時に参照する）
+import lambda_function as pipeline
+
+# ジョブとタスクの状態の保存先: memory / sqlite / dynamodb
+# Lambda では呼び出しごとに別のコンテナに届くので dynamodb が必要（ローカル以外で未設定ならエラーにする）
+JOB_STORE_TABLE_NAME = os.environ.get("JOB_STORE_TABLE_NAME")
+JOB_STORE_BACKEND = os.environ.get(
+    "JOB_STORE_BACKEND",
+    "sqlite" if kv_store.LOCAL_ENV else ("dynamodb" if JOB_STORE_TABLE_NAME else "memory"),
+).lower()
+JOB_TTL_SECONDS = int(os.environ.get("JOB_TTL_SECONDS", str(7 * 24 * 3600)))
+# 設定されていれば SQS、無ければこのプロセス内のキューとワーカーで処理する（ローカルのみ）
+JOB_QUEUE_URL = os.environ.get("JOB_QUEUE_URL")
+# 1タスク（1URL）あたりの試行回数の上限と、失敗後に再試行するまでの待ち時間（秒）
+MAX_TASK_ATTEMPTS = int(os.environ.get("JOB_MAX_TASK_ATTEMPTS", "3"))
+RETRY_DELAY_SECONDS = float(os.environ.get("JOB_RETRY_DELAY_SECONDS", "30"))
+# 受け取ったタスクを、削除されないまま他のワーカーから見えなくしておく時間（秒）。
+# ワーカーが途中で落ちた場合は、この時間が過ぎると別のワーカーが処理し直す
+VISIBILITY_TIMEOUT_SECONDS = int(os.environ.get("JOB_VISIBILITY_TIMEOUT_SECONDS", "900"))
+# プロセス内キューを処理するワーカーのスレッド数
+LOCAL_WORKERS = int(os.environ.get("JOB_LOCAL_WORKERS", "8"))
+# 結果の1ページあたりの件数の上限
+MAX_PAGE_SIZE = 100
+# 結果の Markdown をこれより大きければ artifact_store に置く（DynamoDB の 400KB 制限対策）
+RESULT_INLINE_MAX_BYTES = 64 * 1024
+
+ACTIONS = ("submit", "status", "results")
+
+
+class InProcessQueue:
+    """
+    ローカル・テスト用の SQS の代わり。受け取ったメッセージは delete されるまで
+    visibility_timeout の間だけ見えなくなり、その後また受け取れるようになる。
+    """
+
+    def __init__(self, visibility_timeout=VISIBILITY_TIMEOUT_SECONDS):
+        self.visibility_timeout = visibility_timeout
+        self.cond = threading.Condition()
+        self.messages = {}   # receipt → [本文, 見えるようになる時刻]
+
+    def send(self, bodies):
+        with self.cond:
+            for body in bodies:
+                self.messages[uuid.uuid4().hex] = [body, 0.0]
+            self.cond.notify_all()
+
+    def receive(self, max_messages=10, wait_seconds=1.0):
+        # 戻り値: [(receipt, 本文), ...]
+        deadline = time.monotonic() + wait_seconds
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                visible = [(r, m[0]) for r, m in self.messages.items() if m[1] <= now][:max_messages]
+                if visible or now >= deadline:
+                    for receipt, _ in visible:
+                        self.messages[receipt][1] = now + self.visibility_timeout
+                    return visible
+                self.cond.wait(min(0.1, deadline - now))
+
+    def delete(self, receipt):
+        with self.cond:
+            self.messages.pop(receipt, None)
+
+    def release(self, receipt, delay_seconds):
+        # delay_seconds 後に再び受け取れるようにする
+        with self.cond:
+            if receipt in self.messages:
+                self.messages[receipt][1] = time.monotonic() + delay_seconds
+                self.cond.notify_all()
+
+    def __len__(self):
+        with self.cond:
+            return len(self.messages)
+
+
+class SQSQueue:
+    """
+    本番用。ワーカーの Lambda は SQS のイベントソースマッピングで起動し、
+    タスクごとの成否を batchItemFailures で返す（失敗したものだけが再配信される）。
+    """
+
+    def __init__(self, queue_url):
+        import boto3
+        self.sqs = boto3.client('sqs')
+        self.queue_url = queue_url
+
+    def send(self, bodies):
+        bodies = list(bodies)
+        for i in range(0, len(bodies), 10):
+            entries = [{"Id": str(n), "MessageBody": body} for n, body in enumerate(bodies[i:i + 10])]
+            resp = self.sqs.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            if resp.get("Failed"):
+                raise RuntimeError(f"SQS への送信に失敗しました: {resp['Failed']}")
+
+    def release(self, receipt, delay_seconds):
+        self.sqs.change_message_visibility(
+            QueueUrl=self.queue_url, ReceiptHandle=receipt, VisibilityTimeout=int(delay_seconds)
+        )
+
+
+def _job_key(job_id):
+    return f"job:{job_id}"
+
+
+def _task_key(job_id, index):
+    return f"job:{job_id}:task:{index}"
+
+
+def _claim_key(job_id, index):
+    # 処理中のワーカーが持つ印。VISIBILITY_TIMEOUT_SECONDS で期限切れになる
+    return f"job:{job_id}:task:{index}:claim"
+
+
+def _done_key(job_id, index):
+    # 完了を件数に数えたかの印。同じタスクを2回数えないようにする
+    return f"job:{job_id}:task:{index}:done"
+
+
+class JobQueue:
+    """
+    URL のリストとクエリをジョブとして受け付け、URL ごとのタスクをキューに入れる。
+    ジョブ・タスクの状態と結果は store（kv_store）に置くので、ワーカーが落ちても続きから処理できる。
+    """
+
+    def __init__(self, store, queue):
+        self.store = store
+        self.queue = queue
+
+    # ---------- 受付・照会 ----------
+    def submit(self, event):
+        urls = event.get("urls") or []
+        job_id = uuid.uuid4().hex
+        expires_at = time.time() + JOB_TTL_SECONDS
+        # ワーカーは保存した event から build_options でオプションを組み立て直す
+        job_event = {key: value for key, value in event.items() if key not in ("urls", "action")}
+        self.store.put(_job_key(job_id), {
+            "job_id": job_id,
+            "event": job_event,
+            "total": len(urls),
+            "created_at": time.time(),
+        }, expires_at)
+        for index, url in enumerate(urls):
+            self.store.put(_task_key(job_id, index), {
+                "index": index, "url": url, "status": "queued", "attempts": 0,
+            }, expires_at)
+        self.queue.send(json.dumps({"job_id": job_id, "index": index}) for index in range(len(urls)))
+        print(f"ジョブ {job_id} を受け付けました（{len(urls)}件）")
+        return {"job_id": job_id, "total": len(urls)}
+
+    def status(self, job_id):
+        entry = self.store.get(_job_key(job_id))
+        if entry is None:
+            return None
+        job = entry[0]
+        succeeded = self.store.incr(f"{_job_key(job_id)}:succeeded", 0)
+        failed = self.store.incr(f"{_job_key(job_id)}:failed", 0)
+        finished = succeeded + failed
+        return {
+            "job_id": job_id,
+            "status": "completed" if finished >= job["total"] else "running",
+            "total": job["total"],
+            "succeeded": succeeded,
+            "failed": failed,
+            "created_at": job["created_at"],
+        }
+
+    def results(self, job_id, offset=0, limit=MAX_PAGE_SIZE):
+        """
+        入力の URL の順に、offset 件目から limit 件のタスクの状態と結果を返す。
+        """
+        entry = self.store.get(_job_key(job_id))
+        if entry is None:
+            return None
+        total = entry[0]["total"]
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        items = []
+        for index in range(offset, min(offset + limit, total)):
+            task_entry = self.store.get(_task_key(job_id, index))
+            task = task_entry[0] if task_entry else {"index": index, "status": "unknown"}
+            if task.get("result"):
+                task = dict(task, result=_unpack_result(task["result"]))
+            items.append(task)
+        next_offset = offset + len(items)
+        return {
+            "job_id": job_id,
+            "items": items,
+            "next_offset": next_offset if next_offset < total else None,
+        }
+
+    # ---------- ワーカー ----------
+    def process_message(self, body):
+        """
+        タスクを1件処理する。
+        戻り値: True（完了。メッセージを削除してよい）/ False（再試行する。他のワーカーが処理中の場合を含む）
+        """
+        message = json.loads(body)
+        job_id, index = message["job_id"], message["index"]
+        job_entry = self.store.get(_job_key(job_id))
+        task_entry = self.store.get(_task_key(job_id, index))
+        if job_entry is None or task_entry is None:
+            print(f"ジョブ {job_id} が見つからないため、タスク {index} を破棄します")
+            return True
+        # 再配信で同じタスクが2回届いた場合は何もしない
+        if task_entry[0]["status"] in ("succeeded", "failed"):
+            return True
+
+        # SQS は同じメッセージを重複して届けることがあるので、処理中の印を条件付きで書き込めたワーカーだけが処理する。
+        # 他のワーカーが処理中なら後で受け取り直す（ワーカーが落ちた場合は印の期限が切れてから取り直せる）
+        claim_key = _claim_key(job_id, index)
+        if not self.store.put_if_absent(claim_key, {"claimed_at": time.time()},
+                                        time.time() + VISIBILITY_TIMEOUT_SECONDS):
+            print(f"ジョブ {job_id} のタスク {index} は他のワーカーが処理中のため後で確認します")
+            return False
+        try:
+            return self._run_task(job_id, index, job_entry)
+        finally:
+            self.store.delete(claim_key)
+
+    def _run_task(self, job_id, index, job_entry):
+        # 印を書き込む前に他のワーカーが完了させていた場合に備えて、状態を読み直す
+        task_entry = self.store.get(_task_key(job_id, index))
+        if task_entry is None or task_entry[0]["status"] in ("succeeded", "failed"):
+            return True
+        job, task = job_entry[0], task_entry[0]
+
+        task.update(status="running", attempts=task["attempts"] + 1, updated_at=time.time())
+        self.store.put(_task_key(job_id, index), task, job_entry[1])
+
+        event = job["event"]
+        options = pipeline.build_options(event)
+        try:
+            result = pipeline.process_single_url(
+                task["url"], event.get("query", ""), event.get("userid", "guest"), None, options
+            )
+        except Exception as e:
+            result = pipeline.error_result(task["url"], e)
+
+        # 取得・変換の失敗（error）と、Gemini の一時的な失敗（429 が続いた場合など。analysis_retryable）を再試行する
+        # それ以外の Gemini の失敗（400 など）は送り直しても同じなので、取得からやり直さずに失敗とする
+        error = result.get("error") or result.get("analysis_error")
+        failed = bool(error)
+        retryable = bool(result.get("error")) or bool(result.get("analysis_retryable"))
+        if failed and retryable and task["attempts"] < MAX_TASK_ATTEMPTS:
+            print(f"ジョブ {job_id} のタスク {index} が失敗したため再試行します（{task['attempts']}回目）: {error}")
+            task.update(status="retrying", last_error=error, updated_at=time.time())
+            self.store.put(_task_key(job_id, index), task, job_entry[1])
+            return False
+
+        task.update(status="failed" if failed else "succeeded", result=_pack_result(result), updated_at=time.time())
+        self.store.put(_task_key(job_id, index), task, job_entry[1])
+        # 印の期限切れで別のワーカーも同じタスクを完了させた場合でも、件数は1回だけ数える
+        if self.store.put_if_absent(_done_key(job_id, index), task["status"], job_entry[1]):
+            self.store.incr(f"{_job_key(job_id)}:{task['status']}")
+        return True
+
+    def run_local_worker(self, workers=LOCAL_WORKERS, stop_when_empty=True):
+        """
+        プロセス内キューのタスクを workers 本のスレッドで処理する。
+        stop_when_empty なら、キューが空になったら戻る。
+        """
+        def work():
+            while True:
+                messages = self.queue.receive(max_messages=1)
+                if not messages:
+                    if stop_when_empty and len(self.queue) == 0:
+                        return
+                    continue
+                for receipt, body in messages:
+                    self._handle_local(receipt, body)
+
+        # ThreadPoolExecutor は終了時にスレッドを待つので、止まらないワーカーは daemon スレッドで動かす
+        threads = [threading.Thread(target=work, daemon=True) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _handle_local(self, receipt, body):
+        try:
+            done = self.process_message(body)
+        except Exception as e:
+            print(f"タスクの処理に失敗しました: {e}")
+            done = False
+        if done:
+            self.queue.delete(receipt)
+        else:
+            self.queue.release(receipt, retry_delay())
+
+
+def retry_delay():
+    # 再試行が同時に集中しないように揺らぎを入れる
+    return RETRY_DELAY_SECONDS * (0.5 + random.random())
+
+
+def _pack_result(result):
+    if "markdown" not in result:
+        return result
+    return dict(result, markdown=artifact_store.pack(result["markdown"], "job-results/markdown", RESULT_INLINE_MAX_BYTES))
+
+
+def _unpack_result(result):
+    if not artifact_store.is_ref(result.get("markdown")):
+        return result
+    try:
+        return dict(result, markdown=artifact_store.unpack(result["markdown"]))
+    except Exception as e:
+        print(f"結果の Markdown を読めませんでした: {e}")
+        return result
+
+
+def create_job_queue():
+    # プロセス内のキュー・メモリの保存先は、Lambda では呼び出しの合間に止まり、別のコンテナからは見えない
+    if not kv_store.LOCAL_ENV:
+        if not JOB_QUEUE_URL:
+            raise RuntimeError("ジョブモードには JOB_QUEUE_URL（SQS のキュー）の設定が必要です")
+        if JOB_STORE_BACKEND != "dynamodb" or not JOB_STORE_TABLE_NAME:
+            raise RuntimeError("ジョブモードには JOB_STORE_TABLE_NAME（DynamoDB のテーブル）の設定が必要です")
+    store = kv_store.create_backend(
+        JOB_STORE_BACKEND,
+        sqlite_path=os.environ.get("JOB_STORE_SQLITE_PATH", "/tmp/jobs.sqlite3"),
+        table_name=JOB_STORE_TABLE_NAME,
+    )
+    queue = SQSQueue(JOB_QUEUE_URL) if JOB_QUEUE_URL else InProcessQueue()
+    return JobQueue(store, queue)
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+_local_worker = None
+
+
+def get_job_queue():
+    # 初回の呼び出し時に作り、ウォームコンテナでは使い回す
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = create_job_queue()
+        return _job_queue
+
+
+def _start_local_worker(jobs):
+    # プロセス内キューの場合は、受け付けたこのプロセスのバックグラウンドで処理し続ける
+    global _local_worker
+    with _job_queue_lock:
+        if _local_worker is None or not _local_worker.is_alive():
+            _local_worker = threading.Thread(target=jobs.run_local_worker, kwargs={"stop_when_empty": False},
+                                             daemon=True)
+            _local_worker.start()
+
+
+def handle(event):
+    """
+    action ごとのジョブ API。
+    - submit:  {"urls": [...], "query": ..., その他 lambda_handler と同じオプション} → {"job_id", "total"}
+    - status:  {"job_id"} → 件数と状態
+    - results: {"job_id", "offset", "limit"} → URL の順に結果を返し、続きがあれば next_offset
+    """
+    try:
+        jobs = get_job_queue()
+    except RuntimeError as e:
+        print(f"ジョブを受け付けられません: {e}")
+        return {"statusCode": 500, "body": json.dumps({"error": str(e)}, ensure_ascii=False)}
+    action = event.get("action")
+    if action == "submit":
+        body = jobs.submit(event)
+        if isinstance(jobs.queue, InProcessQueue):
+            _start_local_worker(jobs)
+    elif action == "status":
+        body = jobs.status(event.get("job_id"))
+    else:
+        body = jobs.results(event.get("job_id"), int(event.get("offset", 0)), int(event.get("limit", MAX_PAGE_SIZE)))
+    if body is None:
+        return {"statusCode": 404, "body": json.dumps({"error": "job not found"}, ensure_ascii=False)}
+    return {"statusCode": 200, "body": json.dumps(body, ensure_ascii=False)}
+
+
+@tracing.traced("worker_handler", entry_point=True)
+def worker_handler(event, context):
+    """
+    SQS のイベントソースマッピングから呼ばれるワーカー。
+    再試行するタスクは batchItemFailures で返し、SQS から RETRY_DELAY_SECONDS 後に再配信させる。
+    """
+    jobs = get_job_queue()
+    failures = []
+    for record in event.get("Records", []):
+        try:
+            done = jobs.process_message(record["body"])
+        except Exception as e:
+            print(f"タスクの処理に失敗しました: {e}")
+            done = False
+        if not done:
+            failures.append({"itemIdentifier": record["messageId"]})
+            try:
+                jobs.queue.release(record["receiptHandle"], retry_delay())
+            except Exception as e:
+                print(f"再試行までの待ち時間を設定できませんでした: {e}")
+    # Lambda はハンドラーから戻ると止まるので、溜めたログはここで書き込む
+    pipeline.result_log.flush()
+    return {"batchItemFailures": failures}
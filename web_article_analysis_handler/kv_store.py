@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+LOCAL_ENV = os.environ.get("LOCAL_ENV", "false").lower() == "true"
+
+
+class MemoryBackend:
+    """
+    ウォームコンテナ内だけで保持する保存先。件数が max_entries を超えたら古いものから捨てる。
+    テストやオフラインでの実行にも使う。
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is not None:
+                self.items.move_to_end(key)
+            return entry
+
+    def put(self, key, value, expires_at=None):
+        with self.lock:
+            self.items[key] = (value, expires_at)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_entries:
+                self.items.popitem(last=False)
+
+    def put_if_absent(self, key, value, expires_at=None):
+        # 無いか期限切れの場合だけ書き込み、書き込んだかを返す
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is not None and not is_expired(entry):
+                return False
+            self.items[key] = (value, expires_at)
+            self.items.move_to_end(key)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def incr(self, key, amount=1):
+        # 数値の値に amount を足し、足した後の値を返す（amount=0 で現在の値を読む）
+        with self.lock:
+            value = (self.items.get(key) or (0, None))[0] + amount
+            self.items[key] = (value, None)
+            self.items.move_to_end(key)
+            return value
+
+
+class SQLiteBackend:
+    """ローカル・テスト用の保存先。1ファイルのSQLiteに保存する。"""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv (kv_key TEXT PRIMARY KEY, value TEXT, expires_at REAL)"
+        )
+        self.conn.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value, expires_at FROM kv WHERE kv_key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def put(self, key, value, expires_at=None):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO kv (kv_key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), expires_at),
+            )
+            self.conn.commit()
+
+    def put_if_absent(self, key, value, expires_at=None):
+        # 無いか期限切れの場合だけ書き込む。1つの SQL で判定と書き込みを行うので、複数のプロセスでも1つだけが成功する
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT INTO kv (kv_key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(kv_key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at "
+                "WHERE kv.expires_at IS NOT NULL AND kv.expires_at <= ?",
+                (key, json.dumps(value, ensure_ascii=False), expires_at, time.time()),
+            )
+            self.conn.commit()
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        with self.lock:
+            self.conn.execute("DELETE FROM kv WHERE kv_key = ?", (key,))
+            self.conn.commit()
+
+    def incr(self, key, amount=1):
+        # 1つの SQL で足すので、同じファイルを使う複数のプロセスから呼んでも数え漏れない
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO kv (kv_key, value, expires_at) VALUES (?, ?, NULL) "
+                "ON CONFLICT(kv_key) DO UPDATE SET value = CAST(value AS INTEGER) + excluded.value",
+                (key, amount),
+            )
+            self.conn.commit()
+            row = self.conn.execute("SELECT value FROM kv WHERE kv_key = ?", (key,)).fetchone()
+        return int(row[0])
+
+
+class DynamoDBBackend:
+    """
+    本番用の保存先。パーティションキー kv_key (S) のテーブルを使う。
+    expires_at をテーブルのTTL属性に設定しておくと期限切れの項目は自動で消える。
+    値は JSON 文字列で保存するので、1件 400KB（DynamoDB の上限）未満に収めること。
+    """
+
+    def __init__(self, table_name):
+        import boto3
+        self.table = boto3.resource('dynamodb').Table(table_name)
+
+    def get(self, key):
+        item = self.table.get_item(Key={"kv_key": key}).get("Item")
+        if item is None:
+            return None
+        expires_at = item.get("expires_at")
+        return json.loads(item["value"]), float(expires_at) if expires_at is not None else None
+
+    def put(self, key, value, expires_at=None):
+        item = {"kv_key": key, "value": json.dumps(value, ensure_ascii=False)}
+        if expires_at is not None:
+            item["expires_at"] = int(expires_at)
+        self.table.put_item(Item=item)
+
+    def put_if_absent(self, key, value, expires_at=None):
+        # 条件付き書き込みなので、複数の Lambda から同時に呼んでも1つだけが成功する
+        # TTL による削除は遅れることがあるので、期限切れの項目は無いものとして扱う
+        from botocore.exceptions import ClientError
+        item = {"kv_key": key, "value": json.dumps(value, ensure_ascii=False)}
+        if expires_at is not None:
+            item["expires_at"] = int(expires_at)
+        try:
+            self.table.put_item(
+                Item=item,
+                ConditionExpression="attribute_not_exists(kv_key) OR expires_at <= :now",
+                ExpressionAttributeValues={":now": int(time.time())},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            raise
+        return True
+
+    def delete(self, key):
+        self.table.delete_item(Key={"kv_key": key})
+
+    def incr(self, key, amount=1):
+        # ADD は項目ごとにアトミックなので、複数の Lambda から同時に呼んでも数え漏れない
+        resp = self.table.update_item(
+            Key={"kv_key": key},
+            UpdateExpression="ADD #count :amount",
+            ExpressionAttributeNames={"#count": "count"},
+            ExpressionAttributeValues={":amount": amount},
+            ReturnValues="UPDATED_NEW",
+        )
+        return int(resp["Attributes"]["count"])
+
+
+def create_backend(name, sqlite_path=None, table_name=None):
+    """
+    name: memory / sqlite / dynamodb / none
+    """
+    if name == "memory":
+        return MemoryBackend()
+    if name == "sqlite":
+        return SQLiteBackend(sqlite_path)
+    if name == "dynamodb":
+        return DynamoDBBackend(table_name)
+    return None
+
+
+def is_expired(entry, now=None):
+    # entry: backend.get の戻り値 (value, expires_at)
+    expires_at = entry[1]
+    return expires_at is not None and expires_at <= (now if now is not None else time.time())
@@ -1,20 +1,49 @@
 import os
 import json
 import boto3
-import requests
 import base64
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-import time
+import asyncio
+
+import prompt_builder
+import llm_client
+import static_fetch
+import artifact_store
+import url_cache
+import analysis_cache
+import async_orchestrator
+import result_stream
+import job_queue
+import log_writer
+import tracing
 
 API_KEY = os.environ['GEMINI_API_KEY']
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-2.0-flash")
+# ベンチマークなどでスタブサーバに向ける場合に変える
+GEMINI_API_BASE = os.environ.get("GEMINI_API_BASE", "https://generativelanguage.googleapis.com/v1beta")
+# ジョブ内で共通する分析の指示を登録する先: gemini（cachedContents）/ stub（オフラインのテスト用）
+GEMINI_CONTEXT_CACHE_BACKEND = os.environ.get("GEMINI_CONTEXT_CACHE_BACKEND", "gemini").lower()
+GEMINI_CONTEXT_CACHE_TTL_SECONDS = int(os.environ.get("GEMINI_CONTEXT_CACHE_TTL_SECONDS", "3600"))
 
 # AWSのクライアントを初期化
 lambda_client = boto3.client('lambda')
 s3_client = boto3.client('s3')
 S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")
-dynamodb_client = boto3.resource('dynamodb')
-table = dynamodb_client.Table(os.environ.get("DYNAMODB_TABLE_NAME"))
+# URLごとのログは溜めてから batch_write_item でまとめて書き込む（ハンドラーの終了時に flush する）
+result_log = log_writer.create_writer(os.environ.get("DYNAMODB_TABLE_NAME", "local"))
+
+# Gemini API 用の接続プール。ウォームコンテナでは接続を使い回す
+# 同時に Gemini を呼ぶスレッド数（ThreadPoolExecutor の20）に合わせる
+# 429 を受けると同時実行数を絞り、Retry-After の間はこのコンテナからの呼び出しを止める
+gemini_client = llm_client.LLMClient(pool_size=int(os.environ.get("GEMINI_POOL_SIZE", "20")), provider="gemini")
+
+# URLごとの取得・Markdown 変換の結果のキャッシュ。ウォームコンテナでは使い回す
+page_cache = url_cache.create_cache()
+# 同じクエリ・記事・スクショの Gemini の解析結果のキャッシュ
+result_cache = analysis_cache.create_cache()
+context_cache = (analysis_cache.StubContextCache() if GEMINI_CONTEXT_CACHE_BACKEND == "stub"
+                 else analysis_cache.GeminiContextCache(gemini_client, API_KEY, GEMINI_API_BASE))
 
 # Lambdaを呼び出し
 def invoke_lambda(fn_name, payload):
@@ -41,192 +70,531 @@ def fetch_image_s3(s3_key, url):
         print(f"S3からの画像取得に失敗しました: {e} for {url}")
         return None
 
-def retry_request(func, *args, **kwargs):
-    max_retries = 3
-    delay = 1
-    for attempt in range(max_retries):
-        try:
-            return func(*args, **kwargs)
-        except Exception as e:
-            if attempt < max_retries - 1:
-                print(f"Retrying request due to error: {e}")
-                time.sleep(delay)
-            else:
-                print(f"Max retries exceeded for request: {e}")
-                raise
-
-# Gemini APIを呼び出す（画像あり）
-def call_gemini_with_image(text, b64):
-    def _inner(text, b64):
-        gemini_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={API_KEY}"
-        
-        payload = {
-            "contents": [
-                {
-                    "parts": [
-                        {
-                            "inlineData": {
-                                "mimeType": "image/png",  # 画像のMIMEタイプ
-                                "data": b64,
-                            }
-                        },
-                        {"text": text}
-                    ]
-                }
-            ]
-        }
-        headers = {"Content-Type": "application/json"}
-        response = requests.post(gemini_url, headers=headers, json=payload)
-        response.raise_for_status()
-        response_json = response.json()
-        
-        gemini_text = None
-        if "candidates" in response_json and len(response_json["candidates"]) > 0:
-            gemini_text = response_json["candidates"][0]["content"]["parts"][0]["text"]
-        
-        return gemini_text
-    
-    return retry_request(_inner, text, b64)
+# Gemini に渡すスクショを取得する。縮小画像（タイルに分けた場合は複数）があればそれを使い、無ければ全体の PNG を使う
+# 戻り値: [(MIMEタイプ, base64), ...] 取得できなければ空のリスト
+def fetch_screenshot_images(html_resp, url):
+    model_keys = html_resp.get('model_screenshot_s3_keys') or []
+    if model_keys:
+        mime_type = html_resp.get('model_screenshot_mime_type') or "image/jpeg"
+        images = [(mime_type, fetch_image_s3(key, url)) for key in model_keys]
+        if all(b64 for _, b64 in images):
+            return images
+        print(f"縮小画像を取得できなかったため全体のスクショを使います for {url}")
+    if not html_resp.get('screenshot_s3_key'):
+        return []
+    b64 = fetch_image_s3(html_resp['screenshot_s3_key'], url)
+    return [("image/png", b64)] if b64 else []
+
+# Gemini APIを呼び出す（画像あり）。images: [(MIMEタイプ, base64), ...]
+# cached_content: 登録済みの共通部分（cachedContents の名前）。text はその続きになる
+def call_gemini_with_image(text, images, cached_content=None):
+    parts = [{"inlineData": {"mimeType": mime_type, "data": b64}} for mime_type, b64 in images]
+    parts.append({"text": text})
+    payload = {
+        "contents": [
+            {
+                "parts": parts
+            }
+        ]
+    }
+    if cached_content:
+        payload["cachedContent"] = cached_content
+    return _generate_content(payload)
 
 # Gemini APIを呼び出す（画像なし）
-def call_gemini_no_image(text):
-    def _inner(text):
-        gemini_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={API_KEY}"
-        
-        payload = {
-            "contents": [
-                {
-                    "parts": [
-                        {"text": text}
-                    ]
-                }
-            ]
-        }
-        headers = {"Content-Type": "application/json"}
-        response = requests.post(gemini_url, headers=headers, json=payload)
-        response.raise_for_status()
-        response_json = response.json()
-        
-        gemini_text = None
-        if "candidates" in response_json and len(response_json["candidates"]) > 0:
-            gemini_text = response_json["candidates"][0]["content"]["parts"][0]["text"]
-        
-        return gemini_text
-    return retry_request(_inner, text)
-
-# DynamoDBにログを記録
-def log_to_dynamodb(url, gemini_text, userid):
+def call_gemini_no_image(text, cached_content=None):
+    payload = {
+        "contents": [
+            {
+                "parts": [
+                    {"text": text}
+                ]
+            }
+        ]
+    }
+    if cached_content:
+        payload["cachedContent"] = cached_content
+    return _generate_content(payload)
+
+# レート制限（429）・一時的なエラー（5xx）のリトライは gemini_client が行う
+def _generate_content(payload):
+    gemini_url = f"{GEMINI_API_BASE}/models/{GEMINI_MODEL}:generateContent?key={API_KEY}"
+    headers = {"Content-Type": "application/json"}
+    response = gemini_client.call(gemini_url, payload, headers=headers)
+    response_json = response.json()
+
+    gemini_text = None
+    if "candidates" in response_json and len(response_json["candidates"]) > 0:
+        gemini_text = response_json["candidates"][0]["content"]["parts"][0]["text"]
+
+    return gemini_text
+
+# DynamoDBにログを記録（バッファに入れるだけで、書き込みは log_writer がまとめて行う）
+# timings: ステップごとの所要秒数 / cache: URLキャッシュ・解析キャッシュの状態
+def log_to_dynamodb(url, gemini_text, userid, timings=None, cache=None):
     try:
         timestamp = datetime.now().isoformat()
         item = {
             "userid": userid,
             "ts": timestamp,
             "url": url,
-            "gemini_text": gemini_text
+            "gemini_text": gemini_text,
+            "timings": timings,
+            "cache": cache,
         }
-        table.put_item(Item=item)
-        print(f"DynamoDBへのログが完了しました for {url}")
+        result_log.enqueue(item)
     except Exception as e:
         print(f"DynamoDBへのログに失敗しました: {e} for {url}")
 
-# URLを処理する関数
-def process_single_url(url, query, userid):
-    # 1. Lambdaを呼び出してHTML＋スクショ取得
-    html_resp = invoke_lambda("fetch_html_screenshot_with_selenium", {"url": url})
-    if isinstance(html_resp.get('body'), str):
-        html_resp = json.loads(html_resp['body'])
+# 複数URLを1回のLambda呼び出し（1つのChrome）でまとめて取得する
+def fetch_pages_batch(urls, options=None):
+    options = options or {}
+    pages = {}
+    cache_status = {}
+    # URLキャッシュにあるものは取得しない
+    if options.get("url_cache", True):
+        for url in urls:
+            page, cache_status[url] = page_cache.lookup(url, options)
+            if page is not None:
+                pages[url] = page
+    remaining = [url for url in urls if url not in pages]
 
-    html            = html_resp.get('html')
-    screenshot_url  = html_resp.get('screenshot_url')
-    cropped_url     = html_resp.get('cropped_screenshot_url')
-    s3_key          = html_resp.get('screenshot_s3_key')
+    # スクショが不要なら先に静的取得を試し、揃わなかったURLだけを Selenium でまとめて取得する
+    if remaining and not options.get("screenshot", True):
+        with ThreadPoolExecutor(max_workers=min(len(remaining), static_fetch.MAX_CONCURRENCY)) as executor:
+            for url, page in zip(remaining, executor.map(static_fetch.try_static, remaining)):
+                if page is not None:
+                    pages[url] = page
+        remaining = [url for url in remaining if url not in pages]
 
-    # --- 早期リターン: HTML が取れていなければ以降をスキップ ---
-    if not html or html == "can't_get_html":
-        print(f"{url}：HTML取得に失敗したので処理を中断します")
-        return {
-            "url": url,
-            "screenshot_url":         screenshot_url or "can't_get_image",
-            "cropped_screenshot_url": cropped_url    or "can't_get_image",
-            "markdown":               "can't_get_markdown",
-            "gemini_text":            "can't_get_gemini",
-            "error":                  "can't_get_html"
-        }
+    if remaining:
+        payload = {"urls": remaining, **fetch_options_payload(options)}
+        with tracing.span("fetch_batch", urls=len(remaining)) as span:
+            resp = invoke_lambda("fetch_html_screenshot_with_selenium", payload)
+            if isinstance(resp.get('body'), str):
+                resp = json.loads(resp['body'])
+            span.add_bytes(sum(page.get('content_bytes') or 0 for page in resp))
+        for page in resp:
+            page["fetch_tier"] = "selenium"
+            pages[page.get('url')] = page
 
-    print(f"HTML and screenshot fetched for {url}")
-    print(f"HTML response for {url}: {html_resp}")
-    print(f"Screenshot URL for {url}: {screenshot_url}")
+    # キャッシュを使えなかったURLには、その理由（miss / changed）を残す
+    for url, status in cache_status.items():
+        if url in pages:
+            pages[url].setdefault("cache", {"status": status})
+    return pages
 
-    # 2) Lambdaを呼び出してHTMLをMarkdownに変換
+# lambda_handler の event から、URLごとの処理に渡すオプションを取り出す
+def build_options(event):
+    return {
+        # html_to_md で本文だけを抽出する（ナビ・フッター等を除いて Gemini に渡す量を減らす）
+        "extract_main_content": bool(event.get('extract_main_content', False)),
+        "include_metadata":     bool(event.get('include_metadata', True)),
+        # Gemini に送る記事部分のトークン数の上限（見積もり）
+        "token_budget":         int(event.get('token_budget', prompt_builder.DEFAULT_TOKEN_BUDGET)),
+        # Gemini に渡すスクショの形式・幅・タイルの高さ（例: {"format": "webp", "tile_height": 2048}）
+        "model_image":          event.get('model_image') or {},
+        # スクショの取り方（auto / window / tiled）と tiled で撮る高さの上限。未指定なら Selenium Lambda の設定に従う
+        "capture_mode":         event.get('capture_mode'),
+        "capture_max_height":   event.get('capture_max_height'),
+        # ページ読み込み時に遮断するリソース（例: {"ads": true, "types": ["font", "media"]}、false で遮断しない）と読み込み待ちの上限秒数
+        "block_resources":      event.get('block_resources'),
+        "ready_max_wait":       event.get('ready_max_wait'),
+        # false にするとスクショを撮らず、JavaScript 無しで本文が揃うページは Selenium を使わずに取得する
+        "screenshot":           bool(event.get('screenshot', True)),
+        # blocks にすると Selenium Lambda がブラウザ内でブロックに分解して返す（HTML の転送とパースを省く。本文抽出は使えない）
+        "output":               event.get('output'),
+        # これを超える HTML・ブロック・Markdown は圧縮して S3 に置き、Lambda 間ではキーだけを渡す（バイト数）
+        "artifact_inline_max_bytes": event.get('artifact_inline_max_bytes'),
+        # false にすると URL キャッシュを引かず、保存もしない（常に取得・変換し直す）
+        "url_cache":            bool(event.get('url_cache', True)),
+        # false にすると Gemini の解析結果のキャッシュを引かず、保存もしない
+        "analysis_cache":       bool(event.get('analysis_cache', True)),
+        # true にすると分析の指示（query）をジョブごとに1回だけ Gemini のコンテキストキャッシュに登録して使い回す
+        "context_cache":        bool(event.get('context_cache', False)),
+    }
+
+# Selenium Lambda に渡すスクショ関連の設定
+def fetch_options_payload(options):
+    options = options or {}
+    payload = {"model_image": options.get("model_image", {})}
+    for key in ("capture_mode", "capture_max_height", "block_resources", "ready_max_wait", "output",
+                "artifact_inline_max_bytes"):
+        if options.get(key) is not None:
+            payload[key] = options[key]
+    return payload
+
+# 1) Lambdaを呼び出してHTML＋スクショ取得
+# URLキャッシュにあれば Markdown 入りの応答をそのまま返す
+# スクショが不要な場合は先に静的取得を試し、本文が揃っていれば Selenium を使わない
+def fetch_page(url, options=None):
+    options = options or {}
+    cache_status = None
+    if options.get("url_cache", True):
+        cached, cache_status = page_cache.lookup(url, options)
+        if cached is not None:
+            return cached
+
+    html_resp = None
+    if not options.get("screenshot", True):
+        html_resp = static_fetch.try_static(url)
+    if html_resp is None:
+        payload = {"url": url, **fetch_options_payload(options)}
+        html_resp = invoke_lambda("fetch_html_screenshot_with_selenium", payload)
+        if isinstance(html_resp.get('body'), str):
+            html_resp = json.loads(html_resp['body'])
+        html_resp["fetch_tier"] = "selenium"
+    if cache_status is not None:
+        html_resp["cache"] = {"status": cache_status}
+    return html_resp
+
+# HTML（またはブラウザ内で分解したブロック、URLキャッシュの Markdown）が取れたか
+def page_fetched(html_resp):
+    if html_resp.get('blocks') is not None or html_resp.get('markdown') is not None:
+        return True
+    html = html_resp.get('html')
+    return bool(html) and html != "can't_get_html"
+
+# HTML が取れなかったURLの結果
+def html_failed_result(url, html_resp):
+    print(f"{url}：HTML取得に失敗したので処理を中断します")
+    return {
+        "url": url,
+        "screenshot_url":         html_resp.get('screenshot_url') or "can't_get_image",
+        "cropped_screenshot_url": html_resp.get('cropped_screenshot_url') or "can't_get_image",
+        "markdown":               "can't_get_markdown",
+        "gemini_text":            "can't_get_gemini",
+        "error":                  "can't_get_html"
+    }
+
+# 処理中に例外が起きたURLの結果
+def error_result(url, error):
+    return {
+        "url": url,
+        "screenshot_url": "can't_get_image",
+        "cropped_screenshot_url": "can't_get_image",
+        "markdown": "can't_get_html",
+        "gemini_text": "can't_get_gemini",
+        "error": str(error)
+    }
+
+# 2) Lambdaを呼び出してHTMLをMarkdownに変換。失敗した場合は生HTMLを返す
+# base_url: 相対URLの解決に使うURL（リダイレクト後のURL）。省略すると url
+# blocks: Selenium Lambda がブラウザ内で分解したブロック。あれば HTML の代わりに渡す
+# timings を渡すと、html_to_md Lambda 内のステップごとの所要秒数を timings["html_to_md"] に入れる
+def convert_page(url, html, options, base_url=None, blocks=None, timings=None):
+    # html / blocks は Selenium Lambda が保存した参照ならそのまま渡し、大きければここで保存して参照にする
+    inline_max_bytes = options.get("artifact_inline_max_bytes")
+    payload = {
+        "url": base_url or url,
+        "extract_main_content": options.get("extract_main_content", False),
+        "include_metadata":     options.get("include_metadata", True),
+        "artifact_inline_max_bytes": inline_max_bytes,
+    }
+    if blocks is not None:
+        payload["blocks"] = artifact_store.pack(blocks, "blocks", inline_max_bytes)
+    else:
+        payload["html"] = artifact_store.pack(html, "html", inline_max_bytes)
     try:
-        md_resp = invoke_lambda("html_to_md", {
-            "url": url,
-            "html": html_resp['html']
-        })
+        md_resp = invoke_lambda("html_to_md", payload)
+        status_code = md_resp.get('statusCode')
         if isinstance(md_resp.get('body'), str):
             md_resp = json.loads(md_resp['body'])
-        markdown = md_resp.get('markdown')
+        # html_to_md のエラー応答（500 と {"error": ...}）や関数自体の失敗（errorMessage）も、変換の失敗として扱う
+        if status_code not in (None, 200) or md_resp.get('markdown') is None:
+            raise RuntimeError(md_resp.get('error') or md_resp.get('errorMessage') or f"statusCode {status_code}")
+        markdown = artifact_store.unpack(md_resp.get('markdown'))
+        content_extraction = md_resp.get('content_extraction')
+        if timings is not None and md_resp.get('timings'):
+            timings["html_to_md"] = md_resp['timings']
 
         print(f"Markdown conversion completed for {url}")
         print(f"Markdown response for {url}: {md_resp}")
     except Exception as e:
-        markdown = "#RAW HTML FALLBACK\n" + html
+        content_extraction = None
         print(f"MD変換が失敗したのでHTML情報を格納します。Markdown conversion failed for {url}: {e}")
+        try:
+            if blocks is not None:
+                blocks = artifact_store.unpack(blocks)
+                markdown = "#RAW TEXT FALLBACK\n" + "\n".join(b.get('text') or b.get('code') or '' for b in blocks)
+            else:
+                markdown = "#RAW HTML FALLBACK\n" + artifact_store.unpack(html)
+        except Exception as e:
+            # 保存された HTML・ブロックも読めない場合は、Markdown 無しでスクショなどを返す
+            print(f"{url}のHTMLを成果物から読めませんでした: {e}")
+            markdown = None
+    return markdown, content_extraction
 
-    # 3) S3から画像を取得
-    screenshot_b64 = fetch_image_s3(s3_key, url)
+# 2') URLキャッシュの Markdown があればそれを使い、無ければ変換してキャッシュに入れる
+def markdown_for_page(url, html_resp, options, timings=None):
+    if html_resp.get('markdown') is not None:
+        print(f"{url}はURLキャッシュを使います（{html_resp['cache']['status']}）")
+        return html_resp['markdown'], html_resp.get('content_extraction')
+    markdown, content_extraction = convert_page(
+        url, html_resp.get('html'), options, html_resp.get('final_url'), html_resp.get('blocks'), timings
+    )
+    if options.get("url_cache", True):
+        page_cache.store(url, options, html_resp, markdown, content_extraction)
+    return markdown, content_extraction
 
-    # 4) Gemini APIを呼び出してテキスト生成
+# 4) Gemini APIを呼び出してテキスト生成
+# 戻り値: (gemini_text, 予算の判断の記録, 解析キャッシュの状態 hit / miss / None, 失敗した場合はその例外 / None)
+def analyze_article(url, query, markdown, screenshot_images, options):
+    prompt_budget = None
+    cache_status = None
+    error = None
     try:
-        query = query + "\n#記事内容#\n" + markdown
+        # トークン数の予算内に収まるように記事部分を組み立てる（query は後で付ける）
+        article_prompt, prompt_budget = prompt_builder.build_prompt(
+            query, markdown, budget=options.get("token_budget", prompt_builder.DEFAULT_TOKEN_BUDGET),
+            include_query=False,
+        )
+        if prompt_budget["truncated"]:
+            print(f"{url}のプロンプトを予算内に収めました: {prompt_budget}")
+
+        # 同じクエリ・記事・スクショ・モデルの解析結果があれば Gemini を呼ばない
+        cache_key = None
+        if options.get("analysis_cache", True):
+            cache_key = analysis_cache.analysis_key(query, article_prompt, screenshot_images, GEMINI_MODEL)
+            cached = result_cache.get(cache_key)
+            if cached is not None:
+                print(f"{url}は解析キャッシュを使います")
+                return cached, prompt_budget, "hit", None
+            cache_status = "miss"
+
+        # query をコンテキストキャッシュに登録済みなら、続きの部分だけを送る
+        cached_content = options.get("context_cache_name")
+        text = article_prompt if cached_content else query + article_prompt
         # 画像がある場合はbase64エンコードしたものを渡す、ない場合は画像なしで呼び出す
-        if not screenshot_b64:
-            gemini_text = call_gemini_no_image(query)
+        if not screenshot_images:
+            gemini_text = call_gemini_no_image(text, cached_content)
         else:
-            gemini_text = call_gemini_with_image(query, screenshot_b64)
+            gemini_text = call_gemini_with_image(text, screenshot_images, cached_content)
         print(f"Gemini text generated for {url}")
+        if cache_key is not None:
+            result_cache.put(cache_key, gemini_text)
     except Exception as e:
         gemini_text = f"Gemini call failed: {e} for {url}"
+        error = e
         print(f"Gemini API call failed for {url}: {e}")
-    
-    # 5) DynamoDBにログを記録
-    log_to_dynamodb(url, gemini_text, userid)
+    return gemini_text, prompt_budget, cache_status, error
 
-    # 4) マージして返却
-    return {
+# ジョブ内の全URLで共通する query を Gemini のコンテキストキャッシュに登録する。失敗したら None（通常の送り方に戻す）
+def register_context_cache(query):
+    try:
+        name = context_cache.create(GEMINI_MODEL, query, GEMINI_CONTEXT_CACHE_TTL_SECONDS)
+        print(f"分析の指示をコンテキストキャッシュに登録しました: {name}")
+        return name
+    except Exception as e:
+        print(f"コンテキストキャッシュに登録できないため、URLごとに指示を送ります: {e}")
+        return None
+
+def release_context_cache(name):
+    try:
+        context_cache.delete(name)
+    except Exception as e:
+        print(f"コンテキストキャッシュの削除に失敗しました（TTL で消えます）: {e}")
+
+# 各ステップの結果をマージする
+def build_result(url, html_resp, markdown, gemini_text, content_extraction=None, prompt_budget=None,
+                 analysis_cache_status=None, timings=None, analysis_error=None):
+    result = {
         "url": url,
-        "screenshot_url":         screenshot_url,
-        "cropped_screenshot_url": cropped_url,
+        "screenshot_url":         html_resp.get('screenshot_url'),
+        "cropped_screenshot_url": html_resp.get('cropped_screenshot_url'),
         "markdown":              markdown,
         "gemini_text":           gemini_text,
     }
+    if content_extraction:
+        result["content_extraction"] = content_extraction
+    if prompt_budget:
+        result["prompt_budget"] = prompt_budget
+    if html_resp.get('screenshot_stats'):
+        result["screenshot_stats"] = html_resp['screenshot_stats']
+    # どの取得方法（static / selenium）で HTML を得たか
+    if html_resp.get('fetch_tier'):
+        result["fetch_tier"] = html_resp['fetch_tier']
+    # URLキャッシュの状態（hit / revalidated / changed / miss）と省けた転送量
+    if html_resp.get('cache'):
+        result["cache"] = html_resp['cache']
+    # Gemini の解析結果のキャッシュ（hit / miss）
+    if analysis_cache_status:
+        result["analysis_cache"] = analysis_cache_status
+    # ステップごとの所要秒数（Selenium / html_to_md Lambda 内の内訳を含む）
+    if timings:
+        result["timings"] = timings
+    # Gemini の呼び出しに失敗した場合（gemini_text にもメッセージが入る）
+    # analysis_retryable はレート制限・一時的なエラーなどで、ジョブモードではこの場合だけ再試行する
+    if analysis_error:
+        result["analysis_error"] = str(analysis_error)
+        result["analysis_retryable"] = llm_client.is_retryable(analysis_error)
+    return result
 
-def lambda_handler(event, context):
-    urls   = event.get('urls', [])
-    query  = event.get('query', '')
-    userid = event.get('userid', 'guest')
+# ログに残すキャッシュの状態（URLキャッシュ / 解析キャッシュ）
+def cache_status_for_log(html_resp, analysis_cache_status):
+    return {
+        "url": (html_resp.get('cache') or {}).get('status'),
+        "analysis": analysis_cache_status,
+    }
+
+# 取得したページの大きさ（トレースに記録する）
+def page_bytes(html_resp):
+    return html_resp.get('content_bytes') or len(html_resp.get('markdown') or '')
+
+# Selenium Lambda 内のステップごとの所要秒数を timings に加える
+def add_fetch_timings(timings, html_resp):
+    if html_resp.get('timings'):
+        timings["selenium"] = html_resp['timings']
+
+# URLを処理する関数
+def process_single_url(url, query, userid, html_resp=None, options=None):
+    options = options or {}
+    # ステップごとの所要秒数（結果とログに残す）
+    timings = {}
+    # 1. Lambdaを呼び出してHTML＋スクショ取得（まとめて取得済みの場合はそれを使う）
+    if html_resp is None:
+        with tracing.span("fetch", timings, url=url) as span:
+            html_resp = fetch_page(url, options)
+            span.add_bytes(page_bytes(html_resp))
+            span.set(tier=html_resp.get('fetch_tier'), cache=(html_resp.get('cache') or {}).get('status'))
+    add_fetch_timings(timings, html_resp)
+
+    # --- 早期リターン: HTML が取れていなければ以降をスキップ ---
+    if not page_fetched(html_resp):
+        return dict(html_failed_result(url, html_resp), timings=timings)
+
+    print(f"HTML and screenshot fetched for {url}")
+    print(f"HTML response for {url}: {html_resp}")
+    print(f"Screenshot URL for {url}: {html_resp.get('screenshot_url')}")
+
+    # 2) Lambdaを呼び出してHTMLをMarkdownに変換（URLキャッシュにあれば変換しない）
+    with tracing.span("convert", timings, url=url) as span:
+        markdown, content_extraction = markdown_for_page(url, html_resp, options, timings)
+        span.add_bytes(len((markdown or "").encode("utf-8")))
 
+    # 3) S3から画像を取得
+    with tracing.span("images", timings, url=url) as span:
+        screenshot_images = fetch_screenshot_images(html_resp, url)
+        span.add_bytes(sum(len(b64) for _, b64 in screenshot_images))
+
+    # 4) Gemini APIを呼び出してテキスト生成
+    with tracing.span("analyze", timings, url=url) as span:
+        analysis = analyze_article(url, query, markdown, screenshot_images, options)
+        gemini_text, _, analysis_cache_status, _ = analysis
+        span.add_bytes(len((gemini_text or "").encode("utf-8")))
+        span.set(cache=analysis_cache_status)
+
+    return finish_url(url, userid, html_resp, markdown, content_extraction, analysis, timings)
+
+# 5) DynamoDBにログを記録し、6) 各ステップの結果をマージして返す
+# process_single_url と async_orchestrator.process_url_async の共通の後処理
+# analysis: analyze_article の戻り値 (gemini_text, prompt_budget, analysis_cache_status, analysis_error)
+def finish_url(url, userid, html_resp, markdown, content_extraction, analysis, timings):
+    gemini_text, prompt_budget, analysis_cache_status, analysis_error = analysis
+    # ログはバッファに入れるだけで待たない
+    log_to_dynamodb(url, gemini_text, userid, timings, cache_status_for_log(html_resp, analysis_cache_status))
+    return build_result(url, html_resp, markdown, gemini_text, content_extraction, prompt_budget,
+                        analysis_cache_status, timings, analysis_error)
+
+# 従来のスレッドプールで全URLを処理する
+# on_result を渡すと、完了したURLから順に結果を渡し、結果を溜めない（戻り値は空のリスト）
+def run_urls_in_threads(urls, query, userid, options, batch_size, on_result=None):
     results = []
+    on_result = on_result or results.append
     with ThreadPoolExecutor(max_workers=20) as executor:
-        futures = {
-            executor.submit(process_single_url, url, query, userid): url
-            for url in urls
-        }
+        if batch_size > 1:
+            batches = [urls[i:i + batch_size] for i in range(0, len(urls), batch_size)]
+            batch_futures = {executor.submit(fetch_pages_batch, batch, options): batch for batch in batches}
+            futures = {}
+            # 取得が終わったバッチから、URLごとの後続処理を投入する
+            for batch_fut in as_completed(batch_futures):
+                try:
+                    pages = batch_fut.result()
+                except Exception as e:
+                    print(f"まとめて取得に失敗したため、URLごとに取得します: {e}")
+                    pages = {}
+                for url in batch_futures[batch_fut]:
+                    futures[executor.submit(process_single_url, url, query, userid, pages.get(url), options)] = url
+        else:
+            futures = {
+                executor.submit(process_single_url, url, query, userid, None, options): url
+                for url in urls
+            }
         for fut in as_completed(futures):
-            url = futures[fut]
+            # 処理済みの Future を手放し、結果を抱え込まないようにする
+            url = futures.pop(fut)
             try:
-                results.append(fut.result())
+                result = fut.result()
             except Exception as e:
-                results.append({
-                    "url": url,
-                    "screenshot_url": "can't_get_image",
-                    "cropped_screenshot_url": "can't_get_image",
-                    "markdown": "can't_get_html",
-                    "gemini_text": "can't_get_gemini",
-                    "error": str(e)
-                })
+                result = error_result(url, e)
+            on_result(result)
+
+    return results
+
+# event の urls をすべて処理する。on_result を渡すと結果は溜めずに1件ずつ渡す
+# 戻り値: (結果のリスト, ジョブ全体の統計)
+def run_job(event, on_result=None):
+    urls   = event.get('urls', [])
+    query  = event.get('query', '')
+    userid = event.get('userid', 'guest')
+    # 2以上を指定すると、その件数ずつ1つのSelenium Lambdaでまとめて取得する
+    batch_size = int(event.get('selenium_batch_size', 1))
+    options = build_options(event)
+
+    llm_before = gemini_client.stats()
+    cache_before = page_cache.stats()
+    analysis_before = result_cache.stats()
+    # 共通の指示はジョブごとに1回だけ登録し、終わったら削除する
+    if options["context_cache"] and query:
+        options["context_cache_name"] = register_context_cache(query)
+    try:
+        # mode="async" の場合は asyncio でステージごとに並列数を制御して処理する
+        if event.get('mode') == 'async':
+            results = asyncio.run(async_orchestrator.run_urls(
+                urls, query, userid, options, async_orchestrator.stage_limits_from(event), batch_size,
+                on_result,
+            ))
+        else:
+            results = run_urls_in_threads(urls, query, userid, options, batch_size, on_result)
+    finally:
+        if options.get("context_cache_name"):
+            release_context_cache(options["context_cache_name"])
+        # Lambda はハンドラーから戻ると止まるので、溜めたログはここで書き込む
+        result_log.flush()
+        print(f"DynamoDBへのログ: {result_log.stats()}")
+
+    # レート制限で待たされた時間などをログに残す
+    llm_after = gemini_client.stats()
+    print(f"Gemini の呼び出し状況: {llm_client.stats_delta(llm_before, llm_after)}")
+    cache_after = page_cache.stats()
+    cache_stats = url_cache.summarize({k: cache_after[k] - cache_before[k] for k in cache_after})
+    print(f"URLキャッシュ: {cache_stats}")
+    analysis_after = result_cache.stats()
+    analysis_cache_stats = {k: analysis_after[k] - analysis_before[k] for k in analysis_after}
+    print(f"解析キャッシュ: {analysis_cache_stats}")
+
+    return results, {"cache_stats": cache_stats, "analysis_cache_stats": analysis_cache_stats}
+
+@tracing.traced("lambda_handler", entry_point=True)
+def lambda_handler(event, context):
+    # action を指定した場合はジョブとして受け付け、結果は status / results で取りに来てもらう
+    if event.get('action') in job_queue.ACTIONS:
+        return job_queue.handle(event)
+
+    # response_format="ndjson" の場合は、完了した順の1行ずつの NDJSON で返す
+    # Lambda の戻り値はまとめて返されるので、最初の行から受け取るには result_stream のサーバを使う
+    if event.get('response_format') == 'ndjson':
+        return {
+            "statusCode": 200,
+            "headers": {"Content-Type": result_stream.NDJSON_CONTENT_TYPE},
+            "body": ''.join(result_stream.iter_ndjson(event)),
+        }
 
+    results, stats = run_job(event)
+    if not event.get('include_markdown', True):
+        results = [result_stream.without_markdown(result) for result in results]
     return {
         "statusCode": 200,
-        "body": json.dumps(results, ensure_ascii=False)
+        "body": json.dumps(results, ensure_ascii=False),
+        **stats,
     }
@@ -0,0 +1,188 @@
+import os
+import time
+import random
+import atexit
+import threading
+from decimal import Decimal
+
+import kv_store
+
+# 保存先: dynamodb / local / none
+LOG_BACKEND = os.environ.get("LOG_BACKEND", "local" if kv_store.LOCAL_ENV else "dynamodb").lower()
+# batch_write_item の1回あたりの上限件数（DynamoDB の上限が25件）
+LOG_BATCH_SIZE = 25
+# バッファの最古の記録がこの秒数を超えたら、件数が溜まっていなくても書き込む
+LOG_FLUSH_INTERVAL_SECONDS = float(os.environ.get("LOG_FLUSH_INTERVAL_SECONDS", "1.0"))
+# 書き込めていない件数がこれを超えたら、呼び出し元のスレッドで書き込んでから受け付ける
+LOG_MAX_BUFFERED = int(os.environ.get("LOG_MAX_BUFFERED", "1000"))
+# UnprocessedItems とスロットリングを再試行する回数の上限
+LOG_MAX_ATTEMPTS = int(os.environ.get("LOG_MAX_ATTEMPTS", "5"))
+
+
+class LocalTable:
+    """
+    ローカル・テスト用の DynamoDB テーブルの代わり。書き込んだ項目をメモリに保持する。
+    unprocessed_ratio を指定すると、その割合の項目を UnprocessedItems として返す（再試行の確認用）。
+    """
+
+    def __init__(self, unprocessed_ratio=0.0):
+        self.unprocessed_ratio = unprocessed_ratio
+        self.lock = threading.Lock()
+        self.items = []
+        self.calls = 0
+
+    def batch_write_item(self, RequestItems):
+        unprocessed = {}
+        with self.lock:
+            self.calls += 1
+            for table_name, requests in RequestItems.items():
+                for request in requests:
+                    if random.random() < self.unprocessed_ratio:
+                        unprocessed.setdefault(table_name, []).append(request)
+                    else:
+                        self.items.append(request["PutRequest"]["Item"])
+        return {"UnprocessedItems": unprocessed}
+
+
+def to_dynamodb(value):
+    # boto3 の resource は float を受け付けないので Decimal にする
+    if isinstance(value, float):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {key: to_dynamodb(item) for key, item in value.items() if item is not None}
+    if isinstance(value, (list, tuple)):
+        return [to_dynamodb(item) for item in value]
+    return value
+
+
+class LogWriter:
+    """
+    URLごとの結果のログをバッファに溜め、バックグラウンドのスレッドから batch_write_item でまとめて書き込む。
+    URLの処理は enqueue するだけで戻るので、DynamoDB の待ち時間がURLごとの処理時間に乗らない。
+    LOG_BATCH_SIZE 件溜まったとき、最古の記録が LOG_FLUSH_INTERVAL_SECONDS を超えたとき、
+    flush() を呼んだとき（ハンドラーの終了時）に書き込む。
+    """
+
+    def __init__(self, client, table_name, batch_size=LOG_BATCH_SIZE, flush_interval=LOG_FLUSH_INTERVAL_SECONDS,
+                 max_buffered=LOG_MAX_BUFFERED, max_attempts=LOG_MAX_ATTEMPTS):
+        # client: batch_write_item を持つもの（boto3 の dynamodb resource か LocalTable）
+        self.client = client
+        self.table_name = table_name
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.max_attempts = max_attempts
+        self.cond = threading.Condition()
+        # 書き込み中のバッチと flush() の呼び出しが重ならないようにする
+        self.write_lock = threading.Lock()
+        self.buffer = []
+        self.oldest_at = None
+        self.counters = {"enqueued": 0, "written": 0, "batches": 0, "retries": 0, "dropped": 0}
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stats(self):
+        with self.cond:
+            return dict(self.counters, buffered=len(self.buffer))
+
+    def enqueue(self, item):
+        with self.cond:
+            self.buffer.append(to_dynamodb(item))
+            self.counters["enqueued"] += 1
+            if self.oldest_at is None:
+                self.oldest_at = time.monotonic()
+            backlog = len(self.buffer) > self.max_buffered
+            self.cond.notify_all()
+        # 書き込みが追いつかない場合は、呼び出し元も書き込みに加わってメモリの使用量を抑える
+        if backlog:
+            self.flush()
+
+    def flush(self):
+        # バッファの記録をすべて書き込んでから戻る
+        with self.write_lock:
+            while True:
+                batch = self._take(force=True)
+                if not batch:
+                    return
+                self._write(batch)
+
+    def _take(self, force=False):
+        with self.cond:
+            due = (len(self.buffer) >= self.batch_size or
+                   (self.oldest_at is not None and time.monotonic() - self.oldest_at >= self.flush_interval))
+            if not self.buffer or not (force or due):
+                return []
+            # 同じキー（userid, ts）の項目が1回の batch_write_item に入るとエラーになるので次に回す
+            batch, rest, keys = [], [], set()
+            for item in self.buffer:
+                key = (item.get("userid"), item.get("ts"))
+                if len(batch) < self.batch_size and key not in keys:
+                    keys.add(key)
+                    batch.append(item)
+                else:
+                    rest.append(item)
+            self.buffer = rest
+            self.oldest_at = time.monotonic() if rest else None
+            return batch
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait(self.flush_interval)
+            with self.write_lock:
+                while True:
+                    batch = self._take()
+                    if not batch:
+                        break
+                    self._write(batch)
+
+    def _write(self, items):
+        requests = [{"PutRequest": {"Item": item}} for item in items]
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                resp = self.client.batch_write_item(RequestItems={self.table_name: requests})
+                written = len(requests)
+                requests = resp.get("UnprocessedItems", {}).get(self.table_name, [])
+                written -= len(requests)
+                with self.cond:
+                    self.counters["batches"] += 1
+                    self.counters["written"] += written
+                if not requests:
+                    return
+            except Exception as e:
+                print(f"DynamoDBへのログの書き込みに失敗しました（{attempt}回目）: {e}")
+            if attempt < self.max_attempts:
+                with self.cond:
+                    self.counters["retries"] += 1
+                # 書き込めなかった分だけを、間隔を空けて送り直す
+                time.sleep(min(0.05 * 2 ** attempt, 2.0) * (0.5 + random.random()))
+        print(f"DynamoDBへのログを{len(requests)}件書き込めませんでした")
+        with self.cond:
+            self.counters["dropped"] += len(requests)
+
+
+class NullLogWriter:
+    """ログを保存しない場合（LOG_BACKEND=none）。"""
+
+    def enqueue(self, item):
+        pass
+
+    def flush(self):
+        pass
+
+    def stats(self):
+        return {}
+
+
+def create_writer(table_name):
+    if LOG_BACKEND == "none":
+        return NullLogWriter()
+    if LOG_BACKEND == "local":
+        client = LocalTable(float(os.environ.get("LOG_LOCAL_UNPROCESSED_RATIO", "0")))
+    else:
+        import boto3
+        client = boto3.resource('dynamodb')
+    writer = LogWriter(client, table_name)
+    # Lambda 以外（ローカル実行・ベンチマーク）でプロセスが終わる場合も書き残さない
+    atexit.register(writer.flush)
+    return writer
@@ -0,0 +1,188 @@
+import os
+import re
+import html as html_lib
+
+# 1URLあたりに Gemini へ送る記事部分のトークン数の上限（見積もり）
+DEFAULT_TOKEN_BUDGET = int(os.environ.get("PROMPT_TOKEN_BUDGET", "60000"))
+
+ARTICLE_SEPARATOR = "\n#記事内容#\n"
+RAW_HTML_PREFIX = "#RAW HTML FALLBACK\n"
+# Markdown も生 HTML も無い（html_to_md が失敗し、保存した HTML も読めなかった）場合に記事の代わりに入れる
+NO_ARTICLE_NOTICE = "（記事の本文を取得できませんでした）"
+
+# 優先度の高い順。予算が足りなければ後ろの種類から削る（本文と画像説明は同じ優先度）
+PRIORITY = (('heading',), ('text', 'image'), ('list',), ('table',), ('link',), ('code',))
+# 省略した件数を記す行などのために残しておくトークン数
+SUMMARY_RESERVE_TOKENS = 50
+
+_TAG_PATTERN = re.compile(r'<[^>]+>')
+_DROP_PATTERN = re.compile(r'(?is)<(script|style|noscript|svg|iframe)\b.*?</\1\s*>|<!--.*?-->')
+_SPACE_PATTERN = re.compile(r'[ \t\r\f\v]+')
+_BLANK_LINES_PATTERN = re.compile(r'\n\s*\n+')
+
+
+def estimate_tokens(text):
+    """
+    トークナイザを使わない高速な見積もり。英数字はおよそ4文字で1トークン、日本語などは1文字で1トークン。
+    """
+    if text.isascii():
+        return len(text) // 4 + 1
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+
+def html_to_text(raw_html):
+    """
+    Markdown 変換に失敗したときのフォールバック用に、HTML からタグを除いた本文テキストを作る。
+    """
+    text = _DROP_PATTERN.sub(' ', raw_html)
+    text = _TAG_PATTERN.sub('\n', text)
+    text = html_lib.unescape(text)
+    text = _SPACE_PATTERN.sub(' ', text)
+    return _BLANK_LINES_PATTERN.sub('\n\n', text).strip()
+
+
+def _classify(line):
+    if line.startswith('#'):
+        return 'heading'
+    if line.startswith('!['):
+        return 'image'
+    if line.startswith(('- ', '1. ')):
+        return 'list'
+    if line.startswith('|'):
+        return 'table'
+    if line.startswith('[') and '](' in line:
+        return 'link'
+    return 'text'
+
+
+def split_markdown(markdown):
+    """
+    blocks_to_markdown が作った Markdown を空行区切りのまとまりに分け、種類を付ける。
+    コードブロックは中に空行があっても1つのまとまりにする。
+    戻り値: [(種類, テキスト), ...]
+    """
+    units = []
+    current = []
+    kind = None
+    in_code = False
+    for line in markdown.split('\n'):
+        if in_code:
+            current.append(line)
+            if line == '```':
+                in_code = False
+            continue
+        if line == '```':
+            if current:
+                units.append((kind, '\n'.join(current)))
+            current, kind, in_code = [line], 'code', True
+            continue
+        if line == '':
+            if current:
+                units.append((kind, '\n'.join(current)))
+            current, kind = [], None
+            continue
+        if not current:
+            kind = _classify(line)
+        current.append(line)
+    if current:
+        units.append((kind, '\n'.join(current)))
+    return units
+
+
+def _truncate(text, max_tokens):
+    # 見積もりが max_tokens に収まるまで末尾を削る（二分探索）
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low]
+
+
+def fit_markdown(markdown, budget):
+    """
+    Markdown を予算内に収める。見出し → 本文・画像説明 → リスト → 表 → リンク → コードの順に残し、
+    入りきらない種類は件数だけを末尾に記す。
+    戻り値: (収めたテキスト, 判断の記録)
+    """
+    units = split_markdown(markdown)
+    costs = [estimate_tokens(text) for _, text in units]
+    keep = [None] * len(units)  # 残すテキスト（途中で切ったものを含む）
+    remaining = budget - SUMMARY_RESERVE_TOKENS
+    truncated = 0
+
+    for kinds in PRIORITY:
+        for i, (kind, text) in enumerate(units):
+            if kind in kinds and keep[i] is None and costs[i] <= remaining:
+                keep[i] = text
+                remaining -= costs[i]
+        if 'text' in kinds:
+            # 入りきらなかった最初の本文は、入るところまで切って残す
+            for i, (kind, text) in enumerate(units):
+                if kind == 'text' and keep[i] is None:
+                    if remaining > SUMMARY_RESERVE_TOKENS:
+                        keep[i] = _truncate(text, remaining) + '…'
+                        remaining -= estimate_tokens(keep[i])
+                        truncated += 1
+                    break
+
+    dropped = {}
+    for (kind, _), kept in zip(units, keep):
+        if kept is None:
+            dropped[kind] = dropped.get(kind, 0) + 1
+
+    parts = [kept for kept in keep if kept is not None]
+    if dropped:
+        summary = '、'.join(f"{kind} {count}件" for kind, count in dropped.items())
+        parts.append(f"（文字数の上限のため省略: {summary}）")
+
+    decisions = {
+        "kept_units": len(units) - sum(dropped.values()),
+        "dropped_units": dropped,
+        "truncated_units": truncated,
+    }
+    return '\n\n'.join(parts), decisions
+
+
+def build_prompt(query, markdown, budget=DEFAULT_TOKEN_BUDGET, include_query=True):
+    """
+    query と記事の Markdown から Gemini に送るテキストを組み立てる。
+    Markdown 変換に失敗した生 HTML はタグを除いたテキストにしてから予算内に収める。
+    markdown が None・空の場合は、記事の代わりに NO_ARTICLE_NOTICE を入れる（source は none）。
+    include_query: False なら query を除いた部分（区切り＋記事）だけを返す。query をコンテキストキャッシュで
+    別に渡す場合に使う（予算の計算には query も含める）
+    戻り値: (prompt, 予算の判断の記録)
+    """
+    source = 'markdown'
+    if not markdown:
+        source = 'none'
+        markdown = ''
+    elif markdown.startswith(RAW_HTML_PREFIX):
+        source = 'raw_html'
+        markdown = html_to_text(markdown[len(RAW_HTML_PREFIX):])
+
+    article_budget = max(0, budget - estimate_tokens(query + ARTICLE_SEPARATOR))
+    before = estimate_tokens(markdown)
+    record = {
+        "source": source,
+        "budget_tokens": budget,
+        "estimated_tokens_before": before,
+    }
+    if before <= article_budget:
+        article = markdown
+        record["truncated"] = False
+    else:
+        article, decisions = fit_markdown(markdown, article_budget)
+        record["truncated"] = True
+        record.update(decisions)
+    record["estimated_tokens_after"] = estimate_tokens(article)
+
+    if source == 'raw_html':
+        article = RAW_HTML_PREFIX + article
+    elif source == 'none':
+        article = NO_ARTICLE_NOTICE
+    prompt = ARTICLE_SEPARATOR + article
+    return (query + prompt if include_query else prompt), record
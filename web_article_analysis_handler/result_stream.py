@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import queue
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# run_job などは lambda_function に定義されている（呼び出し時に参照する）
+import lambda_function as pipeline
+
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+_DONE = object()
+
+
+def without_markdown(result):
+    # Markdown を除き、代わりに文字数だけを残す
+    if "markdown" not in result:
+        return result
+    result = dict(result)
+    markdown = result.pop("markdown")
+    result["markdown_chars"] = len(markdown) if isinstance(markdown, str) else 0
+    return result
+
+
+def iter_records(event):
+    """
+    run_job を別スレッドで動かし、完了したURLから順にレコードを返すジェネレータ。
+    - {"type": "result", "completed": 完了数, "total": URL数, ...URLごとの結果}
+    - 最後に {"type": "summary", ...件数・所要時間・キャッシュの統計}
+    event の include_markdown が false なら、結果から Markdown を除く（文字数だけ残す）。
+    結果はジェネレータが受け取ったら手放すので、全URLの Markdown を同時に保持しない。
+    """
+    total = len(event.get('urls', []))
+    include_markdown = event.get('include_markdown', True)
+    records = queue.Queue()
+    outcome = {}
+
+    def worker():
+        try:
+            _, outcome["stats"] = pipeline.run_job(event, on_result=records.put)
+        except Exception as e:
+            print(f"ジョブの処理に失敗しました: {e}")
+            outcome["error"] = str(e)
+        finally:
+            records.put(_DONE)
+
+    start = time.monotonic()
+    threading.Thread(target=worker, daemon=True).start()
+
+    completed = failed = 0
+    first_result_seconds = None
+    while True:
+        result = records.get()
+        if result is _DONE:
+            break
+        completed += 1
+        # 取得・変換の失敗（error）と Gemini の失敗（analysis_error）のどちらも失敗として数える
+        if result.get("error") or result.get("analysis_error"):
+            failed += 1
+        if first_result_seconds is None:
+            first_result_seconds = round(time.monotonic() - start, 3)
+        if not include_markdown:
+            result = without_markdown(result)
+        yield {"type": "result", "completed": completed, "total": total, **result}
+
+    summary = {
+        "type": "summary",
+        "total": total,
+        "completed": completed,
+        "failed": failed,
+        "first_result_seconds": first_result_seconds,
+        "elapsed_seconds": round(time.monotonic() - start, 3),
+        **outcome.get("stats", {}),
+    }
+    if "error" in outcome:
+        summary["error"] = outcome["error"]
+    yield summary
+
+
+def iter_ndjson(event):
+    # 1レコード1行の NDJSON の文字列を返すジェネレータ
+    for record in iter_records(event):
+        yield json.dumps(record, ensure_ascii=False) + "\n"
+
+
+def stream_ndjson(event, write):
+    """
+    レスポンスをストリーミングできる実行環境（Lambda Web Adapter など）向けに、
+    完了したURLから write(bytes) で1行ずつ書き出す。
+    """
+    for line in iter_ndjson(event):
+        write(line.encode("utf-8"))
+
+
+class StreamingHandler(BaseHTTPRequestHandler):
+    """
+    POST の本文（lambda_handler と同じ event の JSON）を受け取り、NDJSON を chunked で1行ずつ返す。
+    Python の Lambda はハンドラーの戻り値をまとめて返すので、lambda_handler の response_format="ndjson" は
+    最後の URL まで待つ。完了したURLから受け取るには、Lambda Web Adapter（AWS_LWA_INVOKE_MODE=response_stream）で
+    このサーバを起動し、関数URLのストリーミングで呼び出す。
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        # Lambda Web Adapter の起動確認（readiness check）用
+        self._send_plain(200, b"ok")
+
+    def do_POST(self):
+        try:
+            event = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError:
+            return self._send_plain(400, b"invalid JSON")
+        self.send_response(200)
+        self.send_header("Content-Type", NDJSON_CONTENT_TYPE)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        stream_ndjson(event, self._write_chunk)
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_plain(self, status, data):
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=None):
+    # Lambda Web Adapter のデフォルトのポートは 8080（AWS_LWA_PORT / PORT で変えられる）
+    port = int(port or os.environ.get("AWS_LWA_PORT") or os.environ.get("PORT", "8080"))
+    server = ThreadingHTTPServer(("0.0.0.0", port), StreamingHandler)
+    print(f"NDJSON のストリーミングをポート {port} で待ち受けます")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    serve()
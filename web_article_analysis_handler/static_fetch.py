@@ -0,0 +1,183 @@
+import os
+import re
+import hashlib
+import requests
+from requests.adapters import HTTPAdapter
+
+import prompt_builder
+
+# Chrome と同じ内容を返してもらえるよう、ブラウザに近いヘッダを送る
+HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/132.0.0.0 Safari/537.36"
+    ),
+    "Accept": "text/html,application/xhtml+xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "ja,en;q=0.8",
+}
+TIMEOUT = (5, float(os.environ.get("STATIC_FETCH_TIMEOUT", "15")))
+MAX_HTML_BYTES = 5 * 1024 * 1024
+# 本文のテキストがこれ未満なら JavaScript で描画するページとみなして Selenium に回す
+MIN_TEXT_CHARS = int(os.environ.get("STATIC_MIN_TEXT_CHARS", "500"))
+# script の量が HTML 全体のこの割合を超え、テキストが少ない場合も Selenium に回す
+MAX_SCRIPT_RATIO = 0.6
+
+# SPA のひな形（中身が空のマウント先）や、JavaScript を有効にするよう求める表示
+_EMPTY_MOUNT_PATTERN = re.compile(
+    r'<div[^>]+id=["\'](root|app|__next|__nuxt|___gatsby)["\'][^>]*>\s*</div>', re.I
+)
+_JS_REQUIRED_PATTERN = re.compile(
+    r'<noscript[^>]*>[^<]*(enable javascript|javascript を有効|javascriptを有効|javascript is required)', re.I
+)
+_SCRIPT_PATTERN = re.compile(r'(?is)<script\b.*?</script\s*>')
+_IMG_PATTERN = re.compile(r'<img\b[^>]*>', re.I)
+_LAZY_SRC_PATTERN = re.compile(r'\sdata-[\w-]*src[\w-]*\s*=\s*(["\'])([^"\']+)\1', re.I)
+_SRC_PATTERN = re.compile(r'\ssrc\s*=\s*(["\'])[^"\']*\1', re.I)
+_META_CHARSET_PATTERN = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.I)
+
+# 同時に静的取得するスレッド数の上限（接続プールの大きさも合わせる）
+MAX_CONCURRENCY = 20
+
+# ウォームコンテナ間で接続を使い回す
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_maxsize=MAX_CONCURRENCY))
+session.mount("http://", HTTPAdapter(pool_maxsize=MAX_CONCURRENCY))
+
+
+def fetch_html(url):
+    """
+    JavaScript を実行せずに HTML を取得する。HTML 以外・大きすぎる・エラーの場合は None。
+    戻り値: (最終的なURL, HTML, 再検証用のヘッダ) または None
+    """
+    try:
+        with session.get(url, headers=HEADERS, timeout=TIMEOUT, stream=True, allow_redirects=True) as resp:
+            if resp.status_code != 200:
+                return None
+            content_type = resp.headers.get("Content-Type", "")
+            if "html" not in content_type:
+                return None
+            data = bytearray()
+            for chunk in resp.iter_content(chunk_size=65536):
+                data.extend(chunk)
+                if len(data) > MAX_HTML_BYTES:
+                    return None
+            # charset の指定が無いと requests は ISO-8859-1 とみなすので、中身から判定し直す
+            encoding = resp.encoding if "charset" in content_type.lower() else detect_encoding(bytes(data))
+            try:
+                html = bytes(data).decode(encoding, errors="replace")
+            except LookupError:
+                html = bytes(data).decode("utf-8", errors="replace")
+            return resp.url, html, validators_from(resp.headers)
+    except Exception as e:
+        print(f"静的取得に失敗しました: {e} for {url}")
+        return None
+
+
+def validators_from(headers):
+    # 条件付きリクエストで使う ETag / Last-Modified
+    return {"etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified")}
+
+
+def check_modified(url, etag=None, last_modified=None):
+    """
+    If-None-Match / If-Modified-Since 付きのリクエストで、前回の取得から変わったかを確かめる。
+    本文は読まずに接続を閉じる。
+    戻り値: False（304 Not Modified など変わっていない）/ True（変わった）/ None（判定できない）
+    """
+    headers = dict(HEADERS)
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    try:
+        with session.get(url, headers=headers, timeout=TIMEOUT, stream=True, allow_redirects=True) as resp:
+            if resp.status_code == 304:
+                return False
+            if resp.status_code != 200:
+                return None
+            # 条件付きリクエストに対応していないサーバでも、ETag が同じなら変わっていない
+            return not (etag and resp.headers.get("ETag") == etag)
+    except Exception as e:
+        print(f"条件付きリクエストに失敗しました: {e} for {url}")
+        return None
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def detect_encoding(data):
+    """
+    <meta charset> → UTF-8 として読めるか → 文字コード推定 の順に HTML の文字コードを決める。
+    """
+    meta = _META_CHARSET_PATTERN.search(data[:4096])
+    if meta:
+        return meta.group(1).decode("ascii")
+    try:
+        data.decode("utf-8")
+        return "utf-8"
+    except UnicodeDecodeError:
+        pass
+    return requests.compat.chardet.detect(data).get("encoding") or "utf-8"
+
+
+def check_completeness(html):
+    """
+    JavaScript 無しの HTML で本文が揃っているかを判定する。
+    戻り値: (揃っているか, 理由, テキスト文字数)
+    """
+    text_chars = len(prompt_builder.html_to_text(html))
+    if _EMPTY_MOUNT_PATTERN.search(html):
+        return False, "spa_shell", text_chars
+    if text_chars < MIN_TEXT_CHARS:
+        reason = "javascript_required" if _JS_REQUIRED_PATTERN.search(html) else "too_little_text"
+        return False, reason, text_chars
+    script_bytes = sum(len(m.group(0)) for m in _SCRIPT_PATTERN.finditer(html))
+    if script_bytes > len(html) * MAX_SCRIPT_RATIO and text_chars < MIN_TEXT_CHARS * 4:
+        return False, "script_heavy", text_chars
+    return True, "complete", text_chars
+
+
+def _copy_lazy_src(match):
+    tag = match.group(0)
+    lazy = _LAZY_SRC_PATTERN.search(tag)
+    if not lazy:
+        return tag
+    src = f' src="{lazy.group(2)}"'
+    if _SRC_PATTERN.search(tag):
+        return _SRC_PATTERN.sub(lambda _: src, tag, count=1)
+    return tag[:4] + src + tag[4:]
+
+
+def copy_lazy_image_src(html):
+    """
+    Selenium 側の fetch_html と同じく、data-*src* 属性（遅延読み込み）の値を img の src に入れる。
+    """
+    return _IMG_PATTERN.sub(_copy_lazy_src, html)
+
+
+def try_static(url):
+    """
+    静的取得を試し、本文が揃っていれば Selenium Lambda と同じ形の応答を返す。揃っていなければ None。
+    """
+    fetched = fetch_html(url)
+    if fetched is None:
+        return None
+    final_url, html, validators = fetched
+    complete, reason, text_chars = check_completeness(html)
+    if not complete:
+        print(f"{url}は静的取得では不十分なため Selenium で取得します（{reason}, {text_chars}文字）")
+        return None
+    print(f"{url}を静的取得しました（{text_chars}文字）")
+    return {
+        "url": url,
+        "final_url": final_url,
+        "html": copy_lazy_image_src(html),
+        "screenshot_url": None,
+        "cropped_screenshot_url": None,
+        "screenshot_s3_key": None,
+        "fetch_tier": "static",
+        "content_sha256": content_hash(html),
+        "content_bytes": len(html.encode("utf-8")),
+        **validators,
+    }
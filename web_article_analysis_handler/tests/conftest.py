@@ -0,0 +1,9 @@
+import os
+import sys
+
+# Lambda のモジュールはフラットに import しているので、関数のディレクトリをパスに追加する
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# lambda_function は import 時に API キーを読み、boto3 のクライアントを作る（テストでは AWS・Gemini に接続しない）
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.environ.setdefault("AWS_DEFAULT_REGION", "ap-northeast-1")
+os.environ.setdefault("LOG_BACKEND", "none")
@@ -0,0 +1,62 @@
+import time
+
+import kv_store
+import analysis_cache
+
+IMAGES = [("image/jpeg", "AAAA")]
+
+
+def test_key_ignores_width_and_whitespace_differences():
+    a = analysis_cache.analysis_key("価格は？  ＡＢＣ", "記事", IMAGES, "gemini-2.0-flash")
+    b = analysis_cache.analysis_key(" 価格は？ ABC\n", "記事", IMAGES, "gemini-2.0-flash")
+    assert a == b
+
+
+def test_key_depends_on_article_images_and_model():
+    base = analysis_cache.analysis_key("q", "記事", IMAGES, "gemini-2.0-flash")
+    assert base != analysis_cache.analysis_key("q", "記事2", IMAGES, "gemini-2.0-flash")
+    assert base != analysis_cache.analysis_key("q", "記事", [("image/jpeg", "BBBB")], "gemini-2.0-flash")
+    assert base != analysis_cache.analysis_key("q", "記事", [], "gemini-2.0-flash")
+    assert base != analysis_cache.analysis_key("q", "記事", IMAGES, "gemini-2.5-flash")
+
+
+def test_hit_and_miss():
+    cache = analysis_cache.AnalysisCache(kv_store.MemoryBackend())
+    key = analysis_cache.analysis_key("q", "記事", IMAGES, "m")
+    assert cache.get(key) is None
+    cache.put(key, '{"score": 3}')
+    assert cache.get(key) == '{"score": 3}'
+    stats = cache.stats()
+    assert (stats["lookups"], stats["hits"], stats["misses"], stats["stores"]) == (2, 1, 1, 1)
+
+
+def test_empty_result_is_not_stored():
+    cache = analysis_cache.AnalysisCache(kv_store.MemoryBackend())
+    cache.put("k", None)
+    assert cache.get("k") is None
+    assert cache.stats()["stores"] == 0
+
+
+def test_ttl():
+    cache = analysis_cache.AnalysisCache(kv_store.MemoryBackend(), ttl=0.05)
+    cache.put("k", "text")
+    time.sleep(0.06)
+    assert cache.get("k") is None
+
+
+def test_sqlite_backend(tmp_path):
+    path = str(tmp_path / "analysis.sqlite3")
+    analysis_cache.AnalysisCache(kv_store.SQLiteBackend(path)).put("k", "text")
+    assert analysis_cache.AnalysisCache(kv_store.SQLiteBackend(path)).get("k") == "text"
+
+
+def test_stub_context_cache():
+    stub = analysis_cache.StubContextCache()
+    name = stub.create("m", "共通の指示", 3600)
+    # 同じモデル・内容なら同じ名前
+    assert stub.create("m", "共通の指示", 3600) == name
+    assert name.startswith("cachedContents/")
+    assert stub.contents[name] == "共通の指示"
+    stub.delete(name)
+    assert name not in stub.contents
+    assert stub.counters == {"created": 2, "deleted": 1}
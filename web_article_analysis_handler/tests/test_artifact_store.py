@@ -0,0 +1,72 @@
+import gzip
+
+import pytest
+
+import artifact_store
+
+
+@pytest.fixture
+def local_backend(tmp_path, monkeypatch):
+    backend = artifact_store.LocalBackend(str(tmp_path / "artifacts"))
+    monkeypatch.setattr(artifact_store, "_backend", backend)
+    monkeypatch.setattr(artifact_store, "_backend_created", True)
+    return backend
+
+
+def test_small_values_stay_inline(local_backend):
+    assert artifact_store.pack("short", "html", inline_max_bytes=100) == "short"
+    assert artifact_store.pack([{"type": "hr"}], "blocks", inline_max_bytes=100) == [{"type": "hr"}]
+    assert artifact_store.pack(None, "html") is None
+
+
+def test_large_text_round_trip(local_backend):
+    html = "<p>本文</p>" * 1000
+    ref = artifact_store.pack(html, "html", inline_max_bytes=100)
+    assert artifact_store.is_ref(ref)
+    assert ref["format"] == "text"
+    assert ref["bytes"] == len(html.encode("utf-8"))
+    assert ref["stored_bytes"] < ref["bytes"]
+    assert artifact_store.unpack(ref) == html
+    # 参照はもう一度 pack してもそのまま
+    assert artifact_store.pack(ref, "html", inline_max_bytes=100) is ref
+
+
+def test_large_json_round_trip(local_backend):
+    blocks = [{"type": "text", "tag": "p", "text": f"段落{i}"} for i in range(500)]
+    ref = artifact_store.pack(blocks, "blocks", inline_max_bytes=100)
+    assert ref["format"] == "json"
+    assert artifact_store.unpack(ref) == blocks
+
+
+def test_default_compression_is_gzip(local_backend):
+    # 呼び出し元の Lambda に zstandard が無くても読めるように、既定は gzip
+    ref = artifact_store.pack("x" * 1000, "markdown", inline_max_bytes=10)
+    assert ref["encoding"] == "gzip"
+    assert ref[artifact_store.REF_KEY].endswith(".txt.gz")
+    assert gzip.decompress(local_backend.get(ref[artifact_store.REF_KEY])) == b"x" * 1000
+
+
+def test_zstd_without_zstandard(local_backend, monkeypatch):
+    monkeypatch.setattr(artifact_store, "zstandard", None)
+    local_backend.put("markdown/a.txt.zst", b"\x28\xb5\x2f\xfd", "text/plain")
+    with pytest.raises(RuntimeError):
+        artifact_store.unpack({artifact_store.REF_KEY: "markdown/a.txt.zst", "format": "text", "encoding": "zstd"})
+
+
+def test_without_backend(monkeypatch):
+    monkeypatch.setattr(artifact_store, "_backend", None)
+    monkeypatch.setattr(artifact_store, "_backend_created", True)
+    # 保存先が無ければ大きくてもそのまま渡す
+    assert artifact_store.pack("x" * 1000, "html", inline_max_bytes=10) == "x" * 1000
+    with pytest.raises(RuntimeError):
+        artifact_store.unpack({artifact_store.REF_KEY: "html/a.txt.gz", "format": "text", "encoding": "gzip"})
+
+
+def test_save_failure_falls_back_to_inline(monkeypatch):
+    class BrokenBackend:
+        def put(self, key, data, content_type):
+            raise OSError("disk full")
+
+    monkeypatch.setattr(artifact_store, "_backend", BrokenBackend())
+    monkeypatch.setattr(artifact_store, "_backend_created", True)
+    assert artifact_store.pack("x" * 1000, "html", inline_max_bytes=10) == "x" * 1000
@@ -0,0 +1,126 @@
+import time
+import asyncio
+import threading
+from collections import Counter
+
+import pytest
+
+pytest.importorskip("boto3")
+
+import lambda_function
+import async_orchestrator
+
+URLS = [f"https://{name}.example/" for name in "abcdefgh"]
+NOT_FOUND = "https://missing.example/"
+BROKEN = "https://broken.example/"
+LIMITS = {"fetch": 2, "convert": 3, "llm": 1}
+DELAY = 0.03
+
+
+class Stages:
+    """スタブにしたステップの同時実行数と、URL ごとの実行区間を記録する。"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = Counter()
+        self.peak = Counter()
+        self.intervals = {}
+
+    def run(self, stage, step, url, value):
+        with self.lock:
+            self.active[stage] += 1
+            self.peak[stage] = max(self.peak[stage], self.active[stage])
+        start = time.monotonic()
+        time.sleep(DELAY)
+        with self.lock:
+            self.active[stage] -= 1
+            self.intervals[(step, url)] = (start, time.monotonic())
+        return value
+
+
+@pytest.fixture
+def stages(monkeypatch):
+    stages = Stages()
+    logged = []
+
+    def fetch_page(url, options=None):
+        html = "can't_get_html" if url == NOT_FOUND else f"<p>{url}</p>"
+        return stages.run("fetch", "fetch", url, {"html": html, "screenshot_url": url + "shot.png",
+                                                  "fetch_tier": "static"})
+
+    def fetch_pages_batch(urls, options=None):
+        return {url: fetch_page(url, options) for url in urls}
+
+    def markdown_for_page(url, html_resp, options, timings=None):
+        if url == BROKEN:
+            raise RuntimeError("conversion failed")
+        return stages.run("convert", "convert", url, ("# " + url, {"root": "article"}))
+
+    def fetch_screenshot_images(html_resp, url):
+        return stages.run("convert", "images", url, [("image/png", "aW1n")])
+
+    def analyze_article(url, query, markdown, screenshot_images, options):
+        return stages.run("llm", "analyze", url, ('{"score": 1}', {"source": "markdown"}, "miss", None))
+
+    def log_to_dynamodb(url, gemini_text, userid, timings=None, cache=None):
+        logged.append((url, gemini_text, userid, cache))
+
+    for func in (fetch_page, fetch_pages_batch, markdown_for_page, fetch_screenshot_images, analyze_article,
+                 log_to_dynamodb):
+        monkeypatch.setattr(lambda_function, func.__name__, func)
+    stages.logged = logged
+    return stages
+
+
+def without_timings(results):
+    # 所要秒数は実行ごとに変わるので比較から外す
+    return sorted(({k: v for k, v in r.items() if k != "timings"} for r in results), key=lambda r: r["url"])
+
+
+def test_stage_limits_are_respected(stages):
+    results = asyncio.run(async_orchestrator.run_urls(URLS, "q", "u", {}, LIMITS))
+    assert [r["url"] for r in results] == URLS
+    assert all(stages.peak[stage] <= limit for stage, limit in LIMITS.items())
+    # 上限まで並列に進む
+    assert (stages.peak["fetch"], stages.peak["convert"], stages.peak["llm"]) == (2, 3, 1)
+
+
+def test_convert_and_images_overlap(stages):
+    asyncio.run(async_orchestrator.run_urls(URLS[:1], "q", "u", {}, LIMITS))
+    convert = stages.intervals[("convert", URLS[0])]
+    images = stages.intervals[("images", URLS[0])]
+    assert convert[0] < images[1] and images[0] < convert[1]
+    # 解析は両方が終わってから
+    assert stages.intervals[("analyze", URLS[0])][0] >= max(convert[1], images[1])
+
+
+@pytest.mark.parametrize("batch_size", [1, 3])
+def test_results_match_thread_mode(stages, batch_size):
+    urls = URLS[:4] + [NOT_FOUND, BROKEN]
+    async_results = asyncio.run(async_orchestrator.run_urls(urls, "q", "u", {}, LIMITS, batch_size))
+    async_logged = sorted(stages.logged)
+    stages.logged.clear()
+    thread_results = lambda_function.run_urls_in_threads(urls, "q", "u", {}, batch_size)
+
+    assert without_timings(async_results) == without_timings(thread_results)
+    assert sorted(stages.logged) == async_logged
+    assert [r["url"] for r in async_results] == urls
+    by_url = {r["url"]: r for r in async_results}
+    assert by_url[URLS[0]]["gemini_text"] == '{"score": 1}'
+    assert by_url[URLS[0]]["prompt_budget"] == {"source": "markdown"}
+    assert by_url[NOT_FOUND]["error"] == "can't_get_html"
+    assert by_url[BROKEN]["error"] == "conversion failed"
+    # ログは解析まで進んだ URL だけ
+    assert [entry[0] for entry in async_logged] == sorted(URLS[:4])
+
+
+def test_on_result_receives_each_result(stages):
+    received = []
+    results = asyncio.run(async_orchestrator.run_urls(URLS[:3], "q", "u", {}, LIMITS, on_result=received.append))
+    assert results == []
+    assert sorted(r["url"] for r in received) == URLS[:3]
+
+
+def test_stage_limits_from_event():
+    limits = async_orchestrator.stage_limits_from({"stage_concurrency": {"llm": 5, "fetch": 0, "unknown": 3}})
+    assert limits == dict(async_orchestrator.DEFAULT_STAGE_LIMITS, llm=5, fetch=1)
@@ -0,0 +1,198 @@
+import json
+import time
+
+import pytest
+
+pytest.importorskip("boto3")
+
+import kv_store
+import job_queue
+
+
+def make_jobs(visibility_timeout=60):
+    return job_queue.JobQueue(kv_store.MemoryBackend(), job_queue.InProcessQueue(visibility_timeout))
+
+
+def ok_result(url):
+    return {"url": url, "markdown": "# 本文", "gemini_text": "{}"}
+
+
+def test_in_process_queue_redelivers_until_deleted():
+    queue = job_queue.InProcessQueue(visibility_timeout=0.05)
+    queue.send(["a"])
+    [(receipt, body)] = queue.receive(wait_seconds=0)
+    assert body == "a"
+    # 受け取った直後は他のワーカーから見えない
+    assert queue.receive(wait_seconds=0) == []
+    # 削除されないまま visibility_timeout が過ぎると、もう一度受け取れる
+    time.sleep(0.06)
+    [(receipt_again, body)] = queue.receive(wait_seconds=0)
+    assert (receipt_again, body) == (receipt, "a")
+    queue.delete(receipt)
+    assert len(queue) == 0
+
+
+def test_in_process_queue_release_delays_redelivery():
+    queue = job_queue.InProcessQueue(visibility_timeout=60)
+    queue.send(["a"])
+    [(receipt, _)] = queue.receive(wait_seconds=0)
+    queue.release(receipt, 0)
+    assert queue.receive(wait_seconds=0) == [(receipt, "a")]
+
+
+def test_submit_and_process(monkeypatch):
+    monkeypatch.setattr(job_queue.pipeline, "process_single_url",
+                        lambda url, query, userid, html_resp, options: ok_result(url))
+    jobs = make_jobs()
+    job = jobs.submit({"action": "submit", "urls": ["https://a.example/", "https://b.example/"], "query": "q"})
+    assert jobs.status(job["job_id"])["status"] == "running"
+    for receipt, body in jobs.queue.receive(max_messages=10, wait_seconds=0):
+        assert jobs.process_message(body) is True
+        jobs.queue.delete(receipt)
+    status = jobs.status(job["job_id"])
+    assert (status["status"], status["succeeded"], status["failed"]) == ("completed", 2, 0)
+    page = jobs.results(job["job_id"], limit=1)
+    assert [item["url"] for item in page["items"]] == ["https://a.example/"]
+    assert page["next_offset"] == 1
+    assert jobs.results(job["job_id"], offset=1)["next_offset"] is None
+
+
+def test_gemini_failure_is_retried(monkeypatch):
+    # Gemini の一時的な失敗は error ではなく analysis_error（analysis_retryable）で返る。これも再試行する
+    calls = []
+
+    def process(url, query, userid, html_resp, options):
+        calls.append(url)
+        if len(calls) == 1:
+            return dict(ok_result(url), gemini_text="Gemini call failed: 429", analysis_error="429",
+                        analysis_retryable=True)
+        return ok_result(url)
+
+    monkeypatch.setattr(job_queue.pipeline, "process_single_url", process)
+    jobs = make_jobs()
+    job = jobs.submit({"urls": ["https://a.example/"]})
+    body = json.dumps({"job_id": job["job_id"], "index": 0})
+    assert jobs.process_message(body) is False
+    task = jobs.results(job["job_id"])["items"][0]
+    assert (task["status"], task["last_error"]) == ("retrying", "429")
+    assert jobs.process_message(body) is True
+    assert jobs.status(job["job_id"])["succeeded"] == 1
+
+
+def test_task_fails_after_max_attempts(monkeypatch):
+    monkeypatch.setattr(job_queue.pipeline, "process_single_url",
+                        lambda url, query, userid, html_resp, options: dict(ok_result(url), analysis_error="429",
+                                                                            analysis_retryable=True))
+    jobs = make_jobs()
+    job = jobs.submit({"urls": ["https://a.example/"]})
+    body = json.dumps({"job_id": job["job_id"], "index": 0})
+    results = [jobs.process_message(body) for _ in range(job_queue.MAX_TASK_ATTEMPTS)]
+    assert results == [False] * (job_queue.MAX_TASK_ATTEMPTS - 1) + [True]
+    status = jobs.status(job["job_id"])
+    assert (status["status"], status["failed"]) == ("completed", 1)
+
+
+def test_permanent_gemini_failure_is_not_retried(monkeypatch):
+    # 400 などの送り直しても変わらない失敗は、取得からやり直さずにそのまま失敗にする
+    calls = []
+    monkeypatch.setattr(job_queue.pipeline, "process_single_url",
+                        lambda url, query, userid, html_resp, options: calls.append(url) or dict(
+                            ok_result(url), analysis_error="HTTP 400: invalid argument", analysis_retryable=False))
+    jobs = make_jobs()
+    job = jobs.submit({"urls": ["https://a.example/"]})
+    assert jobs.process_message(json.dumps({"job_id": job["job_id"], "index": 0})) is True
+    assert len(calls) == 1
+    status = jobs.status(job["job_id"])
+    assert (status["status"], status["failed"]) == ("completed", 1)
+    assert jobs.results(job["job_id"])["items"][0]["result"]["analysis_error"] == "HTTP 400: invalid argument"
+
+
+def test_duplicate_delivery_is_ignored(monkeypatch):
+    calls = []
+    monkeypatch.setattr(job_queue.pipeline, "process_single_url",
+                        lambda url, query, userid, html_resp, options: calls.append(url) or ok_result(url))
+    jobs = make_jobs()
+    job = jobs.submit({"urls": ["https://a.example/"]})
+    body = json.dumps({"job_id": job["job_id"], "index": 0})
+    assert jobs.process_message(body) is True
+    assert jobs.process_message(body) is True
+    assert len(calls) == 1
+    assert jobs.status(job["job_id"])["succeeded"] == 1
+
+
+def test_duplicate_delivery_while_running(monkeypatch):
+    # 1通目の処理中に同じメッセージが届いても処理せず、後で受け取り直させる
+    jobs = make_jobs()
+    job = jobs.submit({"urls": ["https://a.example/"]})
+    body = json.dumps({"job_id": job["job_id"], "index": 0})
+    calls, nested = [], []
+
+    def process(url, query, userid, html_resp, options):
+        calls.append(url)
+        nested.append(jobs.process_message(body))
+        return ok_result(url)
+
+    monkeypatch.setattr(job_queue.pipeline, "process_single_url", process)
+    assert jobs.process_message(body) is True
+    assert nested == [False]
+    assert len(calls) == 1
+    status = jobs.status(job["job_id"])
+    assert (status["status"], status["succeeded"]) == ("completed", 1)
+    # 完了後に届いた分は削除してよい
+    assert jobs.process_message(body) is True
+
+
+def test_stale_claim_is_taken_over_and_counted_once(monkeypatch):
+    # 処理中の印の期限が切れたら別のワーカーが処理し直す。両方が完了しても件数は1回だけ数える
+    monkeypatch.setattr(job_queue, "VISIBILITY_TIMEOUT_SECONDS", -1)
+    jobs = make_jobs()
+    job = jobs.submit({"urls": ["https://a.example/", "https://b.example/"]})
+    body = json.dumps({"job_id": job["job_id"], "index": 0})
+    calls = []
+
+    def process(url, query, userid, html_resp, options):
+        calls.append(url)
+        if len(calls) == 1:
+            assert jobs.process_message(body) is True
+        return ok_result(url)
+
+    monkeypatch.setattr(job_queue.pipeline, "process_single_url", process)
+    assert jobs.process_message(body) is True
+    assert len(calls) == 2
+    status = jobs.status(job["job_id"])
+    assert (status["status"], status["succeeded"], status["failed"]) == ("running", 1, 0)
+
+
+def test_local_worker_survives_exceptions(monkeypatch):
+    # 処理中の例外は再配信され、次の試行で完了する
+    calls = []
+
+    def process(url, query, userid, html_resp, options):
+        calls.append(url)
+        if len(calls) == 1:
+            raise RuntimeError("worker crashed")
+        return ok_result(url)
+
+    monkeypatch.setattr(job_queue.pipeline, "process_single_url", process)
+    monkeypatch.setattr(job_queue, "RETRY_DELAY_SECONDS", 0)
+    jobs = make_jobs()
+    job = jobs.submit({"urls": ["https://a.example/"]})
+    jobs.run_local_worker(workers=2)
+    status = jobs.status(job["job_id"])
+    assert (status["succeeded"], status["failed"]) == (1, 0)
+    assert len(calls) == 2
+
+
+def test_requires_sqs_and_dynamodb_outside_local(monkeypatch):
+    monkeypatch.setattr(kv_store, "LOCAL_ENV", False)
+    monkeypatch.setattr(job_queue, "JOB_QUEUE_URL", None)
+    monkeypatch.setattr(job_queue, "_job_queue", None)
+    with pytest.raises(RuntimeError):
+        job_queue.create_job_queue()
+    resp = job_queue.handle({"action": "submit", "urls": ["https://a.example/"]})
+    assert resp["statusCode"] == 500
+
+    monkeypatch.setattr(job_queue, "JOB_QUEUE_URL", "https://sqs.example/queue")
+    monkeypatch.setattr(job_queue, "JOB_STORE_BACKEND", "memory")
+    with pytest.raises(RuntimeError):
+        job_queue.create_job_queue()
@@ -0,0 +1,37 @@
+import time
+
+import pytest
+
+import kv_store
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    return kv_store.create_backend(request.param, sqlite_path=str(tmp_path / "kv.sqlite3"))
+
+
+def test_put_get_delete(backend):
+    backend.put("a", {"x": 1}, 123.0)
+    assert backend.get("a") == ({"x": 1}, 123.0)
+    backend.delete("a")
+    assert backend.get("a") is None
+
+
+def test_incr(backend):
+    assert backend.incr("count", 0) == 0
+    assert backend.incr("count") == 1
+    assert backend.incr("count", 2) == 3
+
+
+def test_put_if_absent(backend):
+    assert backend.put_if_absent("claim", {"worker": 1}, time.time() + 60) is True
+    # 期限内は上書きしない
+    assert backend.put_if_absent("claim", {"worker": 2}, time.time() + 60) is False
+    assert backend.get("claim")[0] == {"worker": 1}
+    # 期限切れなら無いものとして書き込む
+    backend.put("stale", {"worker": 1}, time.time() - 1)
+    assert backend.put_if_absent("stale", {"worker": 2}, time.time() + 60) is True
+    assert backend.get("stale")[0] == {"worker": 2}
+    # 期限の無い項目は上書きしない
+    backend.put("forever", 1)
+    assert backend.put_if_absent("forever", 2) is False
@@ -0,0 +1,152 @@
+import pytest
+import requests
+
+pytest.importorskip("boto3")
+
+import artifact_store
+import lambda_function
+import llm_client
+import prompt_builder
+
+
+def fail_invoke(fn_name, payload):
+    raise Exception("Error invoking Lambda: timeout")
+
+
+def error_body_invoke(fn_name, payload):
+    return {"statusCode": 500, "body": '{"error": "Failed to parse HTML"}'}
+
+
+def function_error_invoke(fn_name, payload):
+    # 関数自体が例外で終わった場合の Lambda の応答
+    return {"errorMessage": "Task timed out after 60.00 seconds", "errorType": "Sandbox.Timedout"}
+
+
+def unreadable_artifacts(monkeypatch):
+    monkeypatch.setattr(artifact_store, "_backend", None)
+    monkeypatch.setattr(artifact_store, "_backend_created", True)
+    return {artifact_store.REF_KEY: "html/a.txt.zst", "format": "text", "encoding": "zstd"}
+
+
+@pytest.mark.parametrize("invoke", [fail_invoke, error_body_invoke, function_error_invoke])
+def test_convert_page_falls_back_to_raw_html(monkeypatch, invoke):
+    monkeypatch.setattr(lambda_function, "invoke_lambda", invoke)
+    markdown, content_extraction = lambda_function.convert_page("https://example.com/", "<p>本文</p>", {})
+    assert markdown == "#RAW HTML FALLBACK\n<p>本文</p>"
+    assert content_extraction is None
+
+
+def test_convert_page_fallback_with_unreadable_artifact(monkeypatch):
+    # 変換に失敗し、保存された HTML も読めない場合でも例外にせず Markdown 無しで返す
+    monkeypatch.setattr(lambda_function, "invoke_lambda", fail_invoke)
+    ref = unreadable_artifacts(monkeypatch)
+    markdown, content_extraction = lambda_function.convert_page("https://example.com/", ref, {})
+    assert markdown is None
+    assert content_extraction is None
+
+
+@pytest.fixture
+def analysis_cache_backend(monkeypatch):
+    import kv_store
+    import analysis_cache
+    cache = analysis_cache.AnalysisCache(kv_store.MemoryBackend())
+    monkeypatch.setattr(lambda_function, "result_cache", cache)
+    return cache
+
+
+def test_analyze_article_uses_cache(monkeypatch, analysis_cache_backend):
+    calls = []
+    monkeypatch.setattr(lambda_function, "call_gemini_no_image",
+                        lambda text, cached_content=None: calls.append(text) or '{"score": 3}')
+    first = lambda_function.analyze_article("https://example.com/", "質問", "# 本文", [], {})
+    second = lambda_function.analyze_article("https://example.com/", "質問", "# 本文", [], {})
+    assert (first[0], first[2], first[3]) == ('{"score": 3}', "miss", None)
+    assert (second[0], second[2], second[3]) == ('{"score": 3}', "hit", None)
+    assert len(calls) == 1
+
+
+def test_analyze_article_with_context_cache(monkeypatch, analysis_cache_backend):
+    # 共通の指示を登録済みなら、記事部分だけを送る
+    import analysis_cache
+    stub = analysis_cache.StubContextCache()
+    monkeypatch.setattr(lambda_function, "context_cache", stub)
+    sent = []
+    monkeypatch.setattr(lambda_function, "call_gemini_no_image",
+                        lambda text, cached_content=None: sent.append((text, cached_content)) or "{}")
+    name = lambda_function.register_context_cache("長い分析の指示")
+    lambda_function.analyze_article("https://example.com/", "長い分析の指示", "# 本文", [],
+                                    {"context_cache_name": name})
+    [(text, cached_content)] = sent
+    assert cached_content == name
+    assert "長い分析の指示" not in text and "本文" in text
+    lambda_function.release_context_cache(name)
+    assert stub.counters == {"created": 1, "deleted": 1}
+
+
+def test_analyze_article_reports_failure(monkeypatch, analysis_cache_backend):
+    def rate_limited(text, cached_content=None):
+        raise RuntimeError("429 Too Many Requests")
+
+    monkeypatch.setattr(lambda_function, "call_gemini_no_image", rate_limited)
+    gemini_text, _, _, error = lambda_function.analyze_article("https://example.com/", "質問", "# 本文", [], {})
+    assert gemini_text.startswith("Gemini call failed")
+    assert str(error) == "429 Too Many Requests"
+    # 失敗した結果はキャッシュしない
+    assert analysis_cache_backend.stats()["stores"] == 0
+
+
+HTML_RESP = {"url": "https://example.com/", "html": "<p>本文</p>", "fetch_tier": "selenium",
+             "screenshot_url": "https://bucket.s3.amazonaws.com/live/a.png",
+             "cropped_screenshot_url": "https://bucket.s3.amazonaws.com/live/b.png"}
+
+
+def test_process_single_url_without_markdown(monkeypatch, analysis_cache_backend):
+    # html_to_md がエラーを返し、保存された HTML も読めない（markdown 無し）場合も、スクショは結果に残す
+    # Gemini には記事の代わりに「取得できなかった」旨を入れた query だけのプロンプトを送る
+    monkeypatch.setattr(lambda_function, "invoke_lambda", error_body_invoke)
+    html_resp = dict(HTML_RESP, html=unreadable_artifacts(monkeypatch))
+    sent = []
+    monkeypatch.setattr(lambda_function, "call_gemini_no_image",
+                        lambda text, cached_content=None: sent.append(text) or '{"score": 0}')
+    result = lambda_function.process_single_url("https://example.com/", "質問", "guest", html_resp,
+                                                {"url_cache": False})
+    assert "error" not in result
+    assert "analysis_error" not in result
+    assert result["markdown"] is None
+    assert result["gemini_text"] == '{"score": 0}'
+    assert result["prompt_budget"]["source"] == "none"
+    assert sent == ["質問" + prompt_builder.ARTICLE_SEPARATOR + prompt_builder.NO_ARTICLE_NOTICE]
+    assert result["screenshot_url"] == HTML_RESP["screenshot_url"]
+    assert set(result["timings"]) >= {"convert", "images", "analyze"}
+
+
+def test_process_single_url_without_gemini_text(monkeypatch, analysis_cache_backend):
+    # Gemini が候補を返さない（安全性のブロック）場合も、Markdown とスクショは結果に残す
+    monkeypatch.setattr(lambda_function, "invoke_lambda",
+                        lambda fn_name, payload: {"statusCode": 200, "body": '{"markdown": "# 本文"}'})
+    monkeypatch.setattr(lambda_function, "_generate_content", lambda payload: None)
+    result = lambda_function.process_single_url("https://example.com/", "質問", "guest", dict(HTML_RESP),
+                                                {"url_cache": False})
+    assert "error" not in result
+    assert (result["markdown"], result["gemini_text"]) == ("# 本文", None)
+    assert result["screenshot_url"] == HTML_RESP["screenshot_url"]
+
+
+@pytest.mark.parametrize("error, retryable", [
+    (llm_client.LLMHTTPError(429, "rate limited"), True),
+    (llm_client.LLMHTTPError(503, "unavailable"), True),
+    (requests.Timeout("read timed out"), True),
+    (llm_client.LLMHTTPError(400, "invalid argument"), False),
+    (KeyError("candidates"), False),
+])
+def test_process_single_url_marks_retryable_gemini_failures(monkeypatch, analysis_cache_backend, error, retryable):
+    def failing(text, cached_content=None):
+        raise error
+
+    monkeypatch.setattr(lambda_function, "invoke_lambda",
+                        lambda fn_name, payload: {"statusCode": 200, "body": '{"markdown": "# 本文"}'})
+    monkeypatch.setattr(lambda_function, "call_gemini_no_image", failing)
+    result = lambda_function.process_single_url("https://example.com/", "質問", "guest", dict(HTML_RESP),
+                                                {"url_cache": False})
+    assert result["analysis_error"] == str(error)
+    assert result["analysis_retryable"] is retryable
@@ -0,0 +1,156 @@
+import time
+from email.utils import format_datetime
+from datetime import datetime, timezone, timedelta
+
+import pytest
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import llm_client
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None, text="{}"):
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers or {})
+        self.text = text
+
+
+class ScriptedClient(llm_client.LLMClient):
+    """post を、用意した応答（または例外）を順に返すものに置き換える。"""
+
+    def __init__(self, script, max_concurrency=8):
+        super().__init__(pool_size=max_concurrency, provider="test")
+        self.limiter = llm_client.AdaptiveLimiter("test", rate_per_sec=0, max_concurrency=max_concurrency)
+        self.script = list(script)
+        self.posts = 0
+
+    def post(self, url, payload, headers=None, timeout=None):
+        self.posts += 1
+        item = self.script.pop(0)
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    # バックオフの乱数を 0 にし、待ち時間は記録するだけにする
+    recorded = []
+    monkeypatch.setattr(llm_client, "backoff_delay", lambda attempt: 0.0)
+    monkeypatch.setattr(llm_client.time, "sleep", recorded.append)
+    return recorded
+
+
+def test_limiter_halves_once_per_window():
+    limiter = llm_client.AdaptiveLimiter("test", rate_per_sec=0, max_concurrency=8)
+    started = [limiter.acquire() for _ in range(3)]
+    limiter.release(started[0], success=False, throttled=True)
+    assert limiter.limit == 4
+    # 減らす前に送ったリクエストの 429 では、もう一度は減らさない
+    limiter.release(started[1], success=False, throttled=True)
+    assert limiter.limit == 4
+    assert limiter.decreased_at > started[1]
+    # 減らした後に送ったリクエストの 429 では減らす
+    limiter.release(started[2])
+    later = limiter.acquire()
+    limiter.release(later, success=False, throttled=True)
+    assert limiter.limit == pytest.approx(4.25 / 2)
+    assert limiter.stats()["throttled"] == 3
+
+
+def test_limiter_never_goes_below_minimum():
+    limiter = llm_client.AdaptiveLimiter("test", rate_per_sec=0, max_concurrency=2, min_concurrency=1)
+    for _ in range(3):
+        limiter.release(limiter.acquire(), success=False, throttled=True)
+    assert limiter.limit == 1
+
+
+def test_limiter_additive_increase_up_to_max():
+    limiter = llm_client.AdaptiveLimiter("test", rate_per_sec=0, max_concurrency=5)
+    limiter.limit = 4.0
+    limiter.release(limiter.acquire())
+    assert limiter.limit == pytest.approx(4.25)
+    for _ in range(20):
+        limiter.release(limiter.acquire())
+    assert limiter.limit == 5
+    # 失敗（429 以外）では増やさない
+    limiter.limit = 3.0
+    limiter.release(limiter.acquire(), success=False)
+    assert limiter.limit == 3.0
+
+
+def test_limiter_pauses_for_retry_after():
+    limiter = llm_client.AdaptiveLimiter("test", rate_per_sec=0, max_concurrency=4)
+    limiter.release(limiter.acquire(), success=False, throttled=True, retry_after=5)
+    now = time.monotonic()
+    assert limiter.paused_until - now == pytest.approx(5, abs=0.5)
+    # 止めている間は、同時実行数に空きがあっても新しいリクエストを待たせる
+    assert limiter._wait_time(now) == pytest.approx(5, abs=0.5)
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({"Retry-After": "3"}, 3.0),
+    ({"retry-after": "2.5"}, 2.5),
+    ({"Retry-After": "-1"}, 0.0),
+    ({"retry-after-ms": "1500"}, 1.5),
+    ({"retry-after-ms": "200", "Retry-After": "10"}, 0.2),   # ms の指定を優先する
+    ({"retry-after-ms": "soon", "Retry-After": "4"}, 4.0),
+    ({"Retry-After": "soon"}, None),
+    ({}, None),
+])
+def test_parse_retry_after(headers, expected):
+    assert llm_client.parse_retry_after(CaseInsensitiveDict(headers)) == expected
+
+
+def test_parse_retry_after_http_date():
+    when = datetime.now(timezone.utc) + timedelta(seconds=30)
+    wait = llm_client.parse_retry_after(CaseInsensitiveDict({"Retry-After": format_datetime(when, usegmt=True)}))
+    assert wait == pytest.approx(30, abs=2)
+    past = datetime.now(timezone.utc) - timedelta(seconds=30)
+    assert llm_client.parse_retry_after(CaseInsensitiveDict({"Retry-After": format_datetime(past, usegmt=True)})) == 0
+
+
+def test_call_retries_429_after_retry_after(sleeps):
+    client = ScriptedClient([FakeResponse(429, {"retry-after-ms": "10"}), FakeResponse(200)])
+    response = client.call("https://llm.example/", {})
+    assert response.status_code == 200
+    assert client.posts == 2
+    assert sleeps == [0.01]
+    stats = client.stats()
+    assert (stats["throttled"], stats["retries"], stats["concurrency_limit"]) == (1, 1, 4)
+
+
+def test_call_retries_server_errors(sleeps):
+    client = ScriptedClient([FakeResponse(503), FakeResponse(500), FakeResponse(200)])
+    assert client.call("https://llm.example/", {}).status_code == 200
+    assert client.posts == 3
+    stats = client.stats()
+    assert (stats["server_errors"], stats["retries"]) == (2, 2)
+
+
+def test_call_retries_connection_errors(sleeps):
+    client = ScriptedClient([requests.ConnectionError("reset"), FakeResponse(200)])
+    assert client.call("https://llm.example/", {}).status_code == 200
+    assert client.posts == 2
+
+
+@pytest.mark.parametrize("status", [400, 401, 404])
+def test_call_does_not_retry_client_errors(sleeps, status):
+    client = ScriptedClient([FakeResponse(status, text="bad request"), FakeResponse(200)])
+    with pytest.raises(llm_client.LLMHTTPError) as excinfo:
+        client.call("https://llm.example/", {})
+    assert excinfo.value.status_code == status
+    assert client.posts == 1
+    assert sleeps == []
+    assert not llm_client.is_retryable(excinfo.value)
+
+
+def test_call_gives_up_after_max_retries(sleeps):
+    client = ScriptedClient([FakeResponse(429)] * 3)
+    with pytest.raises(llm_client.LLMHTTPError) as excinfo:
+        client.call("https://llm.example/", {}, max_retries=2)
+    assert excinfo.value.status_code == 429
+    assert client.posts == 3
+    assert len(sleeps) == 2
+    assert llm_client.is_retryable(excinfo.value)
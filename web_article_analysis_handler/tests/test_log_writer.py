@@ -0,0 +1,125 @@
+import time
+import threading
+from decimal import Decimal
+
+import log_writer
+
+
+class FlakyTable:
+    """1回目の batch_write_item では先頭の unprocessed 件を UnprocessedItems として返す。"""
+
+    def __init__(self, unprocessed=0, fail_always=False):
+        self.unprocessed = unprocessed
+        self.fail_always = fail_always
+        self.lock = threading.Lock()
+        self.batches = []
+        self.items = []
+
+    def batch_write_item(self, RequestItems):
+        with self.lock:
+            [(table_name, requests)] = RequestItems.items()
+            self.batches.append(len(requests))
+            if self.fail_always:
+                return {"UnprocessedItems": {table_name: requests}}
+            rejected = requests[:self.unprocessed]
+            self.unprocessed = 0
+            self.items.extend(r["PutRequest"]["Item"] for r in requests[len(rejected):])
+            return {"UnprocessedItems": {table_name: rejected} if rejected else {}}
+
+
+def record(i, ts=None):
+    return {"userid": "u", "ts": ts or f"2024-01-01T00:00:{i:02d}", "url": f"https://example.com/{i}",
+            "gemini_text": "{}", "timings": {"fetch": 1.5}}
+
+
+def make_writer(table, **kwargs):
+    # バックグラウンドのスレッドが書き込まないよう、間隔は長くしておく
+    return log_writer.LogWriter(table, "logs", **dict({"flush_interval": 60}, **kwargs))
+
+
+def test_unprocessed_items_are_retried():
+    table = FlakyTable(unprocessed=3)
+    writer = make_writer(table)
+    for i in range(10):
+        writer.enqueue(record(i))
+    writer.flush()
+    assert len(table.items) == 10
+    # 2回目は書き込めなかった3件だけを送り直す
+    assert table.batches == [10, 3]
+    stats = writer.stats()
+    assert (stats["written"], stats["retries"], stats["dropped"], stats["buffered"]) == (10, 1, 0, 0)
+
+
+def test_gives_up_after_max_attempts():
+    table = FlakyTable(fail_always=True)
+    writer = make_writer(table, max_attempts=2)
+    writer.enqueue(record(0))
+    writer.flush()
+    assert table.batches == [1, 1]
+    assert writer.stats()["dropped"] == 1
+
+
+def test_batches_are_limited_to_batch_size():
+    table = FlakyTable()
+    writer = make_writer(table)
+    for i in range(60):
+        writer.enqueue(record(i))
+    writer.flush()
+    assert table.batches == [25, 25, 10]
+
+
+def test_duplicate_keys_go_to_separate_batches():
+    # 同じ (userid, ts) の項目が1回の batch_write_item に入るとエラーになるので次のバッチに回す
+    writer = make_writer(FlakyTable())
+    writer.enqueue(record(0, ts="2024-01-01T00:00:00"))
+    writer.enqueue(record(1, ts="2024-01-01T00:00:00"))
+    writer.enqueue(record(2))
+    first = writer._take(force=True)
+    assert [item["url"] for item in first] == ["https://example.com/0", "https://example.com/2"]
+    second = writer._take(force=True)
+    assert [item["url"] for item in second] == ["https://example.com/1"]
+    assert writer._take(force=True) == []
+
+
+def test_take_waits_for_size_or_age():
+    writer = make_writer(FlakyTable(), batch_size=3)
+    writer.enqueue(record(0))
+    assert writer._take() == []
+    # 最古の記録が flush_interval を超えたら、件数が溜まっていなくても取り出す
+    writer.oldest_at -= 61
+    assert len(writer._take()) == 1
+    for i in range(3):
+        writer.enqueue(record(i))
+    assert len(writer._take()) == 3
+
+
+def test_background_thread_flushes_by_age():
+    table = FlakyTable()
+    writer = log_writer.LogWriter(table, "logs", flush_interval=0.05)
+    writer.enqueue(record(0))
+    deadline = time.monotonic() + 2
+    while not table.items and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(table.items) == 1
+    assert writer.stats()["buffered"] == 0
+
+
+def test_floats_are_converted_for_dynamodb():
+    table = FlakyTable()
+    writer = make_writer(table)
+    writer.enqueue(dict(record(0), cache=None))
+    writer.flush()
+    [item] = table.items
+    assert item["timings"] == {"fetch": Decimal("1.5")}
+    # None の項目は書き込まない
+    assert "cache" not in item
+
+
+def test_local_table():
+    table = log_writer.LocalTable()
+    writer = make_writer(table)
+    for i in range(5):
+        writer.enqueue(record(i))
+    writer.flush()
+    assert len(table.items) == 5
+    assert table.calls == 1
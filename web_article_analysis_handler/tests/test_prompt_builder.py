@@ -0,0 +1,101 @@
+import pytest
+
+import prompt_builder
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("abcd" * 10, 11),     # 英数字はおよそ4文字で1トークン
+    ("日本語の本文", 7),      # 日本語などは1文字で1トークン
+    ("ab日本", 3),
+    ("", 1),
+])
+def test_estimate_tokens(text, expected):
+    assert prompt_builder.estimate_tokens(text) == expected
+
+
+def test_split_markdown_kinds_and_code_blocks():
+    markdown = "\n".join([
+        "# 見出し", "",
+        "本文の段落です。", "",
+        "- 項目1", "- 項目2", "",
+        "| a | b |", "",
+        "[リンク](https://example.com/)", "",
+        "![画像の説明](https://example.com/a.png)", "",
+        "```", "code", "", "more code", "```", "",
+        "最後の段落",
+    ])
+    units = prompt_builder.split_markdown(markdown)
+    assert [kind for kind, _ in units] == ["heading", "text", "list", "table", "link", "image", "code", "text"]
+    # コードブロックは中の空行で分けない
+    assert units[6][1] == "```\ncode\n\nmore code\n```"
+    assert units[2][1] == "- 項目1\n- 項目2"
+
+
+def test_fit_markdown_keeps_higher_priority_kinds():
+    markdown = "\n\n".join([
+        "# 見出し",
+        "本文" * 20,
+        "- " + "項目" * 20,
+        "| " + "表" * 40 + " |",
+        "[" + "リンク" * 20 + "](https://example.com/)",
+    ])
+    # 予算: 見出し（4）と本文（41）が入り、リスト以降は入らない
+    fitted, decisions = prompt_builder.fit_markdown(markdown, prompt_builder.SUMMARY_RESERVE_TOKENS + 50)
+    assert fitted.startswith("# 見出し\n\n" + "本文" * 20)
+    assert decisions == {
+        "kept_units": 2,
+        "dropped_units": {"list": 1, "table": 1, "link": 1},
+        "truncated_units": 0,
+    }
+    assert fitted.endswith("（文字数の上限のため省略: list 1件、table 1件、link 1件）")
+
+
+def test_fit_markdown_truncates_first_text_that_does_not_fit():
+    markdown = "# 見出し\n\n" + "あ" * 500 + "\n\n" + "い" * 500
+    fitted, decisions = prompt_builder.fit_markdown(markdown, prompt_builder.SUMMARY_RESERVE_TOKENS + 200)
+    heading, truncated, summary = fitted.split("\n\n")
+    assert heading == "# 見出し"
+    # 最初の本文だけを入るところまで切り、2つ目の本文は省略する
+    assert truncated.endswith("…") and set(truncated[:-1]) == {"あ"}
+    assert prompt_builder.estimate_tokens(truncated) <= 200
+    assert decisions == {"kept_units": 2, "dropped_units": {"text": 1}, "truncated_units": 1}
+    assert summary == "（文字数の上限のため省略: text 1件）"
+
+
+def test_build_prompt_within_budget():
+    prompt, record = prompt_builder.build_prompt("質問", "# 見出し\n\n本文", budget=1000)
+    assert prompt == "質問" + prompt_builder.ARTICLE_SEPARATOR + "# 見出し\n\n本文"
+    assert record["source"] == "markdown"
+    assert record["truncated"] is False
+    assert record["estimated_tokens_before"] == record["estimated_tokens_after"]
+
+
+def test_build_prompt_records_truncation():
+    markdown = "# 見出し\n\n" + "本文" * 500
+    prompt, record = prompt_builder.build_prompt("質問", markdown, budget=300)
+    assert record["truncated"] is True
+    assert record["budget_tokens"] == 300
+    assert record["estimated_tokens_before"] > record["estimated_tokens_after"]
+    assert record["truncated_units"] == 1
+    # 記事部分は query と区切りを除いた予算に収める
+    article = prompt[len("質問" + prompt_builder.ARTICLE_SEPARATOR):]
+    assert prompt_builder.estimate_tokens(article) <= 300
+
+
+def test_build_prompt_raw_html_fallback():
+    raw = prompt_builder.RAW_HTML_PREFIX + "<p>本文&amp;説明</p><script>var x = 1;</script><!-- メモ -->"
+    prompt, record = prompt_builder.build_prompt("質問", raw, budget=1000, include_query=False)
+    assert record["source"] == "raw_html"
+    # タグ・スクリプト・コメントを除いたテキストにし、生 HTML であることは先頭の記号で伝える
+    assert prompt == prompt_builder.ARTICLE_SEPARATOR + prompt_builder.RAW_HTML_PREFIX + "本文&説明"
+
+
+@pytest.mark.parametrize("markdown", [None, ""])
+def test_build_prompt_without_article(markdown):
+    prompt, record = prompt_builder.build_prompt("質問", markdown, budget=1000)
+    assert prompt == "質問" + prompt_builder.ARTICLE_SEPARATOR + prompt_builder.NO_ARTICLE_NOTICE
+    assert record["source"] == "none"
+    assert record["truncated"] is False
+
+    article_only, _ = prompt_builder.build_prompt("質問", markdown, budget=1000, include_query=False)
+    assert article_only == prompt_builder.ARTICLE_SEPARATOR + prompt_builder.NO_ARTICLE_NOTICE
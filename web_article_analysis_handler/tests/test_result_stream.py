@@ -0,0 +1,96 @@
+import json
+import time
+import threading
+import http.client
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("boto3")
+
+import lambda_function
+import result_stream
+
+URLS = ["https://a.example/", "https://b.example/", "https://c.example/", "https://d.example/"]
+
+
+def stub_process(delays, outcomes=None):
+    # URL ごとに delays 秒待ってから結果を返す（outcomes で失敗の種類を指定する）
+    def process(url, query, userid, html_resp, options):
+        time.sleep(delays.get(url, 0))
+        result = {"url": url, "markdown": "# 本文 " + url, "gemini_text": "{}"}
+        result.update((outcomes or {}).get(url, {}))
+        return result
+    return process
+
+
+def test_records_in_completion_order_with_summary(monkeypatch):
+    delays = {URLS[0]: 0.3, URLS[1]: 0.0, URLS[2]: 0.15, URLS[3]: 0.05}
+    monkeypatch.setattr(lambda_function, "process_single_url", stub_process(delays))
+    records = [json.loads(line) for line in result_stream.iter_ndjson({"urls": URLS, "query": "q"})]
+
+    results, summary = records[:-1], records[-1]
+    # 完了した順（速いものから）に返し、最後に集計を返す
+    assert [r["url"] for r in results] == [URLS[1], URLS[3], URLS[2], URLS[0]]
+    assert [r["completed"] for r in results] == [1, 2, 3, 4]
+    assert all(r["type"] == "result" and r["total"] == 4 for r in results)
+    assert results[0]["markdown"] == "# 本文 " + URLS[1]
+    assert summary["type"] == "summary"
+    assert (summary["total"], summary["completed"], summary["failed"]) == (4, 4, 0)
+    assert summary["first_result_seconds"] < summary["elapsed_seconds"]
+    assert "cache_stats" in summary
+
+
+def test_summary_counts_fetch_and_gemini_failures(monkeypatch):
+    outcomes = {
+        URLS[0]: {"error": "can't_get_html"},
+        URLS[1]: {"analysis_error": "HTTP 429: rate limited", "analysis_retryable": True},
+    }
+    monkeypatch.setattr(lambda_function, "process_single_url", stub_process({}, outcomes))
+    summary = list(result_stream.iter_records({"urls": URLS}))[-1]
+    assert (summary["completed"], summary["failed"]) == (4, 2)
+
+
+def test_without_markdown(monkeypatch):
+    monkeypatch.setattr(lambda_function, "process_single_url", stub_process({}))
+    records = list(result_stream.iter_records({"urls": URLS[:2], "include_markdown": False}))
+    for record in records[:-1]:
+        assert "markdown" not in record
+        assert record["markdown_chars"] == len("# 本文 ") + len(record["url"])
+
+
+def test_job_error_is_reported_in_summary(monkeypatch):
+    def broken(event, on_result=None):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(lambda_function, "run_job", broken)
+    [summary] = result_stream.iter_records({"urls": URLS})
+    assert (summary["type"], summary["completed"], summary["error"]) == ("summary", 0, "boom")
+
+
+def test_http_server_streams_rows_before_the_job_finishes(monkeypatch):
+    # 遅い URL が終わる前に、完了した行をクライアントが受け取れる
+    release = threading.Event()
+
+    def process(url, query, userid, html_resp, options):
+        if url == URLS[0]:
+            assert release.wait(5)
+        return {"url": url, "markdown": "# 本文", "gemini_text": "{}"}
+
+    monkeypatch.setattr(lambda_function, "process_single_url", process)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), result_stream.StreamingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+        conn.request("POST", "/", body=json.dumps({"urls": URLS[:2], "include_markdown": False}))
+        resp = conn.getresponse()
+        assert resp.getheader("Content-Type") == result_stream.NDJSON_CONTENT_TYPE
+        first = json.loads(resp.readline())
+        assert (first["url"], first["completed"]) == (URLS[1], 1)
+        release.set()
+        rest = [json.loads(line) for line in resp.read().splitlines()]
+        assert [r["type"] for r in rest] == ["result", "summary"]
+        assert rest[-1]["completed"] == 2
+    finally:
+        release.set()
+        server.shutdown()
@@ -0,0 +1,69 @@
+import pytest
+
+import static_fetch
+
+ARTICLE_TEXT = "新しい電池は従来品より容量が大きく、充電にかかる時間も半分ほどになった。" * 20
+SCRIPT = "<script>" + "var state = {};" * 800 + "</script>"
+
+
+def page(body, head=""):
+    return f"<html><head><title>t</title>{head}</head><body>{body}</body></html>"
+
+
+@pytest.mark.parametrize("html, complete, reason", [
+    # 中身が空のマウント先だけの SPA のひな形
+    (page('<div id="root"></div>' + SCRIPT), False, "spa_shell"),
+    (page("<div id='__next'> </div><p>" + ARTICLE_TEXT + "</p>"), False, "spa_shell"),
+    # JavaScript を有効にするよう求める表示
+    (page("<noscript>Please enable JavaScript to view this page.</noscript>"), False, "javascript_required"),
+    (page("<noscript>JavaScriptを有効にしてください</noscript><p>読み込み中</p>"), False, "javascript_required"),
+    (page("<p>読み込み中</p>"), False, "too_little_text"),
+    # テキストは最低限あるが、ほとんどが script
+    (page("<p>" + "本文" * 300 + "</p>" + SCRIPT), False, "script_heavy"),
+    # 本文が十分にあれば script が多くても揃っているとみなす
+    (page("<p>" + ARTICLE_TEXT * 3 + "</p>" + SCRIPT), True, "complete"),
+    (page('<div id="root"><article><p>' + ARTICLE_TEXT + "</p></article></div>"), True, "complete"),
+])
+def test_check_completeness(html, complete, reason):
+    result = static_fetch.check_completeness(html)
+    assert result[:2] == (complete, reason)
+    assert result[2] == len(static_fetch.prompt_builder.html_to_text(html))
+
+
+@pytest.mark.parametrize("html, expected", [
+    # src が無ければ追加する
+    ('<img data-src="/a.png" alt="a">', '<img src="/a.png" data-src="/a.png" alt="a">'),
+    # プレースホルダの src は置き換える
+    ('<img src="data:image/gif;base64,R0lG" data-src="/a.png">', '<img src="/a.png" data-src="/a.png">'),
+    ("<IMG class='lazy' src='blank.gif' data-lazy-src='/b.jpg'>", "<IMG class='lazy' src=\"/b.jpg\" data-lazy-src='/b.jpg'>"),
+    ('<img data-original-src="/c.png">', '<img src="/c.png" data-original-src="/c.png">'),
+    # 遅延読み込みでなければ変えない
+    ('<img src="/d.png" alt="d">', '<img src="/d.png" alt="d">'),
+    ('<div data-src="/e.png"></div>', '<div data-src="/e.png"></div>'),
+])
+def test_copy_lazy_image_src(html, expected):
+    assert static_fetch.copy_lazy_image_src(html) == expected
+
+
+def test_copy_lazy_image_src_every_img():
+    html = '<p><img data-src="/1.png"></p><p><img src="/2.png"></p><p><img data-src="/3.png" src=""></p>'
+    assert static_fetch.copy_lazy_image_src(html) == (
+        '<p><img src="/1.png" data-src="/1.png"></p><p><img src="/2.png"></p><p><img data-src="/3.png" src="/3.png"></p>'
+    )
+
+
+@pytest.mark.parametrize("data, expected", [
+    # <meta charset> の指定を優先する
+    (b'<html><head><meta charset="Shift_JIS"></head>', "Shift_JIS"),
+    (b"<meta http-equiv='Content-Type' content='text/html; charset=euc-jp'>", "euc-jp"),
+    ("<p>日本語の本文</p>".encode("utf-8"), "utf-8"),
+    (b"<p>plain ascii</p>", "utf-8"),
+])
+def test_detect_encoding(data, expected):
+    assert static_fetch.detect_encoding(data) == expected
+
+
+def test_detect_encoding_guesses_without_meta():
+    data = ("<p>" + ARTICLE_TEXT + "</p>").encode("shift_jis")
+    encoding = static_fetch.detect_encoding(data)
+    assert data.decode(encoding) == "<p>" + ARTICLE_TEXT + "</p>"
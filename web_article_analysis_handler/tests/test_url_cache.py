@@ -0,0 +1,70 @@
+import kv_store
+import url_cache
+
+URL = "https://example.com/article"
+PAGE = {"url": URL, "fetch_tier": "static", "screenshot_s3_key": "live/a.png", "content_sha256": "abc"}
+
+
+def make_cache():
+    return url_cache.URLCache(kv_store.MemoryBackend())
+
+
+def test_hit_with_same_options():
+    cache = make_cache()
+    options = {"extract_main_content": True, "output": "html"}
+    cache.store(URL, options, PAGE, "# 本文")
+    page, status = cache.lookup(URL, options)
+    assert status == "hit"
+    assert page["markdown"] == "# 本文"
+    assert page["screenshot_s3_key"] == "live/a.png"
+
+
+def test_output_is_part_of_the_key():
+    # blocks で取得した（本文抽出をしていない）Markdown を、本文抽出を指定した html の要求に返さない
+    cache = make_cache()
+    cache.store(URL, {"extract_main_content": True, "output": "blocks"}, PAGE, "# ページ全体")
+    page, status = cache.lookup(URL, {"extract_main_content": True, "output": "html"})
+    assert (page, status) == (None, "miss")
+
+
+def test_block_resources_is_part_of_the_key():
+    assert (url_cache.cache_key(URL, {"block_resources": {"ads": True}})
+            != url_cache.cache_key(URL, {"block_resources": False}))
+
+
+def test_fallback_markdown_is_not_stored():
+    cache = make_cache()
+    cache.store(URL, {}, PAGE, "#RAW HTML FALLBACK\n<p>x</p>")
+    cache.store(URL, {"output": "blocks"}, PAGE, None)
+    assert cache.stats()["stores"] == 0
+
+
+def test_screenshot_required():
+    cache = make_cache()
+    cache.store(URL, {"screenshot": False}, dict(PAGE, screenshot_s3_key=None), "# 本文")
+    assert cache.lookup(URL, {"screenshot": True})[1] == "miss"
+    assert cache.lookup(URL, {"screenshot": False})[1] == "hit"
+
+
+def test_selenium_page_is_stored_without_a_request(monkeypatch):
+    # Selenium Lambda の応答にある ETag / Last-Modified をそのまま保存し、保存のために HEAD を送らない
+    import static_fetch
+
+    def no_request(*args, **kwargs):
+        raise AssertionError("保存時にリクエストを送った")
+
+    monkeypatch.setattr(static_fetch.session, "head", no_request)
+    monkeypatch.setattr(static_fetch.session, "get", no_request)
+    cache = make_cache()
+    page = dict(PAGE, fetch_tier="selenium", etag='"v1"', last_modified="Wed, 01 May 2024 00:00:00 GMT")
+    cache.store(URL, {}, page, "# 本文")
+    assert cache.stats()["stores"] == 1
+
+    # 新鮮でなくなったら、保存した値で条件付きリクエストを送って再検証する
+    checked = []
+    monkeypatch.setattr(static_fetch, "check_modified",
+                        lambda url, etag=None, last_modified=None: checked.append((etag, last_modified)) or False)
+    cache.fresh_seconds = 0
+    page, status = cache.lookup(URL, {})
+    assert status == "revalidated"
+    assert checked == [('"v1"', "Wed, 01 May 2024 00:00:00 GMT")]
@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+import kv_store
+import artifact_store
+import static_fetch
+
+# 保存先: memory / sqlite / dynamodb / none
+URL_CACHE_BACKEND = os.environ.get("URL_CACHE_BACKEND", "sqlite" if kv_store.LOCAL_ENV else "memory").lower()
+# この秒数の間は再検証せずにそのまま使う
+FRESH_SECONDS = int(os.environ.get("URL_CACHE_TTL_SECONDS", str(24 * 3600)))
+# 新鮮でなくなってからも、この秒数までは条件付きリクエストで再検証して使う
+MAX_AGE_SECONDS = int(os.environ.get("URL_CACHE_MAX_AGE_SECONDS", str(7 * 24 * 3600)))
+# これを超える Markdown は artifact_store に置き、キャッシュには参照だけを入れる（DynamoDB の 400KB 制限対策）
+MARKDOWN_INLINE_MAX_BYTES = int(os.environ.get("URL_CACHE_MARKDOWN_INLINE_MAX_BYTES", str(64 * 1024)))
+
+# Markdown・スクショの中身を変えるオプション。これが違えば別のキャッシュにする
+# output が blocks の場合は本文抽出を行わず、block_resources は読み込まれるリソース（描画される内容）を変える
+KEY_OPTIONS = (
+    "extract_main_content", "include_metadata", "model_image", "capture_mode", "capture_max_height",
+    "output", "block_resources",
+)
+# キャッシュから返す Selenium / 静的取得の応答の項目
+PAGE_FIELDS = (
+    "final_url", "fetch_tier", "screenshot_url", "cropped_screenshot_url", "screenshot_s3_key",
+    "model_screenshot_s3_keys", "model_screenshot_mime_type", "screenshot_stats",
+)
+
+# 変換に失敗して生の HTML / テキストを入れた Markdown はキャッシュしない
+_FALLBACK_PREFIX = "#RAW "
+
+
+def cache_key(url, options):
+    selected = {name: (options or {}).get(name) for name in KEY_OPTIONS}
+    digest = hashlib.sha256(json.dumps(selected, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return f"url:{url}:{digest}"
+
+
+class URLCache:
+    """
+    URL ごとに、取得・Markdown 変換の結果（画像の説明文は Markdown に含まれる）と
+    スクショの S3 キー、内容のハッシュ、ETag / Last-Modified を保存する。
+    - fresh_seconds 以内: そのまま使う（hit）
+    - それ以降 max_age_seconds まで: 条件付きリクエストで変わっていなければ使う（revalidated）
+    ヒットした URL は Selenium・html_to_md を呼ばず、Gemini の解析だけを行う。
+    """
+
+    def __init__(self, backend, fresh_seconds=FRESH_SECONDS, max_age_seconds=MAX_AGE_SECONDS):
+        self.backend = backend
+        self.fresh_seconds = fresh_seconds
+        self.max_age_seconds = max(max_age_seconds, fresh_seconds)
+        self.lock = threading.Lock()
+        self.counters = {
+            "lookups": 0, "hits": 0, "revalidated": 0, "changed": 0, "misses": 0,
+            "stores": 0, "bytes_saved": 0, "backend_errors": 0,
+        }
+
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def lookup(self, url, options=None):
+        """
+        戻り値: (キャッシュから作った応答 または None, 状態)
+        状態: hit / revalidated / changed（再検証で変更を検知）/ miss / disabled
+        応答には markdown と content_extraction が入る。
+        """
+        if self.backend is None:
+            return None, "disabled"
+        self._count("lookups")
+        key = cache_key(url, options)
+        try:
+            entry = self.backend.get(key)
+        except Exception as e:
+            print(f"URLキャッシュの読み込みに失敗しました: {e}")
+            self._count("backend_errors")
+            entry = None
+        now = time.time()
+        if entry is None or kv_store.is_expired(entry, now):
+            self._count("misses")
+            return None, "miss"
+        record = entry[0]
+
+        # スクショが必要なのに、キャッシュがスクショ無しで取得したものなら使えない
+        if (options or {}).get("screenshot", True) and not record.get("screenshot_s3_key"):
+            self._count("misses")
+            return None, "miss"
+
+        status = "hit"
+        if now - record["fetched_at"] > self.fresh_seconds:
+            if self._is_modified(url, record):
+                self._count("changed")
+                return None, "changed"
+            status = "revalidated"
+            record["fetched_at"] = now
+            self._put(key, record, now)
+
+        try:
+            markdown = artifact_store.unpack(record["markdown"])
+        except Exception as e:
+            # Markdown の実体が消えていた場合は取り直す
+            print(f"キャッシュした Markdown を読めないため取得し直します: {e}")
+            self._count("misses")
+            return None, "miss"
+
+        bytes_saved = record.get("content_bytes", 0) + record.get("markdown_bytes", 0)
+        self._count("hits" if status == "hit" else "revalidated")
+        self._count("bytes_saved", bytes_saved)
+        page = {"url": url, **{name: record.get(name) for name in PAGE_FIELDS}}
+        page.update({
+            "markdown": markdown,
+            "content_extraction": record.get("content_extraction"),
+            "cache": {"status": status, "fetched_at": record["fetched_at"], "bytes_saved": bytes_saved},
+        })
+        return page, status
+
+    def _is_modified(self, url, record):
+        """
+        ETag / Last-Modified があれば条件付きリクエストで、無ければ（静的取得できたページのみ）
+        HTML を取り直してハッシュで比べる。判定できなければ変わったものとして扱う。
+        """
+        if record.get("etag") or record.get("last_modified"):
+            modified = static_fetch.check_modified(url, record.get("etag"), record.get("last_modified"))
+            return modified is not False
+        if record.get("fetch_tier") == "static" and record.get("content_sha256"):
+            fetched = static_fetch.fetch_html(url)
+            return fetched is None or static_fetch.content_hash(fetched[1]) != record["content_sha256"]
+        return True
+
+    def store(self, url, options, page, markdown, content_extraction=None):
+        """
+        取得・変換が終わったページを保存する。変換に失敗した Markdown は保存しない。
+        page: Selenium Lambda / 静的取得の応答
+        """
+        if self.backend is None or not markdown or markdown.startswith(_FALLBACK_PREFIX):
+            return
+        now = time.time()
+        record = {name: page.get(name) for name in PAGE_FIELDS}
+        record.update({
+            "content_sha256": page.get("content_sha256"),
+            "content_bytes": page.get("content_bytes", 0),
+            "markdown": artifact_store.pack(markdown, "url-cache/markdown", MARKDOWN_INLINE_MAX_BYTES),
+            "markdown_bytes": len(markdown.encode("utf-8")),
+            "content_extraction": content_extraction,
+            # 静的取得は応答ヘッダ、Selenium Lambda はメインドキュメントの応答ヘッダの値（無ければ None）
+            "etag": page.get("etag"),
+            "last_modified": page.get("last_modified"),
+            "fetched_at": now,
+        })
+        self._put(cache_key(url, options), record, now)
+        self._count("stores")
+
+    def _put(self, key, record, now):
+        try:
+            self.backend.put(key, record, now + self.max_age_seconds)
+        except Exception as e:
+            print(f"URLキャッシュの書き込みに失敗しました: {e}")
+            self._count("backend_errors")
+
+
+def summarize(delta):
+    """stats の差分に、ヒット率（再検証して使えたものを含む）を加える。"""
+    summary = dict(delta)
+    lookups = delta.get("lookups", 0)
+    used = delta.get("hits", 0) + delta.get("revalidated", 0)
+    summary["hit_rate"] = round(used / lookups, 3) if lookups else 0.0
+    return summary
+
+
+def create_cache():
+    try:
+        backend = kv_store.create_backend(
+            URL_CACHE_BACKEND,
+            sqlite_path=os.environ.get("URL_CACHE_SQLITE_PATH", "/tmp/url_cache.sqlite3"),
+            table_name=os.environ.get("URL_CACHE_TABLE_NAME"),
+        )
+    except Exception as e:
+        print(f"URLキャッシュの保存先を初期化できないため、メモリのみで動かします: {e}")
+        backend = kv_store.MemoryBackend()
+    return URLCache(backend)